@@ -0,0 +1,131 @@
+"""分段器基准测试：对比旧版逐窗口分句的 chunk_text 与单遍分段实现
+
+用法:
+    python benchmarks/bench_chunker.py --sentences 20000 --repeat 3
+
+输出两种实现的耗时、加速比，以及边界质量：
+  - sentence_aligned: 片段结尾落在句子边界上的比例
+  - uncovered_tokens: 没有被任何片段覆盖的token数（旧实现在句子较长时会跳过内容）
+"""
+import os
+import sys
+import time
+import json
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from nltk.tokenize import sent_tokenize
+from services.text_processor import TextProcessor
+
+WORDS = ("retrieval index vector query document chunk token embedding latency throughput "
+         "cache batch memory parser sentence boundary overlap model answer context").split()
+CJK_WORDS = ["检索", "向量", "文档", "分段", "查询", "缓存", "延迟", "吞吐", "模型", "答案"]
+
+
+def legacy_chunk_text(processor: TextProcessor, text: str, document_id: int):
+    """旧版实现：每个窗口解码、分句，并逐句重新编码测量长度"""
+    chunks = []
+    tokens = processor.encoding.encode(text)
+    if len(tokens) <= processor.chunk_size:
+        return [{"document_id": document_id, "text": processor.encoding.decode(tokens),
+                 "start_pos": 0, "end_pos": len(tokens)}]
+
+    start = 0
+    while start < len(tokens):
+        end = min(start + processor.chunk_size, len(tokens))
+        sentences = sent_tokenize(processor.encoding.decode(tokens[start:end]))
+        new_end = end
+        if len(sentences) > 1:
+            last_full_sent_idx = -1
+            total_len = 0
+            for i, sent in enumerate(sentences):
+                sent_len = len(processor.encoding.encode(sent))
+                if total_len + sent_len <= processor.chunk_size * 0.9:
+                    last_full_sent_idx = i
+                    total_len += sent_len
+                else:
+                    break
+            if last_full_sent_idx >= 0:
+                end_tokens = processor.encoding.encode(' '.join(sentences[:last_full_sent_idx + 1]))
+                new_end = start + len(end_tokens)
+        if new_end <= start:
+            new_end = min(start + processor.chunk_size, len(tokens))
+        chunks.append({"document_id": document_id, "text": processor.encoding.decode(tokens[start:new_end]),
+                       "start_pos": start, "end_pos": new_end})
+        next_start = max(start + processor.chunk_size - processor.overlap, new_end - processor.overlap)
+        if next_start <= start:
+            next_start = start + processor.chunk_size
+        start = next_start
+    # 旧流程中上传接口还会把每个片段重新编码一次计算 total_tokens
+    for chunk in chunks:
+        chunk["token_count"] = len(processor.encoding.encode(chunk["text"]))
+    return chunks
+
+
+def make_text(sentences: int, seed: int = 42) -> str:
+    """生成长短不一的中英文混合句子"""
+    rng = random.Random(seed)
+    parts = []
+    for _ in range(sentences):
+        if rng.random() < 0.3:
+            parts.append("".join(rng.choices(CJK_WORDS, k=rng.randint(3, 30))) + "。")
+        else:
+            # 偶尔出现很长的句子，检验长句处理
+            n = rng.randint(60, 200) if rng.random() < 0.05 else rng.randint(4, 25)
+            parts.append(" ".join(rng.choices(WORDS, k=n)).capitalize() + ".")
+    return " ".join(parts)
+
+
+def boundary_quality(processor: TextProcessor, text: str, chunks) -> dict:
+    total = len(processor.encoding.encode(text))
+    covered = [False] * total
+    for chunk in chunks:
+        for i in range(chunk["start_pos"], min(chunk["end_pos"], total)):
+            covered[i] = True
+    aligned = sum(1 for chunk in chunks if chunk["text"].rstrip().endswith((".", "!", "?", "。", "！", "？")))
+    return {
+        "chunks": len(chunks),
+        "sentence_aligned": round(aligned / len(chunks), 4) if chunks else 0.0,
+        "uncovered_tokens": covered.count(False),
+        "max_tokens": max(chunk["end_pos"] - chunk["start_pos"] for chunk in chunks) if chunks else 0,
+    }
+
+
+def timed(fn, repeat: int):
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - started)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="对比新旧分段实现的速度和边界质量")
+    parser.add_argument("--sentences", type=int, default=20000, help="生成文本的句子数")
+    parser.add_argument("--repeat", type=int, default=3, help="每种实现重复次数（取最快一次）")
+    parser.add_argument("--chunk-size", type=int, default=None)
+    parser.add_argument("--overlap", type=int, default=None)
+    args = parser.parse_args()
+
+    processor = TextProcessor(chunk_size=args.chunk_size, overlap=args.overlap)
+    text = make_text(args.sentences)
+
+    legacy_seconds, legacy_chunks = timed(lambda: legacy_chunk_text(processor, text, 0), args.repeat)
+    current_seconds, current_chunks = timed(lambda: processor.chunk_text(text, 0), args.repeat)
+
+    print(json.dumps({
+        "chars": len(text),
+        "chunk_size": processor.chunk_size,
+        "overlap": processor.overlap,
+        "legacy": {"seconds": round(legacy_seconds, 4), **boundary_quality(processor, text, legacy_chunks)},
+        "single_pass": {"seconds": round(current_seconds, 4), **boundary_quality(processor, text, current_chunks)},
+        "speedup": round(legacy_seconds / current_seconds, 2) if current_seconds else None,
+    }, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+"""基准测试用的合成语料和文件生成器
+
+同一个种子总是生成相同的文本和文件，不同提交之间的基准结果可以直接比较。
+
+用法:
+    python benchmarks/corpus.py --out /tmp/kb_corpus --size-kb 512 --languages zh,en,mixed
+
+文本按语言从固定词表随机组句，句长呈长尾分布（偶尔出现很长的句子），
+可以生成 txt / docx / xlsx / pdf 四种格式。PDF 只使用内置的 Helvetica 字体，
+非拉丁字符无法显示，PDF 中只写入拉丁字母语言的文本。
+"""
+import os
+import sys
+import json
+import random
+import argparse
+from typing import Dict, Iterator, List
+
+LANGUAGES: Dict[str, dict] = {
+    "en": {
+        "words": ("retrieval index vector query document chunk token embedding latency throughput cache batch "
+                  "memory parser sentence boundary overlap model answer context server request response "
+                  "database table column storage engine replica schema migration upload").split(),
+        "joiner": " ", "end": ".",
+    },
+    "de": {
+        "words": ("Abfrage Dokument Speicher Antwort Größe Übersicht Verzeichnis Prüfung Schlüssel Länge "
+                  "Leistung Zwischenspeicher Ergebnis Modell Anfrage Datenbank Tabelle Grenze Maß Straße").split(),
+        "joiner": " ", "end": ".",
+    },
+    "fr": {
+        "words": ("requête document mémoire réponse modèle index vecteur données tâche système serveur "
+                  "résultat élément présentation fenêtre durée débit accès étape écriture").split(),
+        "joiner": " ", "end": ".",
+    },
+    "ru": {
+        "words": ("запрос документ память ответ модель индекс вектор данные задача система сервер "
+                  "результат элемент окно время скорость доступ запись таблица").split(),
+        "joiner": " ", "end": ".",
+    },
+    "zh": {
+        "words": ["检索", "向量", "文档", "分段", "查询", "缓存", "延迟", "吞吐", "模型", "答案", "索引", "数据库",
+                  "服务器", "请求", "响应", "内存", "解析", "句子", "边界", "上下文", "设备", "维护", "故障", "温度"],
+        "joiner": "", "end": "。",
+    },
+    "ja": {
+        "words": ["検索", "ベクトル", "文書", "分割", "クエリ", "キャッシュ", "遅延", "モデル", "回答", "索引",
+                  "データベース", "サーバー", "リクエスト", "メモリ", "解析", "です", "ます", "の", "を", "に"],
+        "joiner": "", "end": "。",
+    },
+}
+# 拉丁字母语言，PDF内置字体可以显示
+LATIN_LANGUAGES = ("en", "de", "fr")
+FORMATS = ("txt", "docx", "xlsx", "pdf")
+
+
+def make_sentence(rng: random.Random, language: str) -> str:
+    spec = LANGUAGES[language]
+    # 5%的长句，检验分段器对超长句子的处理
+    n = rng.randint(60, 200) if rng.random() < 0.05 else rng.randint(4, 25)
+    sentence = spec["joiner"].join(rng.choices(spec["words"], k=n))
+    if spec["joiner"]:
+        sentence = sentence[0].upper() + sentence[1:]
+    return sentence + spec["end"]
+
+
+def iter_sentences(languages: List[str], seed: int = 42) -> Iterator[str]:
+    """无限产出句子；languages 含 "mixed" 时每句随机选一种语言"""
+    rng = random.Random(seed)
+    choices = list(LANGUAGES) if "mixed" in languages else list(languages)
+    while True:
+        yield make_sentence(rng, rng.choice(choices))
+
+
+def make_text(chars: int, languages: List[str], seed: int = 42, paragraph_sentences: int = 8) -> str:
+    """生成约 chars 个字符的文本，每 paragraph_sentences 句换一个段落"""
+    parts, length = [], 0
+    for i, sentence in enumerate(iter_sentences(languages, seed)):
+        if length >= chars:
+            break
+        separator = "\n" if i and i % paragraph_sentences == 0 else " "
+        parts.append(separator + sentence if parts else sentence)
+        length += len(parts[-1])
+    return "".join(parts)
+
+
+def make_chunk_texts(count: int, languages: List[str], seed: int = 42, sentences: int = 6) -> List[str]:
+    """生成 count 个片段大小的文本，用于嵌入和关键词索引的基准"""
+    sentence_iter = iter_sentences(languages, seed)
+    return [" ".join(next(sentence_iter) for _ in range(sentences)) for _ in range(count)]
+
+
+def write_txt(path: str, text: str):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(text)
+
+
+def write_docx(path: str, text: str):
+    import docx
+    document = docx.Document()
+    for paragraph in text.split("\n"):
+        document.add_paragraph(paragraph)
+    document.save(path)
+
+
+def write_xlsx(path: str, text: str, rows_per_sheet: int = 50000):
+    """每个段落一行：序号、语言无关的数值列和段落文本"""
+    import openpyxl
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = None
+    for i, paragraph in enumerate(text.split("\n")):
+        if i % rows_per_sheet == 0:
+            sheet = workbook.create_sheet(f"Sheet{i // rows_per_sheet + 1}")
+            sheet.append(["id", "value", "text"])
+        sheet.append([i + 1, round((i * 7919 % 1000) / 10, 1), paragraph])
+    workbook.save(path)
+
+
+def _pdf_escape(line: str) -> bytes:
+    encoded = line.encode("cp1252", errors="replace")
+    return encoded.replace(b"\\", b"\\\\").replace(b"(", b"\\(").replace(b")", b"\\)")
+
+
+def write_pdf(path: str, text: str, lines_per_page: int = 60, line_chars: int = 95):
+    """不依赖第三方库写出带文本层的PDF（Helvetica，WinAnsi编码），pdfplumber可以直接提取文字"""
+    lines = []
+    for paragraph in text.split("\n"):
+        while paragraph:
+            cut = paragraph.rfind(" ", 0, line_chars) if len(paragraph) > line_chars else len(paragraph)
+            cut = cut if cut > 0 else min(line_chars, len(paragraph))
+            lines.append(paragraph[:cut].strip())
+            paragraph = paragraph[cut:].lstrip()
+    pages = [lines[i:i + lines_per_page] for i in range(0, len(lines), lines_per_page)] or [[]]
+
+    # 对象编号：1 目录，2 页树，3 字体，之后每页一个页面对象和一个内容流
+    objects = {3: b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>"}
+    kids = []
+    for i, page_lines in enumerate(pages):
+        page_id, content_id = 4 + 2 * i, 5 + 2 * i
+        stream = b"BT /F1 10 Tf 12 TL 50 770 Td " + b"".join(b"(" + _pdf_escape(line) + b") '" for line in page_lines) + b" ET"
+        objects[content_id] = b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream)
+        objects[page_id] = (b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+                            b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % content_id)
+        kids.append(b"%d 0 R" % page_id)
+    objects[1] = b"<< /Type /Catalog /Pages 2 0 R >>"
+    objects[2] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (b" ".join(kids), len(kids))
+
+    with open(path, "wb") as f:
+        f.write(b"%PDF-1.4\n")
+        offsets = {}
+        for object_id in sorted(objects):
+            offsets[object_id] = f.tell()
+            f.write(b"%d 0 obj\n%s\nendobj\n" % (object_id, objects[object_id]))
+        xref = f.tell()
+        f.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1))
+        for object_id in sorted(objects):
+            f.write(b"%010d 00000 n \n" % offsets[object_id])
+        f.write(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref))
+
+
+WRITERS = {"txt": write_txt, "docx": write_docx, "xlsx": write_xlsx, "pdf": write_pdf}
+
+
+def generate_files(out_dir: str, chars: int, languages: List[str], formats=FORMATS, seed: int = 42) -> Dict[str, str]:
+    """每种格式生成一个约 chars 个字符的文件，返回 {格式: 路径}"""
+    os.makedirs(out_dir, exist_ok=True)
+    paths = {}
+    for fmt in formats:
+        file_languages = languages
+        if fmt == "pdf":
+            file_languages = [lang for lang in (LATIN_LANGUAGES if "mixed" in languages else languages)
+                              if lang in LATIN_LANGUAGES] or ["en"]
+        path = os.path.join(out_dir, f"corpus_{'-'.join(languages)}_{chars}.{fmt}")
+        WRITERS[fmt](path, make_text(chars, file_languages, seed))
+        paths[fmt] = path
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description="生成合成的多语言语料文件")
+    parser.add_argument("--out", required=True, help="输出目录")
+    parser.add_argument("--size-kb", type=int, default=256, help="每个文件的文本量（千字符）")
+    parser.add_argument("--languages", default="mixed", help=f"逗号分隔: {','.join(LANGUAGES)} 或 mixed")
+    parser.add_argument("--formats", default=",".join(FORMATS))
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    languages = args.languages.split(",")
+    unknown = [lang for lang in languages if lang != "mixed" and lang not in LANGUAGES]
+    if unknown:
+        sys.exit(f"不支持的语言: {unknown}")
+    paths = generate_files(args.out, args.size_kb * 1000, languages, args.formats.split(","), args.seed)
+    print(json.dumps({fmt: {"path": path, "bytes": os.path.getsize(path)} for fmt, path in paths.items()},
+                     ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
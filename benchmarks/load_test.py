@@ -0,0 +1,405 @@
+"""端到端压测：启动应用（SQLite）和大模型桩服务，按混合负载施压，报告各接口的吞吐、延迟分位数和错误率
+
+用法:
+    python benchmarks/load_test.py --duration 60 --concurrency 32
+    python benchmarks/load_test.py --rate 40 --mix upload=1,query=6,stream=2,list=1,delete=1
+    python benchmarks/load_test.py --llm-latency 1.0 --llm-tokens-per-second 30 --app-env RETRIEVAL_MODE=hybrid
+    python benchmarks/load_test.py --url http://127.0.0.1:8000      # 对已经运行的服务施压（不启动应用和桩服务）
+
+--concurrency 为闭环模式：固定数量的虚拟用户，收到响应后立即发下一个请求；
+--rate 为开环模式：按固定速率发起请求，不等待响应，服务变慢时在途请求会积压，更接近真实流量。
+压测期间另有一个探针每100毫秒请求一次 /health，它的延迟反映事件循环是否被同步计算阻塞。
+"""
+import os
+import sys
+import json
+import time
+import socket
+import random
+import shutil
+import asyncio
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from corpus import iter_sentences
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+OPERATIONS = ("upload", "query", "stream", "batch", "list", "delete")
+DEFAULT_MIX = "upload=1,query=6,stream=2,list=1,delete=1"
+
+
+class Recorder:
+    """按接口收集每个请求的耗时和状态"""
+
+    def __init__(self):
+        self.samples = {}  # 接口 -> [(开始时间, 耗时, 状态)]
+        self.first_byte = {}  # 流式接口 -> [首字节耗时]
+        self.recording = False
+
+    def add(self, endpoint: str, started: float, status: str, first_byte: float = None):
+        if not self.recording:
+            return
+        elapsed = time.perf_counter() - started
+        self.samples.setdefault(endpoint, []).append((started, elapsed, status))
+        if first_byte is not None:
+            self.first_byte.setdefault(endpoint, []).append(first_byte)
+
+    def report(self, duration: float) -> dict:
+        endpoints = {}
+        for endpoint, samples in sorted(self.samples.items()):
+            latencies = np.array([elapsed for _, elapsed, _ in samples]) * 1000
+            statuses = {}
+            for _, _, status in samples:
+                statuses[status] = statuses.get(status, 0) + 1
+            errors = sum(count for status, count in statuses.items() if not status.startswith(("2", "3")))
+            endpoints[endpoint] = {
+                "requests": len(samples),
+                "throughput_rps": round(len(samples) / duration, 2),
+                "errors": errors,
+                "error_rate": round(errors / len(samples), 4),
+                "p50_ms": round(float(np.percentile(latencies, 50)), 1),
+                "p95_ms": round(float(np.percentile(latencies, 95)), 1),
+                "p99_ms": round(float(np.percentile(latencies, 99)), 1),
+                "max_ms": round(float(latencies.max()), 1),
+                "statuses": statuses,
+            }
+            if endpoint in self.first_byte:
+                first_byte = np.array(self.first_byte[endpoint]) * 1000
+                endpoints[endpoint]["first_byte_p50_ms"] = round(float(np.percentile(first_byte, 50)), 1)
+                endpoints[endpoint]["first_byte_p95_ms"] = round(float(np.percentile(first_byte, 95)), 1)
+                endpoints[endpoint]["first_byte_p99_ms"] = round(float(np.percentile(first_byte, 99)), 1)
+        workload = {name: stats for name, stats in endpoints.items() if name != "probe GET /health"}
+        total = sum(stats["requests"] for stats in workload.values())
+        errors = sum(stats["errors"] for stats in workload.values())
+        return {
+            "duration_seconds": round(duration, 2),
+            "requests": total,
+            "throughput_rps": round(total / duration, 2) if duration else 0.0,
+            "errors": errors,
+            "error_rate": round(errors / total, 4) if total else 0.0,
+            "endpoints": endpoints,
+        }
+
+
+class Workload:
+    """混合负载：按权重随机选择操作；删除只删除本次压测上传的文档，语料规模保持稳定"""
+
+    def __init__(self, client: httpx.AsyncClient, recorder: Recorder, args):
+        self.client = client
+        self.recorder = recorder
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.sentences = iter_sentences(args.languages, args.seed)
+        self.operations, self.weights = zip(*args.mix.items())
+        self.uploaded = []  # 本次压测上传、可以删除的文档id
+        self.upload_counter = 0
+        # 问题池越小，答案缓存和检索缓存的命中率越高
+        self.questions = [next(self.sentences)[:80] for _ in range(args.question_pool)]
+
+    def choose(self) -> str:
+        operation = self.rng.choices(self.operations, self.weights)[0]
+        if operation == "delete" and not self.uploaded:
+            return "query"
+        return operation
+
+    async def run(self, operation: str):
+        await getattr(self, f"_{operation}")()
+
+    async def _request(self, endpoint: str, method: str, url: str, **kwargs) -> httpx.Response:
+        started = time.perf_counter()
+        try:
+            response = await self.client.request(method, url, **kwargs)
+        except httpx.HTTPError as e:
+            self.recorder.add(endpoint, started, f"exception:{type(e).__name__}")
+            return None
+        self.recorder.add(endpoint, started, str(response.status_code))
+        return response
+
+    def document_text(self) -> str:
+        """每次上传的内容都不同（带序号），不会被内容去重挡掉"""
+        self.upload_counter += 1
+        parts, length = [f"load-test document {self.upload_counter} {time.time_ns()}"], 0
+        while length < self.args.upload_kb * 1000:
+            parts.append(next(self.sentences))
+            length += len(parts[-1])
+        return " ".join(parts)
+
+    async def upload(self, record: bool = True) -> int:
+        files = {"file": (f"load_{self.upload_counter}.txt", self.document_text().encode("utf-8"), "text/plain")}
+        if record:
+            response = await self._request("POST /api/documents/upload", "POST", "/api/documents/upload", files=files)
+        else:
+            response = await self.client.post("/api/documents/upload", files=files)
+        if response is not None and response.status_code in (200, 202):
+            return response.json()["id"]
+        return None
+
+    async def _upload(self):
+        document_id = await self.upload()
+        if document_id is not None:
+            self.uploaded.append(document_id)
+
+    async def _query(self):
+        body = {"question": self.rng.choice(self.questions), "top_k": self.args.top_k}
+        await self._request("POST /api/query/", "POST", "/api/query/", json=body)
+
+    async def _stream(self):
+        endpoint = "POST /api/query/stream"
+        body = {"question": self.rng.choice(self.questions), "top_k": self.args.top_k}
+        started = time.perf_counter()
+        first_byte = None
+        try:
+            async with self.client.stream("POST", "/api/query/stream", json=body) as response:
+                async for _ in response.aiter_bytes():
+                    if first_byte is None:
+                        first_byte = time.perf_counter() - started
+                status = str(response.status_code)
+        except httpx.HTTPError as e:
+            status = f"exception:{type(e).__name__}"
+        self.recorder.add(endpoint, started, status, first_byte)
+
+    async def _batch(self):
+        queries = [{"question": self.rng.choice(self.questions), "top_k": self.args.top_k}
+                   for _ in range(self.args.batch_size)]
+        started = time.perf_counter()
+        try:
+            async with self.client.stream("POST", "/api/query/batch", json={"queries": queries}) as response:
+                errors = 0
+                async for line in response.aiter_lines():
+                    errors += bool(line and "error" in json.loads(line))
+                status = str(response.status_code) if not errors else "item_error"
+        except httpx.HTTPError as e:
+            status = f"exception:{type(e).__name__}"
+        self.recorder.add("POST /api/query/batch", started, status)
+
+    async def _list(self):
+        await self._request("GET /api/documents/", "GET", "/api/documents/",
+                            params={"limit": 20, "offset": self.rng.randint(0, 50)})
+
+    async def _delete(self):
+        document_id = self.uploaded.pop(self.rng.randrange(len(self.uploaded)))
+        await self._request("DELETE /api/documents/{document_id}", "DELETE", f"/api/documents/{document_id}")
+
+
+async def probe(client: httpx.AsyncClient, recorder: Recorder, deadline: float, interval: float = 0.1):
+    """定时请求 /health：接口本身不做任何事，延迟升高说明事件循环被阻塞"""
+    while time.perf_counter() < deadline:
+        started = time.perf_counter()
+        try:
+            response = await client.get("/health")
+            status = str(response.status_code)
+        except httpx.HTTPError as e:
+            status = f"exception:{type(e).__name__}"
+        recorder.add("probe GET /health", started, status)
+        await asyncio.sleep(max(0.0, interval - (time.perf_counter() - started)))
+
+
+async def closed_loop(workload: Workload, deadline: float, concurrency: int):
+    async def user():
+        while time.perf_counter() < deadline:
+            await workload.run(workload.choose())
+
+    await asyncio.gather(*(user() for _ in range(concurrency)))
+
+
+async def open_loop(workload: Workload, deadline: float, rate: float, max_in_flight: int) -> int:
+    """按固定间隔发起请求，返回因在途请求达到上限而放弃的次数"""
+    tasks, skipped = set(), 0
+    next_at = time.perf_counter()
+    while next_at < deadline:
+        await asyncio.sleep(max(0.0, next_at - time.perf_counter()))
+        next_at += 1 / rate
+        if len(tasks) >= max_in_flight:
+            skipped += 1
+            continue
+        task = asyncio.create_task(workload.run(workload.choose()))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    if tasks:
+        await asyncio.gather(*tasks)
+    return skipped
+
+
+async def drive(base_url: str, args) -> dict:
+    recorder = Recorder()
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+    async with httpx.AsyncClient(base_url=base_url, timeout=args.timeout, limits=limits) as client:
+        workload = Workload(client, recorder, args)
+        for _ in range(args.seed_documents):
+            await workload.upload(record=False)
+
+        started = time.perf_counter()
+        warmup_end = started + args.warmup
+        deadline = warmup_end + args.duration
+
+        async def start_recording():
+            await asyncio.sleep(args.warmup)
+            recorder.recording = True
+
+        runner = (open_loop(workload, deadline, args.rate, args.max_in_flight) if args.rate
+                  else closed_loop(workload, deadline, args.concurrency))
+        results = await asyncio.gather(runner, probe(client, recorder, deadline), start_recording())
+        # 开环模式下收尾的在途请求也计入耗时
+        report = recorder.report(time.perf_counter() - warmup_end)
+        if args.rate:
+            report["skipped_in_flight_limit"] = results[0]
+        try:
+            report["server_stats"] = (await client.get("/api/query/stats")).json()
+        except (httpx.HTTPError, ValueError):
+            pass
+    return report
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_process(command, env, log_path: str, cwd: str) -> subprocess.Popen:
+    log = open(log_path, "wb")
+    return subprocess.Popen(command, cwd=cwd, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+
+def wait_ready(url: str, process: subprocess.Popen, log_path: str, timeout: float = 120):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            with open(log_path, encoding="utf-8", errors="replace") as f:
+                sys.exit(f"进程启动失败（退出码 {process.returncode}）:\n{f.read()[-3000:]}")
+        try:
+            if httpx.get(url, timeout=1).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    sys.exit(f"等待 {url} 就绪超时")
+
+
+def start_stack(args, workdir: str):
+    """启动桩服务和应用，返回 (应用地址, 进程列表)"""
+    processes = []
+    stub_port, app_port = free_port(), free_port()
+    stub_env = {
+        **os.environ,
+        "STUB_LLM_LATENCY": str(args.llm_latency),
+        "STUB_LLM_TOKENS_PER_SECOND": str(args.llm_tokens_per_second),
+        "STUB_LLM_OUTPUT_TOKENS": str(args.llm_output_tokens),
+        "STUB_LLM_ERROR_RATE": str(args.llm_error_rate),
+    }
+    stub_log = os.path.join(workdir, "stub_llm.log")
+    processes.append(start_process([sys.executable, "-m", "uvicorn", "stub_llm:app", "--host", "127.0.0.1",
+                                    "--port", str(stub_port), "--log-level", "warning"],
+                                   stub_env, stub_log, BENCHMARKS_DIR))
+    wait_ready(f"http://127.0.0.1:{stub_port}/v1/models", processes[-1], stub_log)
+
+    app_env = {
+        **os.environ,
+        "DATABASE_URL": f"sqlite://{os.path.join(workdir, 'loadtest.sqlite3')}",
+        "OPENAI_API_KEY": "stub",
+        "OPENAI_API_BASE_URL": f"http://127.0.0.1:{stub_port}/v1",
+        "UPLOAD_DIR": os.path.join(workdir, "uploads"),
+        "VECTOR_INDEX_DIR": os.path.join(workdir, "vector_index"),
+        **dict(item.split("=", 1) for item in args.app_env),
+    }
+    app_log = os.path.join(workdir, "app.log")
+    processes.append(start_process([sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1",
+                                    "--port", str(app_port), "--workers", str(args.workers), "--log-level", "warning"],
+                                   app_env, app_log, ROOT))
+    wait_ready(f"http://127.0.0.1:{app_port}/health", processes[-1], app_log)
+    return f"http://127.0.0.1:{app_port}", processes
+
+
+def stop_processes(processes):
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def print_table(report: dict):
+    print(f"{'endpoint':<36} {'req':>7} {'rps':>8} {'err%':>6} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8}")
+    for endpoint, stats in report["endpoints"].items():
+        print(f"{endpoint:<36} {stats['requests']:>7} {stats['throughput_rps']:>8} {stats['error_rate'] * 100:>6.2f} "
+              f"{stats['p50_ms']:>8} {stats['p95_ms']:>8} {stats['p99_ms']:>8} {stats['max_ms']:>8}")
+    print(f"合计 {report['requests']} 个请求, {report['throughput_rps']} req/s, 错误率 {report['error_rate'] * 100:.2f}%"
+          f"（延迟单位: ms）")
+
+
+def parse_mix(text: str) -> dict:
+    mix = {}
+    for item in text.split(","):
+        name, _, weight = item.partition("=")
+        if name not in OPERATIONS:
+            raise argparse.ArgumentTypeError(f"未知的操作: {name}（可选 {', '.join(OPERATIONS)}）")
+        if float(weight or 1) > 0:
+            mix[name] = float(weight or 1)
+    if not mix:
+        raise argparse.ArgumentTypeError("负载配比为空")
+    return mix
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="端到端压测（SQLite + 大模型桩服务）")
+    parser.add_argument("--url", default=None, help="对已运行的服务施压，不启动应用和桩服务")
+    parser.add_argument("--duration", type=float, default=30, help="计入结果的压测秒数")
+    parser.add_argument("--warmup", type=float, default=5, help="开始计数前的预热秒数")
+    parser.add_argument("--concurrency", type=int, default=16, help="闭环模式的虚拟用户数")
+    parser.add_argument("--rate", type=float, default=None, help="开环模式的每秒请求数（指定后忽略 --concurrency）")
+    parser.add_argument("--max-in-flight", type=int, default=1000, help="开环模式的在途请求上限")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix(DEFAULT_MIX),
+                        help=f"操作及权重，可选 {', '.join(OPERATIONS)}（默认 {DEFAULT_MIX}）")
+    parser.add_argument("--seed-documents", type=int, default=20, help="压测前预先上传的文档数")
+    parser.add_argument("--upload-kb", type=int, default=20, help="每个上传文档的文本量（千字符）")
+    parser.add_argument("--question-pool", type=int, default=500, help="问题池大小，越小缓存命中率越高")
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--batch-size", type=int, default=20, help="batch 操作每次的问题数")
+    parser.add_argument("--languages", default="mixed", type=lambda text: text.split(","))
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--timeout", type=float, default=120, help="单个请求的超时秒数")
+    parser.add_argument("--workers", type=int, default=1, help="应用的uvicorn进程数")
+    parser.add_argument("--app-env", action="append", default=[], metavar="KEY=VALUE", help="传给应用的环境变量，可重复")
+    parser.add_argument("--llm-latency", type=float, default=0.3, help="桩服务首个token前的等待秒数")
+    parser.add_argument("--llm-tokens-per-second", type=float, default=50)
+    parser.add_argument("--llm-output-tokens", type=int, default=60)
+    parser.add_argument("--llm-error-rate", type=float, default=0.0)
+    parser.add_argument("--keep", action="store_true", help="保留临时目录（数据库、上传文件和日志）")
+    parser.add_argument("--output", default=None, help="结果JSON的保存路径")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    workdir = tempfile.mkdtemp(prefix="kbserve_load_")
+    processes = []
+    try:
+        base_url = args.url
+        if base_url is None:
+            base_url, processes = start_stack(args, workdir)
+        report = asyncio.run(drive(base_url, args))
+        report["config"] = {key: value for key, value in vars(args).items() if key not in ("keep", "output")}
+    finally:
+        stop_processes(processes)
+        if args.keep:
+            print(f"临时目录: {workdir}", file=sys.stderr)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print_table(report)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"结果已保存: {args.output}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,473 @@
+"""服务层基准测试：分段吞吐、嵌入吞吐、不同语料规模下的检索延迟、各格式的解析耗时
+
+用法:
+    python benchmarks/run_benchmarks.py                         # 全部套件，结果写入 benchmarks/results/
+    python benchmarks/run_benchmarks.py --suites search --search-sizes 10000,100000,1000000
+    python benchmarks/run_benchmarks.py --compare old.json new.json
+
+语料和向量都由固定种子生成，结果JSON带有提交号和运行环境，不同提交之间可以用 --compare 对比。
+检索套件直接在索引上测量（不经过数据库和HTTP），向量为带主题簇结构的合成向量，
+维度默认384（与 all-MiniLM-L6-v2 相同）；100万行×384维约占1.5GB内存。
+simple_search 套件则用 SimpleVectorDB 的哈希向量（4096维）经完整检索路径测量，包括回表。
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import datetime
+import asyncio
+import tempfile
+import subprocess
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from corpus import FORMATS, LANGUAGES, generate_files, make_chunk_texts, make_text
+from services.text_processor import TextProcessor
+from services.simple_vector_db import SimpleVectorDB
+from services.vector_index import IVFIndex, VectorIndex
+from services.quantized_index import QuantizedIndex
+from services.keyword_index import BM25Index, term_frequencies
+from services.document_parser import DocumentParser
+from services.query_cache import QueryCache
+
+SUITES = ("chunking", "embedding", "search", "simple_search", "parse")
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+
+def percentiles(seconds) -> dict:
+    ms = np.asarray(seconds) * 1000
+    return {
+        "count": len(ms),
+        "mean_ms": round(float(ms.mean()), 4),
+        "p50_ms": round(float(np.percentile(ms, 50)), 4),
+        "p95_ms": round(float(np.percentile(ms, 95)), 4),
+        "p99_ms": round(float(np.percentile(ms, 99)), 4),
+    }
+
+
+def best_of(fn, repeat: int):
+    """重复执行取最快一次，返回 (秒数, 最后一次的结果)"""
+    best, result = float("inf"), None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - started)
+    return best, result
+
+
+def per_call(fn, items) -> list:
+    seconds = []
+    for item in items:
+        started = time.perf_counter()
+        fn(item)
+        seconds.append(time.perf_counter() - started)
+    return seconds
+
+
+# ---- 分段 ----
+
+def bench_chunking(args) -> dict:
+    processor = TextProcessor()
+    results = {}
+    for language in args.languages:
+        text = make_text(args.chunk_chars, [language], args.seed)
+        seconds, chunks = best_of(lambda: processor.chunk_text(text, 0), args.repeat)
+        tokens = sum(chunk["token_count"] for chunk in chunks)
+        results[language] = {
+            "chars": len(text),
+            "tokens": tokens,
+            "chunks": len(chunks),
+            "seconds": round(seconds, 4),
+            "chars_per_second": round(len(text) / seconds),
+            "tokens_per_second": round(tokens / seconds),
+        }
+    return results
+
+
+# ---- 嵌入 ----
+
+def bench_embedding(args) -> dict:
+    texts = make_chunk_texts(args.embed_chunks, args.languages, args.seed)
+    chars = sum(len(text) for text in texts)
+    backends = {"hashing": SimpleVectorDB()._embed_batch}
+    if args.transformer:
+        try:
+            from services.vector_db import VectorDB
+            backends["transformer"] = VectorDB().embed_batch
+        except Exception as e:  # 没有安装torch或无法下载模型
+            backends["transformer"] = e
+
+    results = {}
+    for name, embed in backends.items():
+        if isinstance(embed, Exception):
+            results[name] = {"skipped": str(embed)}
+            continue
+        batches = [texts[i:i + args.embed_batch_size] for i in range(0, len(texts), args.embed_batch_size)]
+        embed(batches[0])  # 预热（模型加载、词表缓存）
+        seconds, _ = best_of(lambda: [embed(batch) for batch in batches], args.repeat)
+        results[name] = {
+            "chunks": len(texts),
+            "batch_size": args.embed_batch_size,
+            "seconds": round(seconds, 4),
+            "chunks_per_second": round(len(texts) / seconds, 1),
+            "chars_per_second": round(chars / seconds),
+        }
+    return results
+
+
+# ---- 检索 ----
+
+def synthetic_embeddings(rows: int, dim: int, seed: int, topics: int = 256, block: int = 65536) -> np.ndarray:
+    """带主题簇结构的归一化向量（均匀随机向量的最近邻没有意义，IVF的召回也无从比较）"""
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((topics, dim)).astype(np.float32)
+    matrix = np.empty((rows, dim), dtype=np.float32)
+    for start in range(0, rows, block):
+        end = min(start + block, rows)
+        part = centers[rng.integers(0, topics, end - start)]
+        part += 0.8 * rng.standard_normal(part.shape, dtype=np.float32)
+        part /= np.linalg.norm(part, axis=1, keepdims=True)
+        matrix[start:end] = part
+    return matrix
+
+
+def fill_index(index: VectorIndex, matrix: np.ndarray, chunks_per_document: int):
+    """与 VectorIndex.load 相同的方式一次性装入整个矩阵，避免逐文档拼接的重复拷贝"""
+    rows = len(matrix)
+    index.matrix = matrix
+    index.chunk_ids = np.arange(1, rows + 1, dtype=np.int64)
+    index.document_ids = np.arange(rows, dtype=np.int64) // chunks_per_document + 1
+    index.nonzero_counts = np.count_nonzero(matrix, axis=0).astype(np.int64)
+    now = time.time()
+    index.documents = {
+        document_id: ("text/markdown" if document_id % 2 else "text/plain", now - document_id)
+        for document_id in range(1, int(index.document_ids[-1]) + 1)
+    }
+    index._document_table = None
+    index.loaded = True
+    index.generation += 1
+    if isinstance(index, IVFIndex):
+        index.centroids, index.trained_size = None, 0
+        index._maybe_train()
+    if isinstance(index, QuantizedIndex):
+        index._store_matrix(matrix)
+        index.codes, index.trained_size = None, 0
+        index._maintain()
+
+
+def recall(hits, reference) -> float:
+    expected = {chunk_id for chunk_id, _ in reference}
+    return len(expected & {chunk_id for chunk_id, _ in hits}) / len(expected) if expected else 1.0
+
+
+def bench_search(args) -> dict:
+    results = {}
+    rng = np.random.default_rng(args.seed + 1)
+    for size in args.search_sizes:
+        matrix = synthetic_embeddings(size, args.dim, args.seed)
+        # 查询为语料中随机行加噪声，模拟与某些片段相近的问题
+        queries = matrix[rng.integers(0, size, args.queries)] + 0.3 * rng.standard_normal((args.queries, args.dim)).astype(np.float32)
+        result = {"rows": size, "dim": args.dim, "matrix_mb": round(matrix.nbytes / 2 ** 20, 1)}
+
+        exact = VectorIndex()
+        fill_index(exact, matrix, args.chunks_per_document)
+        reference = [exact.search(query, top_k=args.top_k) for query in queries]
+        result["exact"] = percentiles(per_call(lambda q: exact.search(q, top_k=args.top_k), queries))
+        blocks = [queries[i:i + args.batch_queries] for i in range(0, len(queries), args.batch_queries)]
+        seconds, _ = best_of(lambda: [exact.search_batch(block, top_k=args.top_k) for block in blocks], 1)
+        result["exact_batch"] = {"batch_size": args.batch_queries, "queries_per_second": round(len(queries) / seconds, 1)}
+
+        documents = len(exact.documents)
+        scoped = {"document_ids": random.Random(args.seed).sample(range(1, documents + 1), min(10, documents))}
+        result["filtered_documents"] = percentiles(per_call(lambda q: exact.search(q, top_k=args.top_k, filters=scoped), queries))
+        result["filtered_file_type"] = percentiles(
+            per_call(lambda q: exact.search(q, top_k=args.top_k, filters={"file_type": "text/markdown"}), queries))
+
+        if size <= args.ivf_max_size:
+            ivf = IVFIndex(nprobe=args.nprobe, min_train_size=1)
+            started = time.perf_counter()
+            fill_index(ivf, matrix, args.chunks_per_document)
+            train_seconds = time.perf_counter() - started
+            hits = [ivf.search(query, top_k=args.top_k) for query in queries]
+            result["ivf"] = {
+                **percentiles(per_call(lambda q: ivf.search(q, top_k=args.top_k), queries)),
+                "nlist": len(ivf.centroids),
+                "nprobe": ivf.nprobe,
+                "train_seconds": round(train_seconds, 3),
+                f"recall_at_{args.top_k}": round(float(np.mean([recall(h, r) for h, r in zip(hits, reference)])), 4),
+            }
+            del ivf
+        else:
+            result["ivf"] = {"skipped": f"rows > --ivf-max-size ({args.ivf_max_size})"}
+
+        for method in ("int8", "pq"):
+            if size <= args.quantized_max_size:
+                result[method] = bench_quantized(args, method, matrix, queries, reference)
+            else:
+                result[method] = {"skipped": f"rows > --quantized-max-size ({args.quantized_max_size})"}
+
+        if size <= args.keyword_max_size:
+            result["bm25"] = bench_keyword(args, size)
+        else:
+            result["bm25"] = {"skipped": f"rows > --keyword-max-size ({args.keyword_max_size})"}
+        results[str(size)] = result
+        del exact, matrix
+    return results
+
+
+def bench_quantized(args, method: str, matrix: np.ndarray, queries: np.ndarray, reference: list) -> dict:
+    """量化索引的延迟、召回率（与精确检索的前k个相比）和常驻内存的压缩比"""
+    index = QuantizedIndex(method, rerank_factor=args.rerank_factor, min_train_size=1, directory=args.spill_dir)
+    started = time.perf_counter()
+    fill_index(index, matrix, args.chunks_per_document)
+    train_seconds = time.perf_counter() - started
+    hits = [index.search(query, top_k=args.top_k) for query in queries]
+    # 只用压缩码打分（不精排）时的召回率，反映量化本身的误差
+    approximate = [index._top_k(index.codec.scores(index.codes, index._prepare_query(query)), None, args.top_k)
+                   for query in queries]
+    result = {
+        **percentiles(per_call(lambda q: index.search(q, top_k=args.top_k), queries)),
+        "rerank": args.top_k * index.rerank_factor,
+        "train_seconds": round(train_seconds, 3),
+        f"recall_at_{args.top_k}": round(float(np.mean([recall(h, r) for h, r in zip(hits, reference)])), 4),
+        f"recall_at_{args.top_k}_without_rerank": round(float(np.mean([recall(h, r) for h, r in zip(approximate, reference)])), 4),
+        **index.memory_stats(),
+    }
+    index._replace_store(None)
+    return result
+
+
+def bench_keyword(args, size: int) -> dict:
+    texts = make_chunk_texts(size, args.languages, args.seed)
+    index = BM25Index()
+    started = time.perf_counter()
+    for start in range(0, size, args.chunks_per_document):
+        batch = texts[start:start + args.chunks_per_document]
+        index.add_document(start // args.chunks_per_document + 1, range(start + 1, start + len(batch) + 1),
+                           [term_frequencies(text) for text in batch])
+    build_seconds = time.perf_counter() - started
+    # 问题取自语料中的句子片段
+    rng = random.Random(args.seed)
+    questions = [" ".join(rng.choice(texts).split(" ")[:6]) for _ in range(args.queries)]
+    return {
+        **percentiles(per_call(lambda q: index.search(q, top_k=args.top_k), questions)),
+        "build_seconds": round(build_seconds, 3),
+        **index.stats(),
+    }
+
+
+def bench_simple_search(args) -> dict:
+    """SimpleVectorDB.search 端到端：问题向量化、IDF加权、在4096维哈希向量上检索、回表读取片段
+
+    语料为 make_chunk_texts 生成的片段，片段存入内存SQLite供回表，关闭结果缓存使每次都完整检索。
+    """
+    from tortoise import Tortoise
+    from models.document import Document
+    from models.chunk import Chunk
+
+    async def run() -> dict:
+        results = {}
+        for size in args.search_sizes:
+            if size > args.simple_max_size:
+                results[str(size)] = {"skipped": f"rows > --simple-max-size ({args.simple_max_size})"}
+                continue
+            await Tortoise.init(db_url="sqlite://:memory:",
+                                modules={"models": ["models.document", "models.chunk", "models.embedding_cache"]})
+            await Tortoise.generate_schemas()
+            try:
+                results[str(size)] = await bench_simple_size(args, size, Document, Chunk)
+            finally:
+                await Tortoise.close_connections()
+        return results
+
+    return asyncio.run(run())
+
+
+async def bench_simple_size(args, size: int, Document, Chunk) -> dict:
+    texts = make_chunk_texts(size, args.languages, args.seed)
+    db = SimpleVectorDB(query_cache=QueryCache(max_entries=0))
+    started = time.perf_counter()
+    matrix = np.vstack([db._embed_batch(texts[i:i + args.embed_batch_size])
+                        for i in range(0, size, args.embed_batch_size)])
+    embed_seconds = time.perf_counter() - started
+    fill_index(db.index, matrix, args.chunks_per_document)
+
+    documents = int(db.index.document_ids[-1])
+    await Document.bulk_create([
+        Document(id=document_id, filename=f"doc-{document_id}.md", file_type=db.index.documents[document_id][0], size=0)
+        for document_id in range(1, documents + 1)
+    ])
+    await Chunk.bulk_create([
+        Chunk(id=i + 1, document_id=int(db.index.document_ids[i]), text=text, start_pos=0, end_pos=len(text),
+              token_count=len(text.split()))
+        for i, text in enumerate(texts)
+    ], batch_size=5000)
+
+    # 问题取自语料中的句子片段
+    rng = random.Random(args.seed)
+    questions = [" ".join(rng.choice(texts).split(" ")[:6]) for _ in range(args.queries)]
+    await db.search(questions[0], top_k=args.top_k)  # 预热（sklearn导入、IDF计算）
+    seconds = []
+    for question in questions:
+        started = time.perf_counter()
+        await db.search(question, top_k=args.top_k)
+        seconds.append(time.perf_counter() - started)
+    return {
+        **percentiles(seconds),
+        "rows": size,
+        "dim": db.dim,
+        "matrix_mb": round(matrix.nbytes / 2 ** 20, 1),
+        "embed_seconds": round(embed_seconds, 3),
+    }
+
+
+# ---- 解析 ----
+
+def bench_parse(args) -> dict:
+    parser = DocumentParser(pdf_workers=args.pdf_workers)
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = generate_files(args.files_dir or tmp, args.parse_chars, args.languages, args.formats, args.seed)
+        results = {}
+        for fmt, path in paths.items():
+            pages = []
+            seconds, text = best_of(lambda: "\n".join(parser.iter_file(path, pages)), args.repeat)
+            size = os.path.getsize(path)
+            results[fmt] = {
+                "bytes": size,
+                "chars": len(text),
+                "seconds": round(seconds, 4),
+                "mb_per_second": round(size / 2 ** 20 / seconds, 2),
+                "chars_per_second": round(len(text) / seconds),
+            }
+            if fmt == "pdf":
+                results[fmt]["pages"] = len(pages) // args.repeat
+    return results
+
+
+# ---- 结果 ----
+
+def git_revision() -> dict:
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=root, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=root,
+                                    capture_output=True, text=True).stdout.strip())
+        return {"commit": commit, "dirty": dirty}
+    except (OSError, subprocess.CalledProcessError):
+        return {"commit": None, "dirty": None}
+
+
+def environment() -> dict:
+    return {
+        **git_revision(),
+        "timestamp": datetime.datetime.now().astimezone().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def flatten(results: dict, prefix: str = "") -> dict:
+    flat = {}
+    for key, value in results.items():
+        name = f"{prefix}.{key}" if prefix else str(key)
+        if isinstance(value, dict):
+            flat.update(flatten(value, name))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = value
+    return flat
+
+
+def compare(old_path: str, new_path: str):
+    """逐项对比两次运行的数值结果（耗时类指标变小、吞吐类指标变大为改善）"""
+    with open(old_path, encoding="utf-8") as f:
+        old = json.load(f)
+    with open(new_path, encoding="utf-8") as f:
+        new = json.load(f)
+    print(f"{old['environment'].get('commit')} -> {new['environment'].get('commit')}")
+    old_flat, new_flat = flatten(old["suites"]), flatten(new["suites"])
+    width = max((len(name) for name in new_flat), default=0)
+    for name, value in new_flat.items():
+        if name not in old_flat:
+            continue
+        before = old_flat[name]
+        change = f"{(value - before) / before * 100:+.1f}%" if before else "n/a"
+        print(f"{name:<{width}}  {before:>14}  {value:>14}  {change:>8}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="服务层基准测试，结果保存为JSON")
+    parser.add_argument("--suites", default=",".join(SUITES), help=f"逗号分隔: {','.join(SUITES)}")
+    parser.add_argument("--languages", default="en,zh,mixed", help=f"逗号分隔: {','.join(LANGUAGES)} 或 mixed")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--repeat", type=int, default=3, help="吞吐类测试重复次数（取最快一次）")
+    parser.add_argument("--chunk-chars", type=int, default=500000, help="分段测试的文本字符数")
+    parser.add_argument("--embed-chunks", type=int, default=5000)
+    parser.add_argument("--embed-batch-size", type=int, default=256)
+    parser.add_argument("--transformer", action="store_true", help="同时测试 transformer 嵌入模型（需要torch和模型文件）")
+    parser.add_argument("--search-sizes", default="10000,100000,1000000", help="检索测试的语料行数")
+    parser.add_argument("--dim", type=int, default=384, help="合成向量的维度")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--batch-queries", type=int, default=64, help="批量检索每批的问题数")
+    parser.add_argument("--chunks-per-document", type=int, default=50)
+    parser.add_argument("--nprobe", type=int, default=8)
+    parser.add_argument("--ivf-max-size", type=int, default=100000, help="超过该行数不测IVF（训练耗时较长）")
+    parser.add_argument("--quantized-max-size", type=int, default=100000, help="超过该行数不测int8/PQ量化（训练和编码耗时较长）")
+    parser.add_argument("--rerank-factor", type=int, default=0, help="量化索引精排的候选数为 top_k 的倍数（0为int8取10、PQ取30）")
+    parser.add_argument("--spill-dir", default=None, help="量化索引全精度向量文件的目录（默认系统临时目录）")
+    parser.add_argument("--keyword-max-size", type=int, default=100000, help="超过该行数不测BM25（生成和分词耗时较长）")
+    parser.add_argument("--simple-max-size", type=int, default=100000,
+                        help="超过该行数不测 SimpleVectorDB 端到端检索（4096维稠密矩阵，10万行约1.6GB）")
+    parser.add_argument("--parse-chars", type=int, default=1000000, help="每个测试文件的文本字符数")
+    parser.add_argument("--formats", default=",".join(FORMATS))
+    parser.add_argument("--files-dir", default=None, help="保留生成的测试文件的目录（默认用临时目录）")
+    parser.add_argument("--pdf-workers", type=int, default=1)
+    parser.add_argument("--output", default=None, help="结果文件路径（默认 benchmarks/results/<时间>-<提交>.json）")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="对比两个结果文件后退出")
+    args = parser.parse_args()
+    args.suites = [suite for suite in args.suites.split(",") if suite]
+    unknown = [suite for suite in args.suites if suite not in SUITES]
+    if unknown:
+        parser.error(f"未知的套件: {unknown}")
+    args.languages = args.languages.split(",")
+    args.search_sizes = [int(size) for size in args.search_sizes.split(",") if size]
+    args.formats = args.formats.split(",")
+    return args
+
+
+def main():
+    args = parse_args()
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    runners = {"chunking": bench_chunking, "embedding": bench_embedding, "search": bench_search,
+               "simple_search": bench_simple_search, "parse": bench_parse}
+    report = {"environment": environment(), "config": {k: v for k, v in vars(args).items() if k != "compare"}, "suites": {}}
+    for suite in args.suites:
+        started = time.perf_counter()
+        report["suites"][suite] = runners[suite](args)
+        print(f"{suite}: {time.perf_counter() - started:.1f}s", file=sys.stderr)
+
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+        output = os.path.join(RESULTS_DIR, f"{stamp}-{report['environment']['commit'] or 'nogit'}.json")
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(json.dumps(report["suites"], ensure_ascii=False, indent=2))
+    print(f"结果已保存: {output}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
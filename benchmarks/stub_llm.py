@@ -0,0 +1,109 @@
+"""兼容OpenAI接口的本地桩服务，压测时代替真实的大模型
+
+只实现 /v1/chat/completions（普通和流式）和 /v1/models，按配置的延迟和生成速度返回固定格式的答案：
+首个token前等待 STUB_LLM_LATENCY 秒，之后每秒生成 STUB_LLM_TOKENS_PER_SECOND 个token，
+共 STUB_LLM_OUTPUT_TOKENS 个；STUB_LLM_ERROR_RATE 为返回500的概率。
+
+用法:
+    STUB_LLM_LATENCY=0.5 uvicorn stub_llm:app --app-dir benchmarks --port 18081
+    python benchmarks/stub_llm.py --port 18081 --latency 0.5 --tokens-per-second 40
+"""
+import os
+import json
+import time
+import random
+import asyncio
+import argparse
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+LATENCY = float(os.getenv("STUB_LLM_LATENCY", 0.3))
+TOKENS_PER_SECOND = float(os.getenv("STUB_LLM_TOKENS_PER_SECOND", 50))
+OUTPUT_TOKENS = int(os.getenv("STUB_LLM_OUTPUT_TOKENS", 60))
+ERROR_RATE = float(os.getenv("STUB_LLM_ERROR_RATE", 0))
+
+app = FastAPI(title="stub llm")
+counters = {"requests": 0, "streams": 0, "errors": 0, "active": 0}
+
+
+def _tokens(prompt: str):
+    """答案由提示词中的词和序号拼成，不同问题的答案不同"""
+    words = prompt.split()[-20:] or ["answer"]
+    return [f"{words[i % len(words)]} " for i in range(OUTPUT_TOKENS)]
+
+
+def _chunk(model: str, content: str = None, finish_reason: str = None) -> str:
+    delta = {"content": content} if content is not None else {}
+    payload = {"id": "chatcmpl-stub", "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+               "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+    return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    model = body.get("model", "stub")
+    prompt = " ".join(str(message.get("content", "")) for message in body.get("messages", []))
+    counters["requests"] += 1
+    if random.random() < ERROR_RATE:
+        counters["errors"] += 1
+        return JSONResponse(status_code=500, content={"error": {"message": "stub error", "type": "server_error"}})
+    tokens = _tokens(prompt)
+    interval = 1 / TOKENS_PER_SECOND if TOKENS_PER_SECOND > 0 else 0
+
+    if body.get("stream"):
+        counters["streams"] += 1
+
+        async def events():
+            counters["active"] += 1
+            try:
+                await asyncio.sleep(LATENCY)
+                for token in tokens:
+                    yield _chunk(model, token)
+                    await asyncio.sleep(interval)
+                yield _chunk(model, finish_reason="stop")
+                yield "data: [DONE]\n\n"
+            finally:
+                counters["active"] -= 1
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    counters["active"] += 1
+    try:
+        await asyncio.sleep(LATENCY + interval * len(tokens))
+    finally:
+        counters["active"] -= 1
+    prompt_tokens = len(prompt) // 2
+    return {
+        "id": "chatcmpl-stub", "object": "chat.completion", "created": int(time.time()), "model": model,
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(tokens)}, "finish_reason": "stop"}],
+        "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": len(tokens),
+                  "total_tokens": prompt_tokens + len(tokens)},
+    }
+
+
+@app.get("/v1/models")
+async def models():
+    return {"object": "list", "data": [{"id": "stub", "object": "model", "owned_by": "stub"}]}
+
+
+@app.get("/stats")
+async def stats():
+    return {**counters, "latency": LATENCY, "tokens_per_second": TOKENS_PER_SECOND, "output_tokens": OUTPUT_TOKENS,
+            "error_rate": ERROR_RATE}
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="兼容OpenAI接口的大模型桩服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=18081)
+    parser.add_argument("--latency", type=float, default=LATENCY, help="首个token前的等待秒数")
+    parser.add_argument("--tokens-per-second", type=float, default=TOKENS_PER_SECOND)
+    parser.add_argument("--output-tokens", type=int, default=OUTPUT_TOKENS)
+    parser.add_argument("--error-rate", type=float, default=ERROR_RATE)
+    args = parser.parse_args()
+    LATENCY, TOKENS_PER_SECOND = args.latency, args.tokens_per_second
+    OUTPUT_TOKENS, ERROR_RATE = args.output_tokens, args.error_rate
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
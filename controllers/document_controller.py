@@ -1,84 +1,123 @@
-from fastapi import APIRouter, File, UploadFile, HTTPException
-from models.document import Document
-from models.chunk import Chunk
-from schemas.document import DocumentResponse, DocumentListResponse
-from services.document_parser import DocumentParser
-from services.text_processor import TextProcessor
-from services.simple_vector_db import SimpleVectorDB
+import os
+import time
+import asyncio
+from typing import List
+from fastapi import APIRouter, File, UploadFile, HTTPException, Response
 from tortoise.transactions import in_transaction
+from models.document import Document, DocumentStatus
+from models.chunk import Chunk
+from schemas.document import DocumentResponse, DocumentListResponse, IngestJobResponse, BulkIngestResponse
+from services.ingestion import (BULK_MAX_FILES, BULK_MAX_TOTAL_BYTES, WORKER_ID, BulkTooLargeError, QueueFullError,
+                                TooManyFilesError, iter_document_chunks, spool_bulk_upload, spool_path, spool_upload,
+                                store_chunks)
+from services.shared import vector_db, ingest_queue, embedding_cache, answer_cache
+from services.metrics import observe_parse_timings
 
 router = APIRouter()
 
-# 初始化服务
-document_parser = DocumentParser()
-text_processor = TextProcessor()
-vector_db = SimpleVectorDB()  # 使用简化版向量数据库
+# INGEST_MODE=async 时上传后立即返回，由后台任务队列完成解析和入库
+INGEST_MODE = os.getenv("INGEST_MODE", "sync").lower()
+
+# 本进程内的上传去重计数
+upload_stats = {"uploads": 0, "duplicates": 0}
 
 @router.post("/upload", response_model=DocumentResponse)
-async def upload_document(file: UploadFile = File(...)):
-    """上传并处理文档"""
-    # 读取文件内容以获取大小
-    file_contents = await file.read()
-    file_size = len(file_contents)
-    
-    # 重置文件指针
-    await file.seek(0)
+async def upload_document(response: Response, file: UploadFile = File(...), async_mode: bool = None):
+    """上传并处理文档；异步模式下返回202，文档id即任务id"""
+    if async_mode is None:
+        async_mode = INGEST_MODE == "async"
+    if async_mode and ingest_queue.full:
+        raise HTTPException(status_code=503, detail="入库队列已满，请稍后重试")
+
+    # 上传内容只落盘一次，同时得到文件大小和内容哈希
+    temp_path, file_size, content_hash = await asyncio.to_thread(spool_upload, file.file, file.filename)
+    upload_stats["uploads"] += 1
+
+    # 内容完全相同且未失败的文档直接返回已有记录（处理中的返回对应任务）
+    existing = await Document.filter(content_hash=content_hash).exclude(status=DocumentStatus.FAILED).first()
+    if existing:
+        os.unlink(temp_path)
+        upload_stats["duplicates"] += 1
+        response.headers["X-Duplicate-Of"] = str(existing.id)
+        return existing
     
     # 保存文档信息
-    async with in_transaction():
-        doc = await Document.create(
-            filename=file.filename,
-            file_type=file.content_type or "application/octet-stream",
-            size=file_size
-        )
-        
+    doc = await Document.create(
+        filename=file.filename,
+        file_type=file.content_type or "application/octet-stream",
+        size=file_size,
+        content_hash=content_hash,
+        status=DocumentStatus.QUEUED if async_mode else DocumentStatus.PARSING,
+        owner=WORKER_ID
+    )
+
+    if async_mode:
+        path = spool_path(doc.id, file.filename)
+        os.replace(temp_path, path)
         try:
-            # 解析文档内容
-            text = document_parser.parse_uploaded_file(file)
-            # print(f"解析后的文本长度: {(text)}")
-            cleaned_text = text_processor.clean_text(text)
-            print(f"清理后的文本: {cleaned_text}")
-            
-            if not cleaned_text.strip():
-                await doc.delete()
-                raise HTTPException(status_code=400, detail="文档内容为空或无法解析")
-            
-            # 文本分段
-            chunks = text_processor.chunk_text(cleaned_text, doc.id)
-            print(f"分段: {chunks}")
-            
-            if not chunks:
-                await doc.delete()
-                raise HTTPException(status_code=400, detail="文档分段失败")
-            
-            # 生成嵌入
-            chunks_with_embeddings = await vector_db.create_embeddings(chunks)
-            
-            # 保存所有片段
-            chunk_objects = []
-            for chunk_data in chunks_with_embeddings:
-                chunk_objects.append(Chunk(
-                    document_id=doc.id,
-                    text=chunk_data["text"],
-                    start_pos=chunk_data["start_pos"],
-                    end_pos=chunk_data["end_pos"],
-                    embedding=chunk_data["embedding"]
-                ))
-            
-            # 批量创建
-            await Chunk.bulk_create(chunk_objects)
-            
-            # 更新文档处理状态
-            doc.processed = True
-            doc.chunk_count = len(chunks)
-            doc.total_tokens = sum(len(text_processor.encoding.encode(chunk["text"])) for chunk in chunks)
-            await doc.save()
-            
-            return doc
-        except Exception as e:
-            # 出错时回滚
+            ingest_queue.submit(doc.id, path)
+        except QueueFullError as e:
+            os.unlink(path)
             await doc.delete()
-            raise HTTPException(status_code=500, detail=f"处理文档时出错: {str(e)}")
+            raise HTTPException(status_code=503, detail=str(e))
+        response.status_code = 202
+        return doc
+    
+    try:
+        # 逐页解析、增量分段，按批生成嵌入并写入
+        timings = {}
+        await store_chunks(doc, iter_document_chunks(temp_path, doc.id, timings), vector_db,
+                           embedding_cache=embedding_cache)
+        observe_parse_timings(timings)
+        return doc
+    except ValueError as e:
+        await doc.delete()
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        # 出错时回滚
+        await doc.delete()
+        raise HTTPException(status_code=500, detail=f"处理文档时出错: {str(e)}")
+    finally:
+        os.unlink(temp_path)
+
+@router.post("/bulk", response_model=BulkIngestResponse)
+async def bulk_upload_documents(files: List[UploadFile] = File(...)):
+    """批量导入多个文件或 zip/tar 压缩包，逐文件返回结果，单个文件失败不影响其他文件
+
+    文件数超过 BULK_MAX_FILES 或解压后的总大小超过 BULK_MAX_TOTAL_BYTES 时整个请求返回413。
+    """
+    started = time.perf_counter()
+    spooled, entries = [], []  # entries 按上传顺序保存暂存文件的下标或无法展开的压缩包的结果
+    try:
+        for file in files:
+            try:
+                members = await asyncio.to_thread(spool_bulk_upload, file.file, file.filename, file.content_type,
+                                                  BULK_MAX_FILES - len(spooled),
+                                                  BULK_MAX_TOTAL_BYTES - sum(member["size"] for member in spooled))
+            except ValueError as e:
+                entries.append({"filename": file.filename, "status": "failed", "document_id": None,
+                                "chunk_count": 0, "error": str(e)})
+                continue
+            if len(spooled) + len(members) > BULK_MAX_FILES:
+                spooled.extend(members)
+                raise TooManyFilesError(f"文件数超过上限 {BULK_MAX_FILES}")
+            entries.extend(range(len(spooled), len(spooled) + len(members)))
+            spooled.extend(members)
+    except (TooManyFilesError, BulkTooLargeError) as e:
+        for member in spooled:
+            os.unlink(member["path"])
+        raise HTTPException(status_code=413, detail=str(e))
+
+    try:
+        results = await ingest_queue.ingest_bulk(spooled)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"批量导入时出错: {str(e)}")
+    results = [results[entry] if isinstance(entry, int) else entry for entry in entries]
+    counts = {status: sum(result["status"] == status for result in results) for status in ("done", "duplicate", "failed")}
+    upload_stats["uploads"] += len(spooled)
+    upload_stats["duplicates"] += counts["duplicate"]
+    return {"total": len(results), **counts, "elapsed_seconds": round(time.perf_counter() - started, 3),
+            "files": results}
 
 @router.get("/", response_model=DocumentListResponse)
 async def list_documents(limit: int = 10, offset: int = 0):
@@ -87,6 +126,17 @@ async def list_documents(limit: int = 10, offset: int = 0):
     total = await Document.all().count()
     return {"documents": documents, "total": total}
 
+@router.get("/stats", response_model=dict)
+async def get_ingest_stats():
+    """上传去重和嵌入缓存的命中统计（本进程启动以来）"""
+    uploads = upload_stats["uploads"]
+    return {
+        "uploads": uploads,
+        "duplicate_uploads": upload_stats["duplicates"],
+        "duplicate_rate": round(upload_stats["duplicates"] / uploads, 4) if uploads else 0.0,
+        "embedding_cache": embedding_cache.stats()
+    }
+
 @router.get("/{document_id}", response_model=DocumentResponse)
 async def get_document(document_id: int):
     """获取单个文档信息"""
@@ -95,6 +145,21 @@ async def get_document(document_id: int):
         raise HTTPException(status_code=404, detail="文档不存在")
     return doc
 
+@router.get("/{document_id}/status", response_model=IngestJobResponse)
+async def get_ingest_status(document_id: int):
+    """查询入库任务的阶段和进度"""
+    doc = await Document.get_or_none(id=document_id)
+    if not doc:
+        raise HTTPException(status_code=404, detail="文档不存在")
+    return {
+        "job_id": doc.id,
+        "status": doc.status,
+        "progress": doc.progress,
+        "error": doc.error,
+        "chunk_count": doc.chunk_count,
+        "total_tokens": doc.total_tokens
+    }
+
 @router.delete("/{document_id}", response_model=dict)
 async def delete_document(document_id: int):
     """删除文档及其所有片段"""
@@ -102,10 +167,15 @@ async def delete_document(document_id: int):
     if not doc:
         raise HTTPException(status_code=404, detail="文档不存在")
     
-    # 删除相关片段
-    await Chunk.filter(document_id=document_id).delete()
-    
-    # 删除文档
-    await doc.delete()
+    # 先删除文档和片段，再从索引中移除：正在入库的任务把片段加入索引后会确认文档仍在，
+    # 两步之间加入的行由这里移除，之后加入的由入库任务自行清理
+    async with in_transaction():
+        await Chunk.filter(document_id=document_id).delete()
+        await doc.delete()
+    async with vector_db.index.write_lock():
+        vector_db.index.remove_document(document_id)
+    if vector_db.keyword_index is not None:
+        vector_db.keyword_index.remove_document(document_id)
+    answer_cache.invalidate_document(document_id)
     
-    return {"message": "文档已成功删除"}    
\ No newline at end of file
+    return {"message": "文档已成功删除"}
@@ -1,26 +1,86 @@
+import json
 from fastapi import APIRouter, HTTPException
-from schemas.query import QueryRequest, QueryResponse
-from services.simple_vector_db import SimpleVectorDB
+from fastapi.responses import StreamingResponse
+from schemas.query import BatchQueryRequest, QueryRequest, QueryResponse
+from services.shared import vector_db, answer_cache
 from services.retrieval_generator import RetrievalAugmentedGenerator
 
 router = APIRouter()
 
 # 初始化服务
-vector_db = SimpleVectorDB()  # 使用简化版向量数据库
-rag = RetrievalAugmentedGenerator(vector_db)
+rag = RetrievalAugmentedGenerator(vector_db, answer_cache=answer_cache)
 
 @router.post("/", response_model=QueryResponse)
 async def query_knowledge_base(query: QueryRequest):
     """向知识库提问"""
     try:
+        retrieval = {}
         answer, sources = await rag.generate_answer(
             query.question, 
-            top_k=query.top_k
+            top_k=query.top_k,
+            stats=retrieval,
+            filters=query.search_filters()
         )
         
         return {
             "answer": answer,
-            "sources": sources
+            "sources": sources,
+            "cached": retrieval.get("answer_cache") == "hit",
+            "retrieval": retrieval
         }
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"查询时出错: {str(e)}")    
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=f"查询时出错: {str(e)}")
+
+def _sse(event: str, data) -> str:
+    """按 Server-Sent Events 格式编码一个事件"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@router.post("/stream")
+async def stream_query(query: QueryRequest):
+    """流式问答（SSE）：先发送 sources 事件，随后逐段发送 token 事件，最后发送 done 或 error 事件"""
+    async def events():
+        retrieval = {}
+        try:
+            async for event, data in rag.stream_answer(query.question, top_k=query.top_k, stats=retrieval,
+                                                       filters=query.search_filters()):
+                if event == "sources":
+                    yield _sse("sources", {"sources": data, "retrieval": retrieval})
+                elif event == "token":
+                    yield _sse("token", {"text": data})
+                elif event == "done":
+                    yield _sse("done", data)
+                else:
+                    yield _sse("error", {"message": data})
+        except Exception as e:
+            yield _sse("error", {"message": f"查询时出错: {str(e)}"})
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        # 禁止代理缓冲，保证逐段送达
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@router.post("/batch")
+async def batch_query(batch: BatchQueryRequest):
+    """批量问答：一次编码所有问题、一次矩阵乘法检索，按完成顺序以NDJSON逐行返回每个问题的结果
+
+    每行包含 index（在请求中的序号）、question、answer、sources、cached，出错的问题为 error
+    """
+    async def lines():
+        try:
+            async for item in rag.answer_batch([(q.question, q.top_k, q.search_filters()) for q in batch.queries],
+                                               concurrency=batch.concurrency):
+                yield json.dumps(item, ensure_ascii=False) + "\n"
+        except Exception as e:
+            yield json.dumps({"error": f"批量查询时出错: {str(e)}"}, ensure_ascii=False) + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson", headers={"X-Accel-Buffering": "no"})
+
+@router.get("/stats", response_model=dict)
+async def query_stats():
+    """向量库的入库吞吐、查询延迟和各级缓存统计"""
+    stats = getattr(vector_db, "stats", None)
+    result = stats() if stats else {"backend": type(vector_db).__name__}
+    result["answer_cache"] = answer_cache.stats()
+    return result
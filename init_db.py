@@ -25,7 +25,7 @@ async def init_db():
         },
         "apps": {
             "models": {
-                "models": ["models.document", "models.chunk"],
+                "models": ["models.document", "models.chunk", "models.embedding_cache"],
                 "default_connection": "default",
             },
         },
@@ -1,8 +1,13 @@
 import os
 import time
+import asyncio
 import logging
+
+# 启动耗时从导入本模块开始计算
+_import_started = time.perf_counter()
+
 from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 from tortoise.contrib.fastapi import register_tortoise
 from dotenv import load_dotenv
@@ -17,8 +22,21 @@ logger = logging.getLogger(__name__)
 # 加载环境变量
 load_dotenv()
 
-# 导入控制器
+# 在导入分词和模型相关的库之前设置本地缓存目录（MODEL_CACHE_DIR）
+from services.model_assets import configure_cache_paths
+configure_cache_paths()
+
+# 导入控制器；解析库、sklearn、openai、torch 等重依赖都在首次使用（或预热）时才导入
 from controllers import document_controller, query_controller
+from services.shared import vector_index, keyword_index, vector_db, ingest_queue, embedding_cache, answer_cache
+from services.ingestion import warm_up as warm_up_ingestion
+from services.metrics import REGISTRY, HTTP_REQUEST_SECONDS, STARTUP_SECONDS, CallbackMetric
+
+# 启动预热: background 为服务就绪后在后台线程中加载（默认），blocking 为加载完才接受请求，none 为不预热
+STARTUP_WARMUP = os.getenv("STARTUP_WARMUP", "background").lower()
+startup_timings = {"imports": time.perf_counter() - _import_started}
+_imports_finished = time.perf_counter()
+_warmup_future = None
 
 app = FastAPI(
     title="文档问答系统API",
@@ -40,10 +58,13 @@ app.add_middleware(
 # 健康检查中间件
 @app.middleware("http")
 async def log_requests(request: Request, call_next):
-    """记录请求日志"""
-    start_time = time.time()
+    """记录请求日志和耗时直方图（按路由模板分组，路径参数不会产生新的标签值）"""
+    start_time = time.perf_counter()
     response = await call_next(request)
-    process_time = time.time() - start_time
+    process_time = time.perf_counter() - start_time
+    route = request.scope.get("route")
+    HTTP_REQUEST_SECONDS.observe(process_time, method=request.method,
+                                 route=getattr(route, "path", "unmatched"), status=response.status_code)
     logger.info(f"{request.method} {request.url.path} - {response.status_code} - {process_time:.3f}s")
     return response
 
@@ -61,7 +82,7 @@ TORTOISE_ORM = {
     },
     "apps": {
         "models": {
-            "models": ["models.document", "models.chunk"],
+            "models": ["models.document", "models.chunk", "models.embedding_cache"],
             "default_connection": "default",
         },
     },
@@ -75,6 +96,57 @@ register_tortoise(
     add_exception_handlers=True,
 )
 
+def warm_up():
+    """预先加载首个请求才会用到的依赖：向量器或嵌入模型、分词器和分句模型、大模型客户端"""
+    timings = {}
+    for phase, step in (("warmup_embedding", vector_db.warm_up),
+                        ("warmup_text_processor", warm_up_ingestion),
+                        ("warmup_llm_client", lambda: query_controller.rag.client)):
+        started = time.perf_counter()
+        try:
+            step()
+        except Exception as e:
+            logger.warning(f"预热 {phase} 失败（将在首次使用时重试）: {e}")
+        timings[phase] = time.perf_counter() - started
+        STARTUP_SECONDS.set(timings[phase], phase=phase)
+    logger.info("预热完成: " + ", ".join(f"{phase[7:]} {seconds:.3f}s" for phase, seconds in timings.items()))
+
+
+async def _timed(phase: str, step):
+    started = time.perf_counter()
+    await step
+    startup_timings[phase] = time.perf_counter() - started
+
+
+@app.on_event("startup")
+async def on_startup():
+    """启动时从数据库构建一次常驻内存的向量索引（和关键词索引），并恢复未完成的入库任务
+
+    各阶段耗时记录在日志和 kbserve_startup_seconds 指标中。
+    """
+    global _warmup_future
+    # 导入完成到这里之间是ORM初始化（连接数据库、检查表结构）
+    startup_timings["database"] = time.perf_counter() - _imports_finished
+    await _timed("vector_index", vector_index.load(dim=getattr(vector_db, "dim", None)))
+    if keyword_index is not None:
+        await _timed("keyword_index", keyword_index.load())
+    await _timed("recover_ingest", ingest_queue.recover())
+    if STARTUP_WARMUP == "blocking":
+        await _timed("warmup", asyncio.to_thread(warm_up))
+    elif STARTUP_WARMUP == "background":
+        _warmup_future = asyncio.get_running_loop().run_in_executor(None, warm_up)
+    startup_timings["total"] = time.perf_counter() - _import_started
+    for phase, seconds in startup_timings.items():
+        STARTUP_SECONDS.set(seconds, phase=phase)
+    logger.info("启动耗时: " + ", ".join(f"{phase} {seconds:.3f}s" for phase, seconds in startup_timings.items())
+                + f" (向量索引 {len(vector_index)} 个片段, 预热: {STARTUP_WARMUP})")
+
+@app.on_event("shutdown")
+async def shutdown_ingest_queue():
+    """关闭入库进程池和大模型客户端连接池"""
+    ingest_queue.shutdown()
+    await query_controller.rag.close()
+
 @app.get("/")
 async def root():
     """根路径，返回API信息"""
@@ -90,6 +162,30 @@ async def health_check():
     """健康检查接口"""
     return {"status": "healthy", "timestamp": time.time()}
 
+def _cache_samples():
+    """各缓存的命中/未命中次数，抓取时从组件已有的统计中读取"""
+    caches = {"answer": answer_cache.stats(), "embedding": embedding_cache.stats()}
+    query_cache = getattr(vector_db, "query_cache", None)
+    if query_cache is not None:
+        query_stats = query_cache.stats()
+        caches["query_embedding"] = query_stats["embeddings"]
+        caches["query_result"] = query_stats["results"]
+    return [({"cache": name, "result": result}, stats[key])
+            for name, stats in caches.items() for result, key in (("hit", "hits"), ("miss", "misses"))]
+
+
+CallbackMetric("kbserve_cache_lookups_total", "缓存查询次数", "counter", _cache_samples)
+CallbackMetric("kbserve_vector_index_chunks", "向量索引中的片段数", "gauge", lambda: [({}, len(vector_index))])
+CallbackMetric("kbserve_keyword_index_chunks", "关键词索引中的片段数", "gauge",
+               lambda: [({}, len(keyword_index))] if keyword_index is not None else [])
+CallbackMetric("kbserve_ingest_pending", "排队或处理中的入库任务数", "gauge", lambda: [({}, ingest_queue.pending)])
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """Prometheus文本格式的指标（本进程内的统计，多worker时按实例分别抓取）"""
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
 @app.exception_handler(HTTPException)
 async def http_exception_handler(request: Request, exc: HTTPException):
     """HTTP异常处理器"""
@@ -7,8 +7,13 @@ class Chunk(Model):
     text = fields.TextField()
     start_pos = fields.IntField()
     end_pos = fields.IntField()
-    embedding = fields.JSONField()  # 存储向量为JSON数组
+    token_count = fields.IntField(null=True)  # 分段器给出的token数，生成上下文时不再分词
+    embedding = fields.JSONField(null=True)  # 旧版JSON数组向量，迁移后置空
+    embedding_blob = fields.BinaryField(null=True)  # 小端float32向量的原始字节
+    embedding_dim = fields.IntField(default=0)
+    embedding_dtype = fields.CharField(max_length=8, default="<f4")
+    term_freqs = fields.JSONField(null=True)  # {词项: 词频}，启动时据此重建BM25倒排索引
     created_at = fields.DatetimeField(auto_now_add=True)
     
     def __str__(self):
-        return f"Chunk {self.id} from document {self.document_id}"    
\ No newline at end of file
+        return f"Chunk {self.id} from document {self.document_id}"
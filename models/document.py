@@ -1,15 +1,29 @@
+from enum import Enum
 from tortoise import fields
 from tortoise.models import Model
 
+class DocumentStatus(str, Enum):
+    """入库任务状态"""
+    QUEUED = "queued"
+    PARSING = "parsing"
+    EMBEDDING = "embedding"  # 分批嵌入并写库
+    DONE = "done"
+    FAILED = "failed"
+
 class Document(Model):
     id = fields.IntField(pk=True)
     filename = fields.CharField(max_length=255)
     file_type = fields.CharField(max_length=200)  # 增加长度以支持长MIME类型
     size = fields.IntField()
+    content_hash = fields.CharField(max_length=64, null=True, db_index=True)  # 文件内容的SHA-256，用于去重
     upload_date = fields.DatetimeField(auto_now_add=True)
     processed = fields.BooleanField(default=False)
+    status = fields.CharEnumField(DocumentStatus, max_length=20, default=DocumentStatus.QUEUED)
+    progress = fields.FloatField(default=0)  # 当前阶段的进度 0~1
+    error = fields.TextField(null=True)
+    owner = fields.CharField(max_length=100, null=True)  # 处理该任务的worker（主机:进程号:随机串），重启恢复时据此认领
     chunk_count = fields.IntField(default=0)
     total_tokens = fields.IntField(default=0)
     
     def __str__(self):
-        return self.filename    
\ No newline at end of file
+        return self.filename
@@ -0,0 +1,19 @@
+from tortoise import fields
+from tortoise.models import Model
+
+class EmbeddingCacheEntry(Model):
+    """按规范化文本哈希和嵌入模型缓存的向量，相同片段跨文档复用"""
+    id = fields.IntField(pk=True)
+    text_hash = fields.CharField(max_length=64)  # 规范化文本的SHA-256
+    model = fields.CharField(max_length=255)  # 嵌入模型标识
+    embedding_blob = fields.BinaryField()
+    embedding_dim = fields.IntField()
+    embedding_dtype = fields.CharField(max_length=8, default="<f4")
+    created_at = fields.DatetimeField(auto_now_add=True)
+
+    class Meta:
+        table = "embedding_cache"
+        unique_together = (("text_hash", "model"),)
+
+    def __str__(self):
+        return f"Embedding {self.text_hash[:12]} ({self.model})"
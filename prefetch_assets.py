@@ -0,0 +1,27 @@
+#!/usr/bin/env python3
+"""
+预先下载运行所需的模型和分词资源
+下载分段用的tiktoken编码表、NLTK分句模型（和transformer后端的嵌入模型）到 MODEL_CACHE_DIR，
+镜像构建时执行一次，服务启动和入库时不再访问网络
+用法: MODEL_CACHE_DIR=/opt/kbserve/models python prefetch_assets.py [--embedding-model NAME]
+"""
+
+import os
+import json
+import argparse
+from dotenv import load_dotenv
+
+# 加载环境变量
+load_dotenv()
+
+from services.model_assets import prefetch
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="预先下载模型和分词资源")
+    parser.add_argument("--embedding-model", default=None,
+                        help="同时下载的嵌入模型（VECTOR_DB_BACKEND=transformer 时默认取 EMBEDDING_MODEL）")
+    args = parser.parse_args()
+    embedding_model = args.embedding_model
+    if embedding_model is None and os.getenv("VECTOR_DB_BACKEND", "simple").lower() == "transformer":
+        embedding_model = os.getenv("EMBEDDING_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+    print(json.dumps(prefetch(embedding_model), ensure_ascii=False, indent=2))
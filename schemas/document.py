@@ -17,9 +17,36 @@ class DocumentResponse(DocumentBase):
     id: int
     upload_date: datetime.datetime
     processed: bool
+    status: str
+    progress: float
+    error: Optional[str] = None
+    content_hash: Optional[str] = None
     chunk_count: int
     total_tokens: int
 
 class DocumentListResponse(BaseModel):
     documents: List[DocumentResponse]
-    total: int    
\ No newline at end of file
+    total: int
+
+class IngestJobResponse(BaseModel):
+    job_id: int = Field(..., description="任务id，与文档id相同")
+    status: str = Field(..., description="queued / parsing / embedding / done / failed")
+    progress: float = Field(..., description="当前阶段的进度 0~1")
+    error: Optional[str] = None
+    chunk_count: int
+    total_tokens: int
+
+class BulkIngestFileResult(BaseModel):
+    filename: str = Field(..., description="上传的文件名，压缩包内的文件为包内路径")
+    status: str = Field(..., description="done / duplicate / failed")
+    document_id: Optional[int] = Field(None, description="新建的文档id，内容重复时为已有文档的id")
+    chunk_count: int = 0
+    error: Optional[str] = None
+
+class BulkIngestResponse(BaseModel):
+    total: int
+    done: int
+    duplicate: int
+    failed: int
+    elapsed_seconds: float
+    files: List[BulkIngestFileResult]
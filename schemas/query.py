@@ -1,9 +1,40 @@
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, model_validator
+import os
+import datetime
+from typing import List, Optional
 
 class QueryRequest(BaseModel):
     question: str = Field(..., min_length=3, description="用户问题")
     top_k: int = Field(5, ge=1, le=20, description="检索的上下文数量")
+    document_ids: Optional[List[int]] = Field(None, max_length=10000, description="只在这些文档中检索")
+    file_type: Optional[str] = Field(None, description="只在该文件类型（上传时的MIME类型）的文档中检索")
+    upload_date_from: Optional[datetime.datetime] = Field(None, description="只检索此时间之后上传的文档")
+    upload_date_to: Optional[datetime.datetime] = Field(None, description="只检索此时间之前上传的文档")
+
+    @model_validator(mode="after")
+    def check_upload_date_range(self):
+        if self.upload_date_from and self.upload_date_to and \
+                self.upload_date_from.timestamp() > self.upload_date_to.timestamp():
+            raise ValueError("upload_date_from 不能晚于 upload_date_to")
+        return self
+
+    def search_filters(self) -> Optional[dict]:
+        """检索过滤条件，未设置任何条件时返回None"""
+        filters = {
+            "document_ids": self.document_ids,
+            "file_type": self.file_type,
+            "upload_date_from": self.upload_date_from,
+            "upload_date_to": self.upload_date_to,
+        }
+        return {name: value for name, value in filters.items() if value is not None} or None
+
+class BatchQueryRequest(BaseModel):
+    queries: List[QueryRequest] = Field(..., min_length=1, max_length=int(os.getenv("BATCH_QUERY_MAX_QUESTIONS", 10000)),
+                                        description="问题列表")
+    concurrency: Optional[int] = Field(None, ge=1, le=256, description="同时进行的大模型调用数，默认取 BATCH_QUERY_CONCURRENCY")
 
 class QueryResponse(BaseModel):
     answer: str = Field(..., description="生成的答案")
-    sources: list = Field(..., description="参考的文档来源")    
\ No newline at end of file
+    sources: list = Field(..., description="参考的文档来源")
+    cached: bool = Field(False, description="答案是否来自缓存（未调用大模型）")
+    retrieval: Optional[dict] = Field(None, description="检索统计：索引后端、扫描的候选数、耗时等")    
\ No newline at end of file
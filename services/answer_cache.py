@@ -0,0 +1,159 @@
+import os
+import time
+import hashlib
+import threading
+import numpy as np
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from services.query_cache import normalize_question
+
+
+def question_fingerprint(question: str) -> str:
+    return hashlib.sha256(normalize_question(question).encode("utf-8")).hexdigest()
+
+
+class AnswerCache:
+    """大模型答案缓存
+
+    以检索到的片段id集合为分组：只有上下文完全相同时才可能复用答案。组内先按问题指纹
+    精确匹配；设置了相似度阈值时，再与组内问题向量比较余弦相似度，超过阈值即视为同义问题。
+    任一来源文档变化（删除）时，引用它的条目全部失效。
+    """
+
+    def __init__(self, max_entries: int = None, ttl: float = None, similarity_threshold: float = None):
+        self.max_entries = max_entries if max_entries is not None else int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", 512))
+        self.ttl = ttl if ttl is not None else float(os.getenv("ANSWER_CACHE_TTL", 3600))
+        # 0 表示只做精确匹配
+        self.similarity_threshold = similarity_threshold if similarity_threshold is not None else \
+            float(os.getenv("ANSWER_CACHE_SIMILARITY", 0))
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.seconds_saved = 0.0
+        # (片段id集合, 问题指纹) -> 条目
+        self._entries = OrderedDict()
+        self._groups = {}  # 片段id集合 -> {问题指纹}
+        self._by_document = {}  # 文档id -> {(片段id集合, 问题指纹)}
+        self._lock = threading.Lock()
+
+    @property
+    def semantic(self) -> bool:
+        return 0 < self.similarity_threshold < 1
+
+    @staticmethod
+    def context_key(chunk_ids: Iterable[int]) -> frozenset:
+        return frozenset(chunk_ids)
+
+    def get(self, context_key: frozenset, question: str,
+            question_embedding: Optional[np.ndarray] = None) -> Optional[Tuple[str, List[dict]]]:
+        """返回缓存的 (答案, 来源)，未命中返回None"""
+        fingerprint = question_fingerprint(question)
+        with self._lock:
+            key = (context_key, fingerprint)
+            entry = self._valid(key)
+            semantic_hit = False
+            if entry is None and question_embedding is not None and self.semantic:
+                key, entry = self._most_similar(context_key, question_embedding)
+                semantic_hit = entry is not None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            self.semantic_hits += semantic_hit
+            self.seconds_saved += entry["seconds"]
+            return entry["answer"], entry["sources"]
+
+    def put(self, context_key: frozenset, question: str, answer: str, sources: List[dict], seconds: float,
+            question_embedding: Optional[np.ndarray] = None):
+        """保存一次成功生成的答案，seconds为大模型调用耗时"""
+        if self.max_entries <= 0:
+            return
+        key = (context_key, question_fingerprint(question))
+        embedding = None
+        if question_embedding is not None and self.semantic:
+            embedding = np.asarray(question_embedding, dtype=np.float32).ravel()
+            norm = np.linalg.norm(embedding)
+            embedding = embedding / norm if norm else embedding
+        document_ids = {source["document_id"] for source in sources}
+        with self._lock:
+            self._discard(key)
+            self._entries[key] = {
+                "answer": answer,
+                "sources": sources,
+                "seconds": seconds,
+                "embedding": embedding,
+                "document_ids": document_ids,
+                "expires_at": time.monotonic() + self.ttl,
+            }
+            self._groups.setdefault(context_key, set()).add(key[1])
+            for document_id in document_ids:
+                self._by_document.setdefault(document_id, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._discard(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate_document(self, document_id: int):
+        """文档变化后清除所有引用它的答案"""
+        with self._lock:
+            for key in self._by_document.pop(document_id, set()):
+                if key in self._entries:
+                    self._discard(key)
+                    self.invalidations += 1
+
+    def _valid(self, key) -> Optional[Dict[str, Any]]:
+        entry = self._entries.get(key)
+        if entry is not None and entry["expires_at"] < time.monotonic():
+            self._discard(key)
+            return None
+        return entry
+
+    def _most_similar(self, context_key: frozenset, question_embedding: np.ndarray):
+        query = np.asarray(question_embedding, dtype=np.float32).ravel()
+        norm = np.linalg.norm(query)
+        if not norm:
+            return None, None
+        query = query / norm
+        best_key, best_entry, best_score = None, None, self.similarity_threshold
+        for fingerprint in list(self._groups.get(context_key, ())):
+            key = (context_key, fingerprint)
+            entry = self._valid(key)
+            if entry is None or entry["embedding"] is None or entry["embedding"].shape != query.shape:
+                continue
+            score = float(entry["embedding"] @ query)
+            if score >= best_score:
+                best_key, best_entry, best_score = key, entry, score
+        return best_key, best_entry
+
+    def _discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        group = self._groups.get(key[0])
+        if group is not None:
+            group.discard(key[1])
+            if not group:
+                del self._groups[key[0]]
+        for document_id in entry["document_ids"]:
+            keys = self._by_document.get(document_id)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._by_document[document_id]
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "semantic_hits": self.semantic_hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "llm_calls_saved": self.hits,
+            "llm_seconds_saved": round(self.seconds_saved, 3),
+            "similarity_threshold": self.similarity_threshold,
+        }
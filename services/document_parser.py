@@ -1,81 +1,254 @@
 import os
+import time
+import shutil
+import logging
 import tempfile
-from typing import List, TYPE_CHECKING
-from docx import Document
-import pdfplumber
-from PIL import Image
-import pytesseract
-import openpyxl
+import multiprocessing
+from collections import deque
+from functools import lru_cache
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator, List, Tuple, TYPE_CHECKING
 
+# 各格式的解析库（pdfplumber、python-docx、openpyxl、PIL、pytesseract）在首次解析该格式时才导入，
+# 导入本模块和创建解析器都不加载它们
 if TYPE_CHECKING:
     from fastapi import UploadFile
+    from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+# OCR 渲染分辨率和语言
+OCR_DPI = int(os.getenv("OCR_DPI", 300))
+OCR_LANG = os.getenv("OCR_LANG", "eng")
+# 没有DPI信息的图片（截图、手机照片）按长边像素数缩小，默认约为A4纸360DPI的长边
+OCR_MAX_SIDE = int(os.getenv("OCR_MAX_SIDE", 4200))
+
+
+def _pytesseract(tesseract_cmd: str = None):
+    import pytesseract
+    if tesseract_cmd:
+        pytesseract.pytesseract.tesseract_cmd = tesseract_cmd
+    return pytesseract
+
+
+def prepare_for_ocr(image: "Image.Image", dpi: int = OCR_DPI, max_side: int = OCR_MAX_SIDE) -> "Image.Image":
+    """转为灰度，并把分辨率高于OCR所需的图片缩小，减少Tesseract耗时
+
+    有DPI信息时缩小到 dpi，没有时把长边缩小到 max_side 像素以内。
+    """
+    from PIL import Image
+    image = image.convert("L")
+    source_dpi = image.info.get("dpi", (0, 0))[0]
+    if source_dpi:
+        scale = dpi / source_dpi
+    else:
+        scale = max_side / max(image.width, image.height)
+    if scale < 1:
+        image = image.resize((max(1, int(image.width * scale)), max(1, int(image.height * scale))), Image.LANCZOS)
+    return image
+
+
+@lru_cache(maxsize=1)
+def tesseract_available() -> bool:
+    pytesseract = _pytesseract()
+    try:
+        pytesseract.get_tesseract_version()
+        return True
+    except pytesseract.TesseractNotFoundError:
+        return False
+
+
+def extract_pdf_pages(file_path: str, page_numbers: List[int], tesseract_cmd: str = None) -> List[Tuple[int, str, float, bool]]:
+    """提取指定页的文本，没有文本层的页自动OCR（可在进程池中执行）
+
+    返回 [(页码, 文本, 耗时秒数, 是否OCR)]
+    """
+    import pdfplumber
+    if tesseract_cmd:
+        _pytesseract(tesseract_cmd)
+    results = []
+    with pdfplumber.open(file_path) as pdf:
+        for page_number in page_numbers:
+            started = time.perf_counter()
+            page = pdf.pages[page_number]
+            text = page.extract_text() or ''
+            ocr = not text.strip()
+            if ocr and not tesseract_available():
+                logger.warning(f"未找到Tesseract，跳过第 {page_number + 1} 页的OCR")
+                ocr = False
+            if ocr:
+                # 扫描页：按OCR分辨率渲染后识别
+                image = prepare_for_ocr(page.to_image(resolution=OCR_DPI).original)
+                text = _pytesseract().image_to_string(image, lang=OCR_LANG)
+            page.close()
+            results.append((page_number, text, time.perf_counter() - started, ocr))
+    return results
+
+
+def _init_page_worker():
+    # 多进程并行时每个Tesseract只用一个线程，避免CPU超额订阅
+    os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+
 
 class DocumentParser:
-    def __init__(self, tesseract_path=None):
+    def __init__(self, tesseract_path=None, pdf_workers: int = None):
         # 从环境变量或参数获取Tesseract路径
-        tesseract_path = tesseract_path or os.getenv("TESSERACT_PATH")
-        if tesseract_path:
-            pytesseract.pytesseract.tesseract_cmd = tesseract_path
+        self.tesseract_cmd = tesseract_path or os.getenv("TESSERACT_PATH")
+        # PDF按页并行解析的进程数（默认CPU核数，入库进程池中由调用方按池的大小分摊），页数少于阈值时在当前进程中顺序解析
+        self.pdf_workers = pdf_workers or int(os.getenv("PDF_WORKERS", os.cpu_count() or 1))
+        self.pdf_parallel_min_pages = int(os.getenv("PDF_PARALLEL_MIN_PAGES", 16))
+        self.pdf_pages_per_task = int(os.getenv("PDF_PAGES_PER_TASK", 4))
+        self._page_pool = None
     
     def parse_file(self, file_path: str) -> str:
         """根据文件扩展名解析不同格式的文件"""
+        return '\n'.join(self.iter_file(file_path))
+    
+    def iter_file(self, file_path: str, timings: list = None) -> Iterator[str]:
+        """按页/工作表/段落逐段产出文本，内存占用不随文件大小增长
+
+        timings 不为None时，PDF每页的 {"page", "seconds", "ocr"} 会追加到其中
+        """
         ext = os.path.splitext(file_path)[1].lower()
-        
+
         if ext == '.docx':
-            return self._parse_docx(file_path)
+            return self._iter_docx(file_path)
         elif ext == '.pdf':
-            return self._parse_pdf(file_path)
+            return self._iter_pdf(file_path, timings)
         elif ext in ['.jpg', '.jpeg', '.png', '.bmp']:
-            return self._parse_image(file_path)
+            return iter([self._parse_image(file_path)])
         elif ext in ['.xlsx', '.xls']:
-            return self._parse_excel(file_path)
+            return self._iter_excel(file_path)
         elif ext == '.txt':
-            return self._parse_txt(file_path)
+            return self._iter_txt(file_path)
         else:
             raise ValueError(f"不支持的文件格式: {ext}")
     
-    def _parse_docx(self, file_path: str) -> str:
+    def _iter_docx(self, file_path: str) -> Iterator[str]:
+        from docx import Document
         doc = Document(file_path)
-        return '\n'.join([para.text for para in doc.paragraphs])
+        for para in doc.paragraphs:
+            yield para.text
+    
+    def _get_page_pool(self) -> ProcessPoolExecutor:
+        if self._page_pool is None:
+            self._page_pool = ProcessPoolExecutor(
+                max_workers=self.pdf_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_page_worker
+            )
+        return self._page_pool
+    
+    def close(self):
+        """关闭PDF页级进程池，下次并行解析时重新创建"""
+        if self._page_pool is not None:
+            self._page_pool.shutdown()
+            self._page_pool = None
     
-    def _parse_pdf(self, file_path: str) -> str:
+    def _iter_pdf(self, file_path: str, timings: list = None) -> Iterator[str]:
+        """按页产出文本；页数较多时分组提交到进程池并行提取/OCR，按页码顺序重组"""
+        import pdfplumber
+        started = time.perf_counter()
         with pdfplumber.open(file_path) as pdf:
-            return '\n'.join([page.extract_text() or '' for page in pdf.pages])
+            page_count = len(pdf.pages)
+
+        groups = [list(range(i, min(i + self.pdf_pages_per_task, page_count)))
+                  for i in range(0, page_count, self.pdf_pages_per_task)]
+        tesseract_cmd = self.tesseract_cmd
+        if self.pdf_workers > 1 and page_count >= self.pdf_parallel_min_pages:
+            results = self._map_pages(file_path, groups, tesseract_cmd)
+        else:
+            results = (extract_pdf_pages(file_path, group, tesseract_cmd) for group in groups)
+
+        ocr_pages = 0
+        for pages in results:
+            for page_number, text, seconds, ocr in pages:
+                ocr_pages += ocr
+                if timings is not None:
+                    timings.append({"page": page_number + 1, "seconds": round(seconds, 4), "ocr": ocr})
+                yield text
+        logger.info(f"PDF解析完成: {os.path.basename(file_path)} 共 {page_count} 页, "
+                    f"其中OCR {ocr_pages} 页, 耗时 {time.perf_counter() - started:.2f}s")
     
+    def _map_pages(self, file_path: str, groups: List[List[int]], tesseract_cmd: str) -> Iterator[list]:
+        """在进程池中按页码顺序提取各组页面，同时提交的组数不超过 pdf_workers*2，每取走一组再提交下一组
+
+        Executor.map 会一次提交全部页面，分段和嵌入跟不上时提取好的文本全部堆在内存中。
+        """
+        pool = self._get_page_pool()
+        groups = iter(groups)
+        pending = deque(pool.submit(extract_pdf_pages, file_path, group, tesseract_cmd)
+                        for group in islice(groups, self.pdf_workers * 2))
+        try:
+            while pending:
+                pages = pending.popleft().result()
+                for group in islice(groups, 1):
+                    pending.append(pool.submit(extract_pdf_pages, file_path, group, tesseract_cmd))
+                yield pages
+        finally:
+            # 提前停止读取（入库失败）时取消还没开始的组
+            for future in pending:
+                future.cancel()
+
     def _parse_image(self, file_path: str) -> str:
-        image = Image.open(file_path)
-        return pytesseract.image_to_string(image)
+        from PIL import Image
+        image = prepare_for_ocr(Image.open(file_path))
+        return _pytesseract(self.tesseract_cmd).image_to_string(image, lang=OCR_LANG)
     
-    def _parse_excel(self, file_path: str) -> str:
+    def _iter_excel(self, file_path: str, rows_per_segment: int = 1000) -> Iterator[str]:
+        import openpyxl
         workbook = openpyxl.load_workbook(file_path, read_only=True)
-        text = []
-        for sheet_name in workbook.sheetnames:
-            sheet = workbook[sheet_name]
-            sheet_text = []
-            for row in sheet.rows:
-                row_text = [str(cell.value) for cell in row if cell.value is not None]
-                if row_text:
-                    sheet_text.append('\t'.join(row_text))
-            if sheet_text:
-                text.append(f"Sheet: {sheet_name}\n" + '\n'.join(sheet_text))
-        return '\n\n'.join(text)
+        try:
+            for sheet_name in workbook.sheetnames:
+                sheet = workbook[sheet_name]
+                header_sent = False
+                sheet_text = []
+                for row in sheet.rows:
+                    row_text = [str(cell.value) for cell in row if cell.value is not None]
+                    if row_text:
+                        sheet_text.append('\t'.join(row_text))
+                    if len(sheet_text) >= rows_per_segment:
+                        yield self._sheet_segment(sheet_name, sheet_text, header_sent)
+                        header_sent = True
+                        sheet_text = []
+                if sheet_text:
+                    yield self._sheet_segment(sheet_name, sheet_text, header_sent)
+        finally:
+            workbook.close()
+    
+    @staticmethod
+    def _sheet_segment(sheet_name: str, rows: List[str], header_sent: bool) -> str:
+        text = '\n'.join(rows)
+        return text if header_sent else f"Sheet: {sheet_name}\n" + text
     
-    def _parse_txt(self, file_path: str) -> str:
+    def _iter_txt(self, file_path: str, block_size: int = 1 << 16) -> Iterator[str]:
         with open(file_path, 'r', encoding='utf-8') as f:
-            return f.read()
+            carry = ''
+            while True:
+                # 读到行尾为止，避免把一个词切断在两段之间；行尾最多再读 block_size 个字符
+                block = carry + f.read(block_size)
+                if not block:
+                    break
+                line = f.readline(block_size)
+                carry = ''
+                if len(line) == block_size and not line.endswith('\n'):
+                    # 超长的行：在读到的最后一个空白处切开，其余部分并入下一段
+                    cut = max(line.rfind(' '), line.rfind('\t')) + 1
+                    if cut:
+                        line, carry = line[:cut], line[cut:]
+                yield block + line
     
     def parse_uploaded_file(self, file: "UploadFile") -> str:
         """解析上传的文件"""
-        # 读取文件内容
-        file_contents = file.file.read()
-        
+        # 流式写入临时文件，不在内存中保留整个文件
         with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(file.filename)[1]) as temp:
-            temp.write(file_contents)
+            shutil.copyfileobj(file.file, temp)
             temp_path = temp.name
-        
+
         try:
             text = self.parse_file(temp_path)
         finally:
             os.unlink(temp_path)
-        
-        return text    
\ No newline at end of file
+
+        return text
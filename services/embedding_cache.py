@@ -0,0 +1,75 @@
+import hashlib
+import unicodedata
+from typing import Any, Dict, List
+from models.embedding_cache import EmbeddingCacheEntry
+from services.embedding_codec import decode_embedding, embedding_fields
+
+
+def normalize_text(text: str) -> str:
+    """NFKC规范化并合并空白，排版上的差异不影响缓存命中"""
+    return " ".join(unicodedata.normalize("NFKC", text).split())
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """持久化的片段嵌入缓存
+
+    以 (规范化文本的SHA-256, 嵌入模型标识) 为键保存向量；create_embeddings 与
+    向量数据库的同名方法接口一致，只把未命中的片段交给模型计算，并写回缓存。
+    """
+
+    def __init__(self, vector_db, enabled: bool = True):
+        self.vector_db = vector_db
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def model_id(self) -> str:
+        return self.vector_db.model_id
+
+    async def create_embeddings(self, chunks: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        if not self.enabled or not chunks:
+            return await self.vector_db.create_embeddings(chunks)
+
+        model = self.model_id
+        hashes = [text_hash(chunk["text"]) for chunk in chunks]
+        rows = await EmbeddingCacheEntry.filter(model=model, text_hash__in=list(set(hashes))).values_list(
+            "text_hash", "embedding_blob", "embedding_dim", "embedding_dtype"
+        )
+        cached = {h: decode_embedding(blob, dim, dtype) for h, blob, dim, dtype in rows}
+
+        # 同一批内重复的文本也只计算一次
+        pending = {}
+        for chunk, h in zip(chunks, hashes):
+            if h in cached:
+                chunk["embedding"] = cached[h]
+                self.hits += 1
+            else:
+                pending.setdefault(h, []).append(chunk)
+                self.misses += 1
+
+        if pending:
+            firsts = [group[0] for group in pending.values()]
+            await self.vector_db.create_embeddings(firsts)
+            for group in pending.values():
+                for chunk in group[1:]:
+                    chunk["embedding"] = group[0]["embedding"]
+            await EmbeddingCacheEntry.bulk_create([
+                EmbeddingCacheEntry(text_hash=h, model=model, **embedding_fields(group[0]["embedding"]))
+                for h, group in pending.items()
+            ], ignore_conflicts=True)
+        return chunks
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "model": self.model_id,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+        }
@@ -0,0 +1,34 @@
+import numpy as np
+from typing import Any, Dict, Optional
+
+# 向量统一以小端float32存储，可直接用 np.frombuffer 零拷贝解码
+EMBEDDING_DTYPE = "<f4"
+
+
+def encode_embedding(embedding: Any) -> bytes:
+    """将向量编码为小端float32字节串"""
+    return np.ascontiguousarray(embedding, dtype=EMBEDDING_DTYPE).ravel().tobytes()
+
+
+def decode_embedding(blob: bytes, dim: int, dtype: str = EMBEDDING_DTYPE) -> np.ndarray:
+    """零拷贝解码向量（返回只读视图）"""
+    return np.frombuffer(blob, dtype=np.dtype(dtype), count=dim)
+
+
+def embedding_fields(embedding: Any) -> Dict[str, Any]:
+    """生成写入 Chunk 模型所需的向量字段"""
+    vector = np.asarray(embedding, dtype=EMBEDDING_DTYPE).ravel()
+    return {
+        "embedding_blob": vector.tobytes(),
+        "embedding_dim": int(vector.shape[0]),
+        "embedding_dtype": EMBEDDING_DTYPE,
+    }
+
+
+def row_embedding(blob: Optional[bytes], dim: int, dtype: str, legacy: Optional[list]) -> Optional[np.ndarray]:
+    """读取一行的向量，兼容尚未迁移的JSON格式"""
+    if blob is not None:
+        return decode_embedding(blob, dim, dtype)
+    if legacy is not None:
+        return np.asarray(legacy, dtype=np.float32)
+    return None
@@ -0,0 +1,171 @@
+import os
+import time
+import asyncio
+import inspect
+import numpy as np
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple, Union
+from models.chunk import Chunk
+from services.keyword_index import BM25Index, top_hits, term_frequencies
+from services.vector_index import VectorIndex
+
+# 关键词候选不超过语料的这一比例时，只对候选片段做向量打分
+HYBRID_PRUNE_RATIO = float(os.getenv("HYBRID_PRUNE_RATIO", 0.2))
+# 每一路取 top_k * HYBRID_FUSION_DEPTH 个结果参与融合
+HYBRID_FUSION_DEPTH = int(os.getenv("HYBRID_FUSION_DEPTH", 4))
+# 倒数排名融合(RRF)的平滑常数
+RRF_K = int(os.getenv("RRF_K", 60))
+# 批量检索的关键词一路在事件循环中进行，每处理这么多条问题让出一次
+KEYWORD_BATCH_YIELD = 32
+
+
+def rrf_fuse(rankings: Sequence[List[Tuple[int, float]]], top_k: int, k: int = None) -> List[Tuple[int, float]]:
+    """倒数排名融合：得分为各路排名的 1/(k+rank) 之和，与各路得分的量纲无关"""
+    k = k or RRF_K
+    fused = {}
+    for ranking in rankings:
+        for rank, (chunk_id, _) in enumerate(ranking):
+            fused[chunk_id] = fused.get(chunk_id, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(fused.items(), key=lambda item: -item[1])[:top_k]
+
+
+def hybrid_search(index: VectorIndex, keyword_index: BM25Index, question: str, query_embedding: np.ndarray,
+                  top_k: int = 5, stats: dict = None, filters: Dict[str, Any] = None) -> List[Tuple[int, float]]:
+    """混合检索：BM25和向量两路排名做RRF融合
+
+    候选片段只取问题中少见词项（按文档频率从低到高，倒排表总长不超过范围的 HYBRID_PRUNE_RATIO，
+    不含CJK单字）的倒排表，两路都只在候选上打分，单次查询的计算量与这些倒排项的数量成正比；
+    候选不足融合深度时用完整BM25排名的前几名补足，整个问题命中的片段仍不足 top_k 个时向量一路全量检索。
+    问题中没有足够少见的词项时两路都退回全量检索。
+    有过滤条件时两路都只在满足条件的文档中检索，比例按过滤后的范围计算。
+    """
+    started = time.perf_counter()
+    plan = keyword_plan(index, keyword_index, question, top_k, filters)
+    vector_stats = {}
+    hits = fuse_plan(index, plan, query_embedding, top_k, filters, stats=vector_stats)
+    if stats is not None:
+        document_ids, chunk_ids, _, pruned = plan
+        stats.update({
+            "backend": "hybrid",
+            "vector_backend": vector_stats.get("backend"),
+            "pruned": pruned,
+            "candidates": vector_stats.get("candidates", 0),
+            "keyword_candidates": len(chunk_ids),
+            "total": len(index),
+            "filtered": document_ids is not None,
+            "elapsed_ms": round((time.perf_counter() - started) * 1000, 3),
+        })
+    return hits
+
+
+def keyword_plan(index: VectorIndex, keyword_index: BM25Index, question: str, top_k: int,
+                 filters: Dict[str, Any] = None) -> Tuple[Optional[np.ndarray], np.ndarray, np.ndarray, bool]:
+    """混合检索的关键词一路，返回 (过滤后的文档id, 关键词候选chunk_id, BM25得分, 向量一路是否只在候选上打分)
+
+    读取BM25倒排表，必须在事件循环线程中调用。
+    """
+    document_ids = index.filter_documents(filters)
+    depth = top_k * max(1, HYBRID_FUSION_DEPTH)
+    scope = len(index) if document_ids is None else len(index.rows_for_documents(document_ids))
+    selective = keyword_index.selective_candidates(question, int(HYBRID_PRUNE_RATIO * scope), min_results=depth,
+                                                   document_ids=document_ids)
+    # 整个问题命中的片段都不足 top_k 个时，向量一路只能靠全量检索补足
+    pruned = selective is not None and len(selective[0]) >= min(top_k, scope)
+    chunk_ids, scores = selective if selective is not None else keyword_index.candidates(question, document_ids)
+    return document_ids, chunk_ids, scores, pruned
+
+
+def fuse_plan(index: VectorIndex, plan: tuple, query_embedding: np.ndarray, top_k: int,
+              filters: Dict[str, Any] = None, stats: dict = None) -> List[Tuple[int, float]]:
+    """混合检索的向量一路与排名融合；只读取向量索引，可以在线程中对 read_view() 视图执行"""
+    _, chunk_ids, scores, pruned = plan
+    depth = top_k * max(1, HYBRID_FUSION_DEPTH)
+    if pruned:
+        rows = index.rows_for(chunk_ids)
+        vector_hits = index.search_rows(query_embedding, rows[rows >= 0], top_k=depth, stats=stats)
+    else:
+        vector_hits = index.search(query_embedding, top_k=depth, stats=stats, filters=filters)
+    return rrf_fuse([vector_hits, top_hits(chunk_ids, scores, depth)], top_k)
+
+
+async def refresh_indexes(index: VectorIndex, keyword_index: Optional[BM25Index], batch_size: int = 1000):
+    """检索前同步其他worker对共享向量索引的写入，关键词索引按变化的片段从数据库补齐
+
+    只有共享索引（VECTOR_INDEX_BACKEND=mmap）会返回变化；本worker已有的片段不会重复加入关键词索引。
+    """
+    changes = index.refresh()
+    if changes is None or keyword_index is None:
+        return
+    for document_id in changes["removed"]:
+        keyword_index.remove_document(document_id)
+    chunk_ids = changes["chunk_ids"].tolist()
+    for start in range(0, len(chunk_ids), batch_size):
+        rows = await Chunk.filter(id__in=chunk_ids[start:start + batch_size]).order_by("id") \
+            .values_list("id", "document_id", "term_freqs", "text")
+        by_document = {}
+        for chunk_id, document_id, freqs, text in rows:
+            by_document.setdefault(document_id, []).append((chunk_id, freqs if freqs is not None else term_frequencies(text)))
+        for document_id, chunks in by_document.items():
+            known = {keyword_index.slot_chunk_ids[slot] for slot in keyword_index.document_slots.get(document_id, ())}
+            chunks = [(chunk_id, freqs) for chunk_id, freqs in chunks if chunk_id not in known]
+            keyword_index.add_document(document_id, [chunk_id for chunk_id, _ in chunks], [freqs for _, freqs in chunks])
+
+
+async def search_hits(index: VectorIndex, keyword_index: Optional[BM25Index], mode: str, question: str,
+                      embed: Callable, top_k: int = 5, stats: dict = None,
+                      filters: Dict[str, Any] = None) -> List[Tuple[int, float]]:
+    """按检索模式（vector / bm25 / hybrid）返回 (chunk_id, 得分)
+
+    embed(question) 返回查询向量（可以是协程），纯关键词检索时不会调用。
+    filters 的文档级条件由向量索引登记的文档元数据求值。
+    """
+    if keyword_index is None or mode == "vector":
+        return index.search(await _embedding(embed, question), top_k=top_k, stats=stats, filters=filters)
+    if mode == "bm25":
+        return keyword_index.search(question, top_k=top_k, stats=stats, document_ids=index.filter_documents(filters))
+    return hybrid_search(index, keyword_index, question, await _embedding(embed, question), top_k=top_k,
+                         stats=stats, filters=filters)
+
+
+async def search_hits_batch(index: VectorIndex, keyword_index: Optional[BM25Index], mode: str, questions: List[str],
+                            embeddings: Optional[np.ndarray], top_k: Union[int, Sequence[int]] = 5, stats: dict = None,
+                            filters: Sequence[Optional[Dict[str, Any]]] = None) -> List[List[Tuple[int, float]]]:
+    """批量版本：向量模式一次矩阵乘法；关键词和混合模式逐条查询倒排表（embeddings 在 bm25 模式下可为None）
+
+    向量一路（矩阵乘法、IVF/量化逐条检索）在线程中对索引的只读视图执行，不阻塞事件循环；
+    BM25倒排表只能在事件循环线程中读取，关键词一路每 KEYWORD_BATCH_YIELD 条问题让出一次事件循环。
+    """
+    started = time.perf_counter()
+    top_ks = [top_k] * len(questions) if isinstance(top_k, int) else list(top_k)
+    filters = list(filters) if filters is not None else [None] * len(questions)
+    if keyword_index is None or mode == "vector":
+        view = index.read_view()
+        results = await asyncio.to_thread(view.search_batch, embeddings, top_k=top_ks, stats=stats, filters=filters)
+        index.adopt_caches(view)
+        return results
+
+    results, plans = [], []
+    for i, (question, k, f) in enumerate(zip(questions, top_ks, filters)):
+        if i and i % KEYWORD_BATCH_YIELD == 0:
+            await asyncio.sleep(0)
+        if mode == "bm25":
+            results.append(keyword_index.search(question, top_k=k, document_ids=index.filter_documents(f)))
+        else:
+            plans.append(keyword_plan(index, keyword_index, question, k, f))
+    if mode != "bm25":
+        view = index.read_view()
+        results = await asyncio.to_thread(lambda: [fuse_plan(view, plan, embedding, k, f) for plan, embedding, k, f
+                                                   in zip(plans, embeddings, top_ks, filters)])
+        index.adopt_caches(view)
+    if stats is not None:
+        stats.update({
+            "backend": mode,
+            "queries": len(questions),
+            "total": len(index),
+            "elapsed_ms": round((time.perf_counter() - started) * 1000, 3),
+        })
+    return results
+
+
+async def _embedding(embed: Callable, question: str) -> np.ndarray:
+    embedding = embed(question)
+    return await embedding if inspect.isawaitable(embedding) else embedding
@@ -0,0 +1,660 @@
+import os
+import json
+import time
+import socket
+import hashlib
+import asyncio
+import logging
+import tarfile
+import zipfile
+import tempfile
+import mimetypes
+import uuid
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from typing import Any, Awaitable, BinaryIO, Callable, Dict, Iterable, Iterator, List, Tuple
+from tortoise.transactions import in_transaction
+from models.document import Document, DocumentStatus
+from models.chunk import Chunk
+from services.embedding_codec import embedding_fields
+from services.keyword_index import term_frequencies
+from services.metrics import (CHUNKS_PROCESSED, DOCUMENTS_INGESTED, STAGE_SECONDS, TOKENS_PROCESSED,
+                              observe_parse_timings, timed_iter)
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_DIR = os.getenv("UPLOAD_DIR", os.path.join(tempfile.gettempdir(), "kbserve_uploads"))
+# 每批嵌入并写库的片段数
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", 256))
+# 批量导入时多个文档共用的嵌入/写库批次的片段数，以及一次请求最多的文件数（压缩包按其中的文件计）
+BULK_BATCH_SIZE = int(os.getenv("BULK_BATCH_SIZE", 1024))
+BULK_MAX_FILES = int(os.getenv("BULK_MAX_FILES", 10000))
+# 压缩包内单个文件解压后的字节数上限，以及一次请求所有文件解压后的总字节数上限（防止压缩炸弹）
+BULK_MAX_FILE_BYTES = int(os.getenv("BULK_MAX_FILE_BYTES", 256 << 20))
+BULK_MAX_TOTAL_BYTES = int(os.getenv("BULK_MAX_TOTAL_BYTES", 4 << 30))
+
+# 本进程的标识，写入 Document.owner；随机串区分重启后复用的进程号
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+ARCHIVE_SUFFIXES = (".zip", ".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".tar.xz", ".txz")
+
+# 每个进程（包括进程池的worker）各自懒加载一份解析器和文本处理器
+_parser = None
+_processor = None
+# 入库进程池的worker中为池的大小（主进程中为None），PDF按页并行的进程数据此分摊CPU
+_pool_size = None
+
+
+def _init_ingest_worker(pool_size: int):
+    global _pool_size
+    _pool_size = pool_size
+
+
+def _get_services():
+    global _parser, _processor
+    if _parser is None:
+        from services.document_parser import DocumentParser
+        from services.text_processor import TextProcessor
+        pdf_workers = None
+        if _pool_size is not None:
+            # 每个入库worker都可能再开页级进程池，默认各分 CPU核数/INGEST_WORKERS 个，总数不超过核数
+            pdf_workers = int(os.getenv("PDF_WORKERS", 0)) or max(1, (os.cpu_count() or 1) // _pool_size)
+        _parser = DocumentParser(pdf_workers=pdf_workers)
+        _processor = TextProcessor()
+    return _parser, _processor
+
+
+def warm_up():
+    """预先创建解析器和分段器，加载tiktoken编码表和NLTK分句模型（各格式的解析库仍在首次解析时导入）"""
+    _, processor = _get_services()
+    processor.chunk_text("Warm up. 预热。", 0)
+
+
+def owner_alive(owner: str) -> bool:
+    """任务的处理者是否仍在运行：暂存文件在本机磁盘上，其他主机的任务不由本机恢复，按仍在运行处理"""
+    if not owner:
+        return False
+    host, pid, _ = owner.rsplit(":", 2)
+    if host != socket.gethostname():
+        return True
+    if int(pid) == os.getpid():
+        return owner == WORKER_ID
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def spool_path(document_id: int, filename: str) -> str:
+    """上传文件在磁盘上的暂存路径，保留扩展名供解析器识别格式"""
+    return os.path.join(UPLOAD_DIR, f"{document_id}{os.path.splitext(filename or '')[1].lower()}")
+
+
+class SizeLimitError(ValueError):
+    """暂存的内容超过字节数上限"""
+
+
+def spool_upload(source: BinaryIO, filename: str, block_size: int = 1 << 20,
+                 max_bytes: int = None) -> Tuple[str, int, str]:
+    """把上传内容写入暂存目录，返回临时路径、文件大小和内容的SHA-256
+
+    指定 max_bytes 时读到超过上限的内容就停止，删除临时文件并抛出 SizeLimitError。
+    """
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    digest = hashlib.sha256()
+    with tempfile.NamedTemporaryFile(dir=UPLOAD_DIR, delete=False, suffix=os.path.splitext(filename or '')[1]) as temp:
+        while True:
+            block = source.read(block_size)
+            if not block:
+                break
+            if max_bytes is not None and temp.tell() + len(block) > max_bytes:
+                temp.close()
+                os.unlink(temp.name)
+                raise SizeLimitError(f"{filename} 超过 {max_bytes} 字节")
+            digest.update(block)
+            temp.write(block)
+        return temp.name, temp.tell(), digest.hexdigest()
+
+
+class TooManyFilesError(Exception):
+    """批量导入的文件数超过 BULK_MAX_FILES"""
+
+
+class BulkTooLargeError(Exception):
+    """批量导入的文件解压后的总字节数超过 BULK_MAX_TOTAL_BYTES"""
+
+
+def is_archive(filename: str) -> bool:
+    return (filename or "").lower().endswith(ARCHIVE_SUFFIXES)
+
+
+def iter_archive_members(path: str) -> Iterator[Tuple[str, BinaryIO]]:
+    """逐个打开压缩包中的普通文件，返回包内路径和可读的文件对象（tar按顺序流式读取）
+
+    目录、链接和 __MACOSX/、.DS_Store 这类隐藏文件跳过；文件对象只在迭代到下一个成员前有效。
+    """
+    def skipped(name: str) -> bool:
+        return name.startswith("__MACOSX/") or os.path.basename(name).startswith(".")
+
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as archive:
+            for info in archive.infolist():
+                if info.is_dir() or skipped(info.filename):
+                    continue
+                with archive.open(info) as member:
+                    yield info.filename, member
+        return
+    with tarfile.open(path, "r|*") as archive:
+        for info in archive:
+            if not info.isfile() or skipped(info.name):
+                continue
+            yield info.name, archive.extractfile(info)
+
+
+def spool_bulk_upload(source: BinaryIO, filename: str, content_type: str = None, max_files: int = None,
+                      max_bytes: int = None, max_file_bytes: int = None) -> List[Dict[str, Any]]:
+    """暂存批量导入的一个上传文件，压缩包展开为其中的各个文件
+
+    返回 filename / file_type / path / size / content_hash 的列表；压缩包内文件的类型按扩展名推断。
+    展开后超过 max_files 个文件时删除已暂存的文件并抛出 TooManyFilesError，压缩包损坏或其中的文件
+    解压后超过 max_file_bytes（默认 BULK_MAX_FILE_BYTES）时抛出 ValueError。解压时边读边计数，
+    不信任压缩包自己声明的大小；所有文件合计超过 max_bytes 时抛出 BulkTooLargeError。
+    """
+    max_file_bytes = max_file_bytes or BULK_MAX_FILE_BYTES
+    try:
+        path, size, content_hash = spool_upload(source, filename, max_bytes=max_bytes)
+    except SizeLimitError:
+        raise BulkTooLargeError(f"文件总大小超过上限 {BULK_MAX_TOTAL_BYTES} 字节")
+    if not is_archive(filename):
+        return [{"filename": filename, "file_type": content_type or "application/octet-stream",
+                 "path": path, "size": size, "content_hash": content_hash}]
+    files, remaining = [], max_bytes
+    try:
+        for name, member in iter_archive_members(path):
+            if max_files is not None and len(files) >= max_files:
+                raise TooManyFilesError(f"文件数超过上限 {BULK_MAX_FILES}")
+            limit = max_file_bytes if remaining is None else min(max_file_bytes, remaining)
+            try:
+                member_path, member_size, member_hash = spool_upload(member, name, max_bytes=limit)
+            except SizeLimitError:
+                if limit < max_file_bytes:
+                    raise BulkTooLargeError(f"文件总大小超过上限 {BULK_MAX_TOTAL_BYTES} 字节")
+                raise ValueError(f"压缩包 {filename} 中的 {name} 解压后超过 {max_file_bytes} 字节")
+            if remaining is not None:
+                remaining -= member_size
+            files.append({"filename": name, "file_type": mimetypes.guess_type(name)[0] or "application/octet-stream",
+                          "path": member_path, "size": member_size, "content_hash": member_hash})
+    except Exception as e:
+        for file in files:
+            os.unlink(file["path"])
+        if isinstance(e, (zipfile.BadZipFile, tarfile.TarError)):
+            raise ValueError(f"无法读取压缩包 {filename}: {e}")
+        raise
+    finally:
+        os.unlink(path)
+    return files
+
+
+def iter_document_chunks(path: str, document_id: int, timings: Dict[str, Any] = None) -> Iterator[Dict[str, Any]]:
+    """逐页/逐段解析并增量分段，片段自带token数和词频（关键词索引用）
+
+    timings 不为None时累计各阶段的秒数（parse / clean / chunk / terms）、文件类型和PDF页数，
+    迭代结束后交给 metrics.observe_parse_timings 记录。
+    """
+    parser, processor = _get_services()
+    timings = timings if timings is not None else {}
+    timings["file_type"] = os.path.splitext(path)[1].lower().lstrip(".") or "unknown"
+    timings.setdefault("terms", 0.0)
+    pages = []
+    segments = timed_iter(parser.iter_file(path, pages), timings, "parse")
+    for chunk in processor.iter_chunks(segments, document_id, timings):
+        started = time.perf_counter()
+        chunk["term_freqs"] = term_frequencies(chunk["text"])
+        timings["terms"] += time.perf_counter() - started
+        yield chunk
+    for page in pages:
+        key = f"pages_ocr_{'true' if page['ocr'] else 'false'}"
+        timings[key] = timings.get(key, 0) + 1
+
+
+def spool_chunks(path: str, document_id: int, out_path: str) -> Tuple[int, Dict[str, Any]]:
+    """在进程池中解析和分段，结果逐行写入JSONL文件，返回片段数和各阶段耗时（由主进程记录指标）"""
+    count = 0
+    timings = {}
+    try:
+        with open(out_path, "w", encoding="utf-8") as out:
+            for chunk in iter_document_chunks(path, document_id, timings):
+                out.write(json.dumps(chunk, ensure_ascii=False) + "\n")
+                count += 1
+    finally:
+        # 页级进程池不在两个文件之间常驻，空闲的入库worker不占用额外的进程
+        _get_services()[0].close()
+    return count, timings
+
+
+def iter_spooled_chunks(path: str) -> Iterator[Dict[str, Any]]:
+    """逐行读回 spool_chunks 写入的片段"""
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            yield json.loads(line)
+
+
+class DocumentDoneError(ValueError):
+    """文档已入库完成，不能再次写入片段"""
+
+
+async def store_chunks(doc: Document, chunks: Iterable[Dict[str, Any]], vector_db, batch_size: int = None,
+                       total: int = None, on_progress: Callable[[DocumentStatus, float], Awaitable[Any]] = None,
+                       embedding_cache=None):
+    """按固定大小分批生成嵌入、写库并加入内存索引，内存占用与文档大小无关
+
+    chunks 可以是惰性的迭代器（在线程中推进，不阻塞事件循环）；已知片段总数 total 时
+    每批完成后调用 on_progress(阶段, 进度)。任何一批失败都会清理该文档已写入的片段。
+    传入 embedding_cache 时已缓存的片段不再经过模型。
+    """
+    batch_size = batch_size or INGEST_BATCH_SIZE
+    embedder = embedding_cache or vector_db
+    chunks = iter(chunks)
+    chunk_count = total_tokens = last_id = 0
+    stored_ids = []
+    try:
+        while True:
+            batch = await asyncio.to_thread(lambda: list(islice(chunks, batch_size)))
+            if not batch:
+                break
+
+            with STAGE_SECONDS.time(stage="embed"):
+                await embedder.create_embeddings(batch)
+            for chunk in batch:
+                if "term_freqs" not in chunk:
+                    chunk["term_freqs"] = term_frequencies(chunk["text"])
+            insert_started = time.perf_counter()
+            async with in_transaction():
+                status = await Document.filter(id=doc.id).values_list("status", flat=True)
+                if not status:
+                    raise ValueError("文档已被删除")
+                if status[0] == DocumentStatus.DONE:
+                    raise DocumentDoneError(f"文档 {doc.id} 已入库完成")
+                await Chunk.bulk_create([
+                    Chunk(
+                        document_id=doc.id,
+                        text=chunk["text"],
+                        start_pos=chunk["start_pos"],
+                        end_pos=chunk["end_pos"],
+                        token_count=chunk["token_count"],
+                        term_freqs=chunk["term_freqs"],
+                        **embedding_fields(chunk["embedding"])
+                    )
+                    for chunk in batch
+                ])
+                # 本批新写入的id（按id顺序与插入顺序一一对应）
+                chunk_ids = await Chunk.filter(document_id=doc.id, id__gt=last_id).order_by("id").values_list("id", flat=True)
+            STAGE_SECONDS.observe(time.perf_counter() - insert_started, stage="db_insert")
+            last_id = chunk_ids[-1]
+            stored_ids.extend(chunk_ids)
+            vector_db.index.register_document(doc.id, doc.file_type, doc.upload_date)
+            async with vector_db.index.write_lock():
+                vector_db.index.add_document(doc.id, chunk_ids, [chunk["embedding"] for chunk in batch])
+            if vector_db.keyword_index is not None:
+                vector_db.keyword_index.add_document(doc.id, chunk_ids, [chunk["term_freqs"] for chunk in batch])
+            # 写库和加入索引之间文档可能被删除：删除接口先删文档再从索引移除，
+            # 加入索引之后文档仍在则删除接口随后会移除这些行，否则由这里清理
+            if not await Document.exists(id=doc.id):
+                raise ValueError("文档已被删除")
+
+            batch_tokens = sum(chunk["token_count"] for chunk in batch)
+            chunk_count += len(batch)
+            total_tokens += batch_tokens
+            CHUNKS_PROCESSED.inc(len(batch))
+            TOKENS_PROCESSED.inc(batch_tokens)
+            if on_progress and total:
+                await on_progress(DocumentStatus.EMBEDDING, chunk_count / total)
+
+        if not chunk_count:
+            raise ValueError("文档内容为空或无法解析")
+    except DocumentDoneError:
+        # 已由其他任务入库完成，只删除本次写入的片段，不动已完成的结果
+        await Chunk.filter(id__in=stored_ids).delete()
+        raise
+    except Exception:
+        # 出错时清理已写入的片段
+        await Chunk.filter(document_id=doc.id).delete()
+        async with vector_db.index.write_lock():
+            vector_db.index.remove_document(doc.id)
+        if vector_db.keyword_index is not None:
+            vector_db.keyword_index.remove_document(doc.id)
+        DOCUMENTS_INGESTED.inc(result="failed")
+        raise
+
+    doc.processed = True
+    doc.status = DocumentStatus.DONE
+    doc.progress = 1.0
+    doc.error = None
+    doc.chunk_count = chunk_count
+    doc.total_tokens = total_tokens
+    await doc.save()
+    DOCUMENTS_INGESTED.inc(result="done")
+
+
+class QueueFullError(Exception):
+    """入库队列积压已达上限"""
+
+
+class IngestionQueue:
+    """异步入库任务队列
+
+    上传的文件先落盘并立即返回任务id（即文档id），解析/分段在有界进程池中执行并把片段
+    写入暂存的JSONL文件，嵌入和写库在主进程中分批进行。任务状态保存在 Document 上，
+    任何worker都能查询。
+    """
+
+    ACTIVE_STATUSES = [DocumentStatus.QUEUED, DocumentStatus.PARSING, DocumentStatus.EMBEDDING]
+
+    def __init__(self, vector_db, workers: int = None, concurrency: int = None, max_backlog: int = None,
+                 embedding_cache=None):
+        self.vector_db = vector_db
+        self.embedding_cache = embedding_cache
+        self.workers = workers or int(os.getenv("INGEST_WORKERS", 2))
+        self.concurrency = concurrency or int(os.getenv("INGEST_CONCURRENCY", 2))
+        self.max_backlog = max_backlog or int(os.getenv("INGEST_MAX_BACKLOG", 100))
+        self.pending = 0
+        self._executor = None
+        self._semaphore = None
+        self._tasks = set()
+
+    @property
+    def full(self) -> bool:
+        return self.pending >= self.max_backlog
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_ingest_worker, initargs=(self.workers,)
+            )
+        return self._executor
+
+    def submit(self, document_id: int, path: str, force: bool = False):
+        """提交入库任务，积压达到上限时抛出 QueueFullError（force为True时不检查）"""
+        if self.full and not force:
+            raise QueueFullError("入库队列已满，请稍后重试")
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        self.pending += 1
+        task = asyncio.get_running_loop().create_task(self._run(document_id, path))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _update(self, document_id: int, **fields):
+        await Document.filter(id=document_id).update(**fields)
+
+    async def _run(self, document_id: int, path: str):
+        chunk_path = f"{path}.chunks.jsonl"
+        try:
+            async with self._semaphore:
+                doc = await Document.get_or_none(id=document_id)
+                if doc is None or doc.status == DocumentStatus.DONE:
+                    return
+
+                await self._update(document_id, status=DocumentStatus.PARSING, progress=0)
+                loop = asyncio.get_running_loop()
+                total, timings = await loop.run_in_executor(self._get_executor(), spool_chunks, path, document_id, chunk_path)
+                observe_parse_timings(timings)
+                await self._update(document_id, status=DocumentStatus.EMBEDDING, progress=0)
+
+                async def on_progress(status: DocumentStatus, progress: float):
+                    await self._update(document_id, status=status, progress=progress)
+
+                await store_chunks(doc, iter_spooled_chunks(chunk_path), self.vector_db,
+                                   total=total, on_progress=on_progress, embedding_cache=self.embedding_cache)
+        except Exception as e:
+            logger.error(f"文档 {document_id} 入库失败: {e}", exc_info=True)
+            await self._update(document_id, status=DocumentStatus.FAILED, error=str(e))
+        finally:
+            self.pending -= 1
+            for spooled in (path, chunk_path):
+                if os.path.exists(spooled):
+                    os.unlink(spooled)
+
+    async def ingest_bulk(self, files: List[Dict[str, Any]], batch_size: int = None) -> List[Dict[str, Any]]:
+        """批量导入已暂存的文件（spool_bulk_upload 的结果），返回与 files 顺序一致的逐文件结果
+
+        内容重复的文件不再处理，其余文件在一个事务中创建文档记录；解析和分段在进程池中并行，
+        先解析完的文档先进入共享的批次，多个文档的片段一起生成嵌入、在一个事务中写库。
+        某个文件解析失败只影响该文件，某一批嵌入或写库失败只影响这一批涉及的文档，
+        失败的文档与同步上传一样被删除。暂存文件在返回或出错后都会删除。
+        """
+        try:
+            return await self._ingest_bulk(files, batch_size or BULK_BATCH_SIZE)
+        finally:
+            for file in files:
+                for spooled in (file["path"], f"{file['path']}.chunks.jsonl"):
+                    if os.path.exists(spooled):
+                        os.unlink(spooled)
+
+    async def _ingest_bulk(self, files: List[Dict[str, Any]], batch_size: int) -> List[Dict[str, Any]]:
+        embedder = self.embedding_cache or self.vector_db
+        index, keyword_index = self.vector_db.index, self.vector_db.keyword_index
+        results = [{"filename": file["filename"], "status": None, "document_id": None, "chunk_count": 0,
+                    "error": None} for file in files]
+
+        # 与库中已有文档或本批中更早的文件内容相同的不再处理
+        existing = {}
+        hashes = list({file["content_hash"] for file in files})
+        for start in range(0, len(hashes), 500):
+            existing.update(await Document.filter(content_hash__in=hashes[start:start + 500])
+                            .exclude(status=DocumentStatus.FAILED).values_list("content_hash", "id"))
+        first, duplicates, docs = {}, {}, {}
+        for i, file in enumerate(files):
+            if file["content_hash"] in existing:
+                results[i].update(status="duplicate", document_id=existing[file["content_hash"]])
+            elif file["content_hash"] in first:
+                duplicates[i] = first[file["content_hash"]]
+            else:
+                first[file["content_hash"]] = i
+        async with in_transaction():
+            for i in first.values():
+                file = files[i]
+                docs[i] = await Document.create(filename=file["filename"][-255:], file_type=file["file_type"][:200],
+                                                size=file["size"], content_hash=file["content_hash"],
+                                                status=DocumentStatus.PARSING, owner=WORKER_ID)
+        position = {doc.id: i for i, doc in docs.items()}
+        state = {i: {"stored": 0, "tokens": 0, "last_id": 0} for i in docs}
+        failed = {}
+        buffer = []  # (文件下标, 片段)，可能来自多个文档
+
+        async def fail(targets: List[int], error: Exception):
+            ids = [docs[i].id for i in targets]
+            async with index.write_lock():
+                for i in targets:
+                    index.remove_document(docs[i].id)
+            for i in targets:
+                failed[i] = str(error)
+                if keyword_index is not None:
+                    keyword_index.remove_document(docs[i].id)
+            await Chunk.filter(document_id__in=ids).delete()
+            await Document.filter(id__in=ids).delete()
+            DOCUMENTS_INGESTED.inc(len(targets), result="failed")
+
+        async def flush():
+            batch = [(i, chunk) for i, chunk in buffer if i not in failed]
+            buffer.clear()
+            targets = list(dict.fromkeys(i for i, _ in batch))
+            if not batch:
+                return
+            try:
+                with STAGE_SECONDS.time(stage="embed"):
+                    await embedder.create_embeddings([chunk for _, chunk in batch])
+                insert_started = time.perf_counter()
+                async with in_transaction():
+                    present = set(await Document.filter(id__in=[docs[i].id for i in targets]).values_list("id", flat=True))
+                    gone = [i for i in targets if docs[i].id not in present]
+                    targets = [i for i in targets if docs[i].id in present]
+                    batch = [(i, chunk) for i, chunk in batch if docs[i].id in present]
+                    await Chunk.bulk_create([
+                        Chunk(
+                            document_id=docs[i].id,
+                            text=chunk["text"],
+                            start_pos=chunk["start_pos"],
+                            end_pos=chunk["end_pos"],
+                            token_count=chunk["token_count"],
+                            term_freqs=chunk["term_freqs"],
+                            **embedding_fields(chunk["embedding"])
+                        )
+                        for i, chunk in batch
+                    ])
+                    # 本批新写入的id：每个文档大于其上一批最后一个id的行，按id顺序与插入顺序一一对应
+                    rows = await Chunk.filter(document_id__in=[docs[i].id for i in targets],
+                                              id__gt=min(state[i]["last_id"] for i in targets) if targets else 0) \
+                        .order_by("id").values_list("id", "document_id")
+                STAGE_SECONDS.observe(time.perf_counter() - insert_started, stage="db_insert")
+            except Exception as e:
+                logger.error(f"批量导入的一批片段写入失败，涉及 {len(targets)} 个文档: {e}", exc_info=True)
+                await fail(targets, e)
+                return
+            if gone:
+                await fail(gone, ValueError("文档已被删除"))
+
+            chunk_ids = {i: [] for i in targets}
+            for chunk_id, document_id in rows:
+                i = position[document_id]
+                if chunk_id > state[i]["last_id"]:
+                    chunk_ids[i].append(chunk_id)
+            grouped = {i: [] for i in targets}
+            for i, chunk in batch:
+                grouped[i].append(chunk)
+            for i in targets:
+                index.register_document(docs[i].id, docs[i].file_type, docs[i].upload_date)
+            async with index.write_lock():
+                index.add_documents([(docs[i].id, chunk_ids[i], [chunk["embedding"] for chunk in grouped[i]])
+                                     for i in targets])
+            for i in targets:
+                if keyword_index is not None:
+                    keyword_index.add_document(docs[i].id, chunk_ids[i], [chunk["term_freqs"] for chunk in grouped[i]])
+                state[i]["stored"] += len(grouped[i])
+                state[i]["tokens"] += sum(chunk["token_count"] for chunk in grouped[i])
+                state[i]["last_id"] = chunk_ids[i][-1]
+            # 与 store_chunks 相同：加入索引之后再确认文档仍在，期间被删除的文档由这里清理
+            present = set(await Document.filter(id__in=[docs[i].id for i in targets]).values_list("id", flat=True))
+            gone = [i for i in targets if docs[i].id not in present]
+            if gone:
+                await fail(gone, ValueError("文档已被删除"))
+                targets = [i for i in targets if docs[i].id in present]
+                batch = [(i, chunk) for i, chunk in batch if docs[i].id in present]
+            CHUNKS_PROCESSED.inc(len(batch))
+            TOKENS_PROCESSED.inc(sum(chunk["token_count"] for _, chunk in batch))
+
+            # 片段已全部写入的文档标记为完成
+            done = [i for i in targets if state[i]["stored"] == state[i].get("total")]
+            if done:
+                async with in_transaction():
+                    for i in done:
+                        await Document.filter(id=docs[i].id).update(
+                            processed=True, status=DocumentStatus.DONE, progress=1.0, error=None,
+                            chunk_count=state[i]["stored"], total_tokens=state[i]["tokens"])
+                DOCUMENTS_INGESTED.inc(len(done), result="done")
+
+        loop = asyncio.get_running_loop()
+        executor = self._get_executor()
+        # 进程池的队列是先进先出的，限制同时提交的文件数，后台入库任务不必排在整批导入之后
+        window = asyncio.Semaphore(self.workers * 2)
+        chunk_paths = {i: f"{files[i]['path']}.chunks.jsonl" for i in docs}
+
+        async def parse(i: int):
+            async with window:
+                try:
+                    return i, await loop.run_in_executor(executor, spool_chunks, files[i]["path"], docs[i].id,
+                                                         chunk_paths[i]), None
+                except Exception as e:
+                    return i, None, e
+
+        tasks = [asyncio.ensure_future(parse(i)) for i in docs]
+        try:
+            for future in asyncio.as_completed(tasks):
+                i, parsed, error = await future
+                if error is None and not parsed[0]:
+                    error = ValueError("文档内容为空或无法解析")
+                if error is not None:
+                    await fail([i], error)
+                    continue
+                state[i]["total"], timings = parsed
+                observe_parse_timings(timings)
+                chunks = iter_spooled_chunks(chunk_paths[i])
+                try:
+                    while i not in failed:
+                        size = batch_size - len(buffer)
+                        part = await asyncio.to_thread(lambda: list(islice(chunks, size)))
+                        if not part:
+                            break
+                        buffer.extend((i, chunk) for chunk in part)
+                        if len(buffer) >= batch_size:
+                            await flush()
+                finally:
+                    chunks.close()
+            await flush()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        for i, doc in docs.items():
+            if i in failed:
+                results[i].update(status="failed", error=failed[i])
+            else:
+                results[i].update(status="done", document_id=doc.id, chunk_count=state[i]["stored"])
+        for i, original in duplicates.items():
+            if original in failed:
+                results[i].update(status="failed", error=failed[original])
+            else:
+                results[i].update(status="duplicate", document_id=docs[original].id)
+        return results
+
+    async def recover(self):
+        """启动时重新提交未完成的任务，暂存文件已丢失的标记为失败
+
+        多个worker同时启动时都会看到这些任务：处理者仍在运行的跳过，其余的按读到的状态和处理者
+        做条件更新来认领，只有更新到1行的worker提交，每个任务只处理一次。
+        """
+        for doc in await Document.filter(status__in=self.ACTIVE_STATUSES):
+            if owner_alive(doc.owner):
+                continue
+            claim = Document.filter(id=doc.id, status=doc.status, owner=doc.owner)
+            path = spool_path(doc.id, doc.filename)
+            if os.path.exists(path):
+                if await claim.update(status=DocumentStatus.QUEUED, progress=0, owner=WORKER_ID) == 1:
+                    self.submit(doc.id, path, force=True)
+            else:
+                await claim.update(status=DocumentStatus.FAILED, error="服务重启时暂存文件已丢失", owner=WORKER_ID)
+        await self._discard_failed_chunks()
+
+    async def _discard_failed_chunks(self, batch_size: int = 500):
+        """删除失败文档残留的片段，并从启动时已加载的索引中移除
+
+        批量导入按批提交片段，中途重启时已写入的批次所属的文档在上面被标记为失败，片段需要一并清理。
+        """
+        index, keyword_index = self.vector_db.index, self.vector_db.keyword_index
+        failed = await Document.filter(status=DocumentStatus.FAILED).values_list("id", flat=True)
+        for start in range(0, len(failed), batch_size):
+            orphaned = await Chunk.filter(document_id__in=failed[start:start + batch_size]).distinct() \
+                .values_list("document_id", flat=True)
+            if not orphaned:
+                continue
+            await Chunk.filter(document_id__in=orphaned).delete()
+            async with index.write_lock():
+                for document_id in orphaned:
+                    index.remove_document(document_id)
+            if keyword_index is not None:
+                for document_id in orphaned:
+                    keyword_index.remove_document(document_id)
+            logger.warning(f"已删除 {len(orphaned)} 个失败文档残留的片段: {orphaned}")
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+        # 同步入库在主进程中解析，可能创建过页级进程池
+        if _parser is not None:
+            _parser.close()
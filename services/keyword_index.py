@@ -0,0 +1,271 @@
+import os
+import math
+import time
+import logging
+import numpy as np
+from array import array
+from collections import Counter
+from typing import Dict, List, Optional, Sequence, Tuple
+from models.chunk import Chunk
+from services.term_tokenizer import is_cjk_character, tokenize_terms
+
+logger = logging.getLogger(__name__)
+
+
+def term_frequencies(text: str) -> Dict[str, int]:
+    """片段的词频，入库时随片段一起保存，启动时据此重建倒排索引"""
+    return dict(Counter(tokenize_terms(text)))
+
+
+class BM25Index:
+    """常驻内存的BM25倒排索引
+
+    每个片段占一个槽位（slot），词项的倒排表是紧凑的 (槽位, 词频) 数组，入库时增量追加。
+    删除文档只把槽位标记为失效，失效槽位超过一定比例后整体压缩。
+    查询只读取问题中各词项的倒排表，耗时与命中的倒排项数量成正比，与语料规模无关。
+
+    倒排表以 numpy 视图直接读取 array 缓冲区，查询和增删都必须在事件循环线程中进行。
+    """
+
+    def __init__(self, k1: float = None, b: float = None):
+        self.k1 = k1 if k1 is not None else float(os.getenv("BM25_K1", 1.2))
+        self.b = b if b is not None else float(os.getenv("BM25_B", 0.75))
+        self.loaded = False
+        self._reset()
+
+    def _reset(self):
+        self.postings = {}  # 词项 -> (array('i') 槽位, array('f') 词频)
+        self.slot_chunk_ids = array("q")
+        self.slot_document_ids = array("q")
+        self.slot_lengths = array("f")
+        self.alive = bytearray()
+        self.document_slots = {}  # 文档id -> [槽位]
+        self.live_count = 0
+        self.dead_count = 0
+        self.total_length = 0.0
+
+    def __len__(self) -> int:
+        return self.live_count
+
+    async def load(self, batch_size: int = 5000):
+        """从数据库分批读取片段词频构建索引，缺少词频的旧片段按原文现场分词"""
+        self._reset()
+        last_id = 0
+        while True:
+            rows = await Chunk.filter(id__gt=last_id, term_freqs__isnull=False).order_by("id").limit(batch_size) \
+                .values_list("id", "document_id", "term_freqs")
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            for chunk_id, document_id, freqs in rows:
+                self._add_chunk(document_id, chunk_id, freqs)
+
+        legacy = last_id = 0
+        while True:
+            rows = await Chunk.filter(id__gt=last_id, term_freqs__isnull=True).order_by("id").limit(batch_size) \
+                .values_list("id", "document_id", "text")
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            for chunk_id, document_id, text in rows:
+                self._add_chunk(document_id, chunk_id, term_frequencies(text))
+            legacy += len(rows)
+        if legacy:
+            logger.warning(f"{legacy} 个片段没有保存词频，已按原文分词；运行 migrate_db.py 可回填")
+        self.loaded = True
+        logger.info(f"关键词索引已加载: {self.live_count} 个片段, {len(self.postings)} 个词项")
+
+    def add_document(self, document_id: int, chunk_ids: Sequence[int], term_freqs: Sequence[Dict[str, int]]):
+        """增量加入一个文档的片段词频"""
+        for chunk_id, freqs in zip(chunk_ids, term_freqs):
+            self._add_chunk(document_id, chunk_id, freqs)
+
+    def _add_chunk(self, document_id: int, chunk_id: int, freqs: Dict[str, int]):
+        slot = len(self.slot_chunk_ids)
+        length = float(sum(freqs.values()))
+        self.slot_chunk_ids.append(chunk_id)
+        self.slot_document_ids.append(document_id)
+        self.slot_lengths.append(length)
+        self.alive.append(1)
+        self.document_slots.setdefault(document_id, []).append(slot)
+        self.live_count += 1
+        self.total_length += length
+        for term, tf in freqs.items():
+            entry = self.postings.get(term)
+            if entry is None:
+                entry = self.postings[term] = (array("i"), array("f"))
+            entry[0].append(slot)
+            entry[1].append(tf)
+
+    def remove_document(self, document_id: int):
+        """把文档的所有槽位标记为失效，失效槽位过多时压缩倒排表"""
+        slots = self.document_slots.pop(document_id, None)
+        if not slots:
+            return
+        for slot in slots:
+            self.alive[slot] = 0
+            self.total_length -= self.slot_lengths[slot]
+        self.live_count -= len(slots)
+        self.dead_count += len(slots)
+        if self.dead_count > max(1000, self.live_count // 4):
+            self._compact()
+
+    def _compact(self):
+        """丢弃失效槽位并重新编号"""
+        alive = np.frombuffer(self.alive, dtype=np.uint8).astype(bool)
+        remap = np.cumsum(alive, dtype=np.int64) - 1
+        postings = {}
+        for term, (slots, tfs) in self.postings.items():
+            slots_np = np.frombuffer(slots, dtype=np.int32)
+            keep = alive[slots_np]
+            if keep.any():
+                postings[term] = (array("i", remap[slots_np[keep]].astype(np.int32).tobytes()),
+                                  array("f", np.frombuffer(tfs, dtype=np.float32)[keep].tobytes()))
+        self.postings = postings
+        self.slot_chunk_ids = array("q", np.frombuffer(self.slot_chunk_ids, dtype=np.int64)[alive].tobytes())
+        self.slot_document_ids = array("q", np.frombuffer(self.slot_document_ids, dtype=np.int64)[alive].tobytes())
+        self.slot_lengths = array("f", np.frombuffer(self.slot_lengths, dtype=np.float32)[alive].tobytes())
+        self.document_slots = {document_id: remap[slots].tolist() for document_id, slots in self.document_slots.items()}
+        self.alive = bytearray(b"\x01" * len(self.slot_chunk_ids))
+        self.dead_count = 0
+
+    def _query_postings(self, question: str) -> List[Tuple[str, int, np.ndarray, np.ndarray, int]]:
+        """问题中各词项的 (词项, 问题中的词频, 槽位, 词频, 文档频率)；倒排表按槽位升序，可能含失效槽位"""
+        alive = np.frombuffer(self.alive, dtype=np.uint8)
+        postings = []
+        for term, query_tf in Counter(tokenize_terms(question)).items():
+            entry = self.postings.get(term)
+            if entry is None:
+                continue
+            slots = np.frombuffer(entry[0], dtype=np.int32)
+            df = int(np.count_nonzero(alive[slots])) if self.dead_count else len(slots)
+            if df:
+                postings.append((term, query_tf, slots, np.frombuffer(entry[1], dtype=np.float32), df))
+        return postings
+
+    def _score(self, postings: list, slots: np.ndarray = None) -> Tuple[np.ndarray, np.ndarray]:
+        """BM25得分：slots为None时对命中任一词项的全部存活槽位打分；否则只对给定的槽位（升序、存活）打分，
+        每个词项二分查找这些槽位，耗时与槽位数成正比而与词项的倒排表长度无关"""
+        lengths = np.frombuffer(self.slot_lengths, dtype=np.float32)
+        average_length = self.total_length / self.live_count or 1.0
+
+        def weight(query_tf, df, tfs, slot_lengths):
+            idf = math.log(1 + (self.live_count - df + 0.5) / (df + 0.5))
+            norm = self.k1 * (1 - self.b + self.b * slot_lengths / average_length)
+            return query_tf * idf * tfs * (self.k1 + 1) / (tfs + norm)
+
+        if slots is not None:
+            scores = np.zeros(len(slots), dtype=np.float32)
+            for _, query_tf, term_slots, tfs, df in postings:
+                positions = np.minimum(np.searchsorted(term_slots, slots), len(term_slots) - 1)
+                hit = term_slots[positions] == slots
+                scores[hit] += weight(query_tf, df, tfs[positions[hit]], lengths[slots[hit]])
+            return slots, scores
+
+        alive = np.frombuffer(self.alive, dtype=np.uint8)
+        part_slots, part_scores = [], []
+        for _, query_tf, term_slots, tfs, df in postings:
+            if self.dead_count:
+                keep = alive[term_slots].astype(bool)
+                term_slots, tfs = term_slots[keep], tfs[keep]
+            part_slots.append(term_slots)
+            part_scores.append(weight(query_tf, df, tfs, lengths[term_slots]))
+        if not part_slots:
+            return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.float32)
+        slots, inverse = np.unique(np.concatenate(part_slots), return_inverse=True)
+        return slots, np.bincount(inverse, weights=np.concatenate(part_scores)).astype(np.float32)
+
+    def _in_documents(self, slots: np.ndarray, document_ids: Optional[np.ndarray]) -> np.ndarray:
+        if document_ids is None:
+            return np.ones(len(slots), dtype=bool)
+        return np.isin(np.frombuffer(self.slot_document_ids, dtype=np.int64)[slots], document_ids)
+
+    def candidates(self, question: str, document_ids: np.ndarray = None) -> Tuple[np.ndarray, np.ndarray]:
+        """返回包含任一查询词项的片段 (chunk_id数组, BM25得分数组)，只访问这些词项的倒排表
+
+        document_ids 不为None时只保留这些文档的片段（IDF仍按全部语料计算）。
+        """
+        if not self.live_count:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        slots, scores = self._score(self._query_postings(question))
+        keep = self._in_documents(slots, document_ids)
+        return np.frombuffer(self.slot_chunk_ids, dtype=np.int64)[slots[keep]], scores[keep]
+
+    def selective_candidates(self, question: str, max_postings: int, min_results: int = 0,
+                             document_ids: np.ndarray = None) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        """只用少见词项选出候选片段，返回 (chunk_id数组, BM25得分数组)，没有足够少见的词项时返回None
+
+        词项（不含CJK单字）按文档频率从低到高选取，倒排表总长不超过 max_postings；候选的得分
+        仍按问题的全部词项计算，常见词项只在候选槽位上查找。候选少于 min_results 个（如只有一个
+        片段含有的编号）时，用完整BM25排名的前 min_results 个补足。
+        """
+        if not self.live_count:
+            return None
+        postings = self._query_postings(question)
+        chosen, total = [], 0
+        for entry in sorted((entry for entry in postings if not is_cjk_character(entry[0])), key=lambda entry: entry[4]):
+            if total + entry[4] > max_postings:
+                break
+            chosen.append(entry)
+            total += entry[4]
+        if not chosen:
+            return None
+        slots = np.unique(np.concatenate([entry[2] for entry in chosen]))
+        if self.dead_count:
+            slots = slots[np.frombuffer(self.alive, dtype=np.uint8)[slots].astype(bool)]
+        slots = slots[self._in_documents(slots, document_ids)]
+        if len(slots) < min_results:
+            all_slots, all_scores = self._score(postings)
+            keep = self._in_documents(all_slots, document_ids)
+            all_slots, all_scores = all_slots[keep], all_scores[keep]
+            if len(all_slots) > min_results:
+                all_slots = all_slots[np.argpartition(-all_scores, min_results - 1)[:min_results]]
+            slots = np.union1d(slots, all_slots)
+        slots, scores = self._score(postings, slots)
+        return np.frombuffer(self.slot_chunk_ids, dtype=np.int64)[slots], scores
+
+    def search(self, question: str, top_k: int = 5, stats: dict = None,
+               document_ids: np.ndarray = None) -> List[Tuple[int, float]]:
+        """纯关键词检索，返回按BM25得分排序的 (chunk_id, 得分)；document_ids 限定检索范围"""
+        started = time.perf_counter()
+        chunk_ids, scores = self.candidates(question, document_ids)
+        hits = top_hits(chunk_ids, scores, top_k)
+        if stats is not None:
+            stats.update({
+                "backend": "bm25",
+                "candidates": len(chunk_ids),
+                "total": self.live_count,
+                "elapsed_ms": round((time.perf_counter() - started) * 1000, 3),
+            })
+        return hits
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "chunks": self.live_count,
+            "terms": len(self.postings),
+            "postings": sum(len(slots) for slots, _ in self.postings.values()),
+            "dead_slots": self.dead_count,
+        }
+
+
+def top_hits(chunk_ids: np.ndarray, scores: np.ndarray, top_k: int) -> List[Tuple[int, float]]:
+    """argpartition 取得分最高的k个并排序"""
+    k = min(top_k, len(scores))
+    if k <= 0:
+        return []
+    top = np.argpartition(-scores, k - 1)[:k] if k < len(scores) else np.arange(len(scores))
+    top = top[np.argsort(-scores[top], kind="stable")]
+    return list(zip(chunk_ids[top].tolist(), scores[top].tolist()))
+
+
+def create_keyword_index() -> Optional[BM25Index]:
+    """RETRIEVAL_MODE 为 bm25 或 hybrid 时创建关键词索引，纯向量检索不占用这部分内存"""
+    mode = retrieval_mode()
+    return BM25Index() if mode in ("bm25", "hybrid") else None
+
+
+def retrieval_mode() -> str:
+    mode = os.getenv("RETRIEVAL_MODE", "vector").lower()
+    if mode not in ("vector", "bm25", "hybrid"):
+        raise ValueError(f"不支持的检索模式: {mode}")
+    return mode
@@ -0,0 +1,42 @@
+import os
+import httpx
+import logging
+from typing import Optional, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI
+
+logger = logging.getLogger(__name__)
+
+
+def create_llm_client() -> Optional["AsyncOpenAI"]:
+    """创建进程内共享的异步大模型客户端，未配置API密钥时返回None
+
+    所有请求复用同一个连接池（保持长连接，省去每次握手），
+    超时和重试次数可通过环境变量调整。openai 包在这里才导入（约0.7秒），不计入启动时间。
+    """
+    api_key = os.getenv("OPENAI_API_KEY")
+    if not api_key:
+        logger.warning("未配置 OPENAI_API_KEY 环境变量，问答接口无法调用大模型")
+        return None
+    from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+
+    timeout = httpx.Timeout(
+        float(os.getenv("LLM_TIMEOUT", 60)),
+        connect=float(os.getenv("LLM_CONNECT_TIMEOUT", 5))
+    )
+    http_client = DefaultAsyncHttpxClient(
+        limits=httpx.Limits(
+            max_connections=int(os.getenv("LLM_MAX_CONNECTIONS", 100)),
+            max_keepalive_connections=int(os.getenv("LLM_MAX_KEEPALIVE", 20)),
+            keepalive_expiry=float(os.getenv("LLM_KEEPALIVE_EXPIRY", 30))
+        ),
+        timeout=timeout
+    )
+    return AsyncOpenAI(
+        api_key=api_key,
+        base_url=os.getenv("OPENAI_API_BASE_URL"),
+        timeout=timeout,
+        max_retries=int(os.getenv("LLM_MAX_RETRIES", 2)),
+        http_client=http_client
+    )
@@ -0,0 +1,225 @@
+"""进程内的Prometheus指标：计数器、仪表和直方图，/metrics 以文本格式导出
+
+每次记录只是加锁后更新几个数字（直方图多一次二分查找），开销在微秒级，可以常开。
+多个worker进程各自统计，由Prometheus按实例分别抓取后汇总。
+"""
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, Iterator, List, Sequence, Tuple
+
+# 从毫秒级的检索到分钟级的大文件解析都能分辨
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+Samples = List[Tuple[Dict[str, str], float]]
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels.items()) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Registry:
+    """按注册顺序导出所有指标"""
+
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            if any(existing.name == metric.name for existing in self._metrics):
+                raise ValueError(f"指标重复注册: {metric.name}")
+            self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in list(self._metrics):
+            lines.append(f"# HELP {metric.name} {_escape(metric.documentation)}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for suffix, labels, value in metric.samples():
+                lines.append(f"{metric.name}{suffix}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class _Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), registry: Registry = None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        (registry or REGISTRY).register(self)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        if len(labels) != len(self.labelnames) or any(name not in labels for name in self.labelnames):
+            raise ValueError(f"{self.name} 的标签应为 {self.labelnames}，实际为 {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _labels(self, key: Tuple[str, ...]) -> Dict[str, str]:
+        return dict(zip(self.labelnames, key))
+
+    def samples(self) -> Iterable[Tuple[str, Dict[str, str], float]]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    """只增不减的计数器"""
+    type = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # 没有标签的计数器从0开始导出
+        self._values = {} if self.labelnames else {(): 0}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        return [("", self._labels(key), value) for key, value in values]
+
+
+class Gauge(_Metric):
+    """可增可减的当前值；也可以给定回调，抓取时读取（如索引大小）"""
+    type = "gauge"
+
+    def __init__(self, *args, function: Callable[[], float] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values = {}
+        self._function = function
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        if self._function is not None:
+            return [("", {}, self._function())]
+        with self._lock:
+            values = list(self._values.items())
+        return [("", self._labels(key), value) for key, value in values]
+
+
+class CallbackMetric(_Metric):
+    """抓取时由回调给出全部样本 [(标签, 值)]，用于导出各组件已有的统计（如缓存命中数）"""
+
+    def __init__(self, name: str, documentation: str, metric_type: str, callback: Callable[[], Samples],
+                 registry: Registry = None):
+        self.type = metric_type
+        self._callback = callback
+        super().__init__(name, documentation, registry=registry)
+
+    def samples(self):
+        return [("", labels, value) for labels, value in self._callback()]
+
+
+class Histogram(_Metric):
+    """累积分桶的直方图，额外导出总和与次数"""
+    type = "histogram"
+
+    def __init__(self, *args, buckets: Sequence[float] = DEFAULT_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}  # 标签值 -> [各桶计数（非累积）, 总和, 次数]
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        """记录代码块的耗时"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        with self._lock:
+            series = [(key, list(counts), total, count) for key, (counts, total, count) in self._series.items()]
+        result = []
+        for key, counts, total, count in series:
+            labels = self._labels(key)
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                result.append(("_bucket", {**labels, "le": _format_value(bound)}, cumulative))
+            result.append(("_sum", labels, total))
+            result.append(("_count", labels, count))
+        return result
+
+
+def timed_iter(iterable: Iterable, timings: Dict[str, float], stage: str) -> Iterator:
+    """把推进迭代器花费的时间累加到 timings[stage]，用于交织执行的生成器各自计时"""
+    iterator = iter(iterable)
+    while True:
+        started = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - started
+            return
+        timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - started
+        yield item
+
+
+# ---- 应用的指标 ----
+
+# 入库：clean / chunk / terms 为单个文件的累计耗时，embed / db_insert 为每批的耗时；
+# 查询：search / context_build / llm_first_token / llm_total 为单次问答的耗时
+STAGE_SECONDS = Histogram("kbserve_stage_seconds", "各处理阶段的耗时（秒）", ("stage",))
+PARSE_SECONDS = Histogram("kbserve_parse_seconds", "单个文件的解析耗时（秒，含OCR）", ("file_type",))
+HTTP_REQUEST_SECONDS = Histogram("kbserve_http_request_seconds", "HTTP请求耗时（秒）", ("method", "route", "status"))
+CHUNKS_PROCESSED = Counter("kbserve_chunks_processed_total", "已入库的片段数")
+TOKENS_PROCESSED = Counter("kbserve_tokens_processed_total", "已入库的token数")
+DOCUMENTS_INGESTED = Counter("kbserve_documents_ingested_total", "入库完成的文档数", ("result",))
+PDF_PAGES = Counter("kbserve_pdf_pages_total", "解析的PDF页数", ("ocr",))
+STARTUP_SECONDS = Gauge("kbserve_startup_seconds", "启动各阶段的耗时（秒）", ("phase",))
+
+
+def observe_parse_timings(timings: Dict[str, float]):
+    """记录 iter_document_chunks 收集的单个文件各阶段耗时"""
+    if "parse" in timings:
+        PARSE_SECONDS.observe(timings["parse"], file_type=timings.get("file_type", "unknown"))
+    for stage in ("clean", "chunk", "terms"):
+        if stage in timings:
+            STAGE_SECONDS.observe(timings[stage], stage=stage)
+    for ocr in ("true", "false"):
+        pages = timings.get(f"pages_ocr_{ocr}")
+        if pages:
+            PDF_PAGES.inc(pages, ocr=ocr)
@@ -0,0 +1,501 @@
+"""多worker共享的内存映射向量索引
+
+多worker部署时，常驻内存的 VectorIndex 在每个worker里各有一份向量矩阵，内存随worker数线性增长，
+而且一个worker入库的文档其他worker要等重启才看得到。MmapVectorIndex 把矩阵放在 VECTOR_INDEX_DIR
+下的文件中，各worker只读映射（mmap），同一台机器上通过页缓存共享一份物理内存。
+
+目录内容：
+    manifest.json        当前版本：段名、行数、维度、文档日志长度、每维非零行数等，写临时文件后原子替换
+    version              8字节的版本号，各worker映射后在每次检索前比较，变化时才重新读取 manifest
+    writer.lock          写入锁（fcntl.flock），同一时刻只有一个进程写入
+    <段>.vectors         按行追加的归一化float32矩阵
+    <段>.chunk_ids       与矩阵行对应的chunk id（int64）
+    <段>.document_ids    与矩阵行对应的文档id（int64）
+    <段>.documents       文档事件日志（每行一个JSON）：登记文件类型和上传时间，或删除文档
+
+写入方持锁先同步到最新版本，追加数据后再发布新的 manifest；读取方只映射 manifest 记录的行数，
+不会读到写了一半的数据。删除文档只在日志中追加一条删除事件，对应的行在读取方标记为失效，
+失效行超过 VECTOR_INDEX_COMPACT_RATIO 后由后台线程写一个只含有效行的新段替换旧段。
+在事件循环中写入前先 async with write_lock()，在线程中等待写入锁，不阻塞其他请求。
+依赖 fcntl，只支持 Linux / macOS。
+"""
+import os
+import json
+import mmap
+import fcntl
+import asyncio
+import logging
+import threading
+import contextlib
+import numpy as np
+from typing import Dict, Optional, Sequence, Tuple
+from models.chunk import Chunk
+from services.vector_index import VectorIndex, normalize_rows, iter_embedding_batches, load_document_meta, _timestamp
+
+logger = logging.getLogger(__name__)
+
+FORMAT_VERSION = 1
+MANIFEST = "manifest.json"
+VERSION_FILE = "version"
+LOCK_FILE = "writer.lock"
+SEGMENT_PREFIX = "segment-"
+# 每个段由这三个等长的数组文件组成
+ARRAYS = (("vectors", np.float32), ("chunk_ids", np.int64), ("document_ids", np.int64))
+
+
+def default_directory() -> str:
+    return os.getenv("VECTOR_INDEX_DIR", "./vector_index")
+
+
+def invalidate(directory: str = None) -> bool:
+    """删除 manifest，下次启动时从数据库重建；重新生成向量后调用（需先停止服务）"""
+    try:
+        os.remove(os.path.join(directory or default_directory(), MANIFEST))
+    except FileNotFoundError:
+        return False
+    return True
+
+
+class MmapVectorIndex(VectorIndex):
+    """向量矩阵放在内存映射文件中、多个进程共享的精确检索索引
+
+    检索逻辑与 VectorIndex 相同，matrix / chunk_ids / document_ids 是文件的只读映射；
+    alive 标记每行是否有效（所属文档未被删除），检索时跳过失效行。
+    refresh() 在检索前调用，其他进程发布了新版本时重新映射并递增 generation。
+    """
+
+    def __init__(self, directory: str = None, compact_ratio: float = None):
+        super().__init__()
+        self.directory = directory or default_directory()
+        self.compact_ratio = compact_ratio if compact_ratio is not None else \
+            float(os.getenv("VECTOR_INDEX_COMPACT_RATIO", 0.2))
+        self.alive = np.ones(0, dtype=bool)
+        self.dead_rows = 0
+        self.version = 0  # 已映射的 manifest 版本
+        self.manifest = None
+        self._version_map = None
+        self._pending_documents = {}  # register_document 登记、尚未写入日志的文档元数据
+        self._changes = _empty_changes()  # 其他进程写入、尚未被 refresh() 取走的变化
+        self._lock = threading.RLock()
+        self._lock_held = False  # write_lock() 已取得文件锁
+        self._compacting = None  # 后台压缩线程
+
+    def __len__(self) -> int:
+        return len(self.chunk_ids) - self.dead_rows
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    # ---- 读取方 ----
+
+    def _published_version(self) -> int:
+        """映射版本号文件，之后每次读取不需要系统调用"""
+        if self._version_map is None:
+            try:
+                with open(self._path(VERSION_FILE), "rb") as f:
+                    self._version_map = mmap.mmap(f.fileno(), 8, access=mmap.ACCESS_READ)
+            except (FileNotFoundError, ValueError):
+                return 0
+        return int.from_bytes(self._version_map[:8], "little")
+
+    def _read_manifest(self) -> Optional[dict]:
+        try:
+            with open(self._path(MANIFEST), encoding="utf-8") as f:
+                manifest = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        return manifest if manifest.get("format") == FORMAT_VERSION else None
+
+    def _map(self, segment: str, kind: str, dtype, shape: tuple) -> np.ndarray:
+        path = self._path(f"{segment}.{kind}")
+        if not shape[0]:
+            return np.zeros(shape, dtype=dtype)
+        return np.asarray(np.memmap(path, dtype=dtype, mode="r", shape=shape))
+
+    def _read_events(self, segment: str, start: int, end: int) -> list:
+        if end <= start:
+            return []
+        with open(self._path(f"{segment}.documents"), "rb") as f:
+            f.seek(start)
+            data = f.read(end - start)
+        return [json.loads(line) for line in data.decode("utf-8").splitlines() if line]
+
+    def _apply(self, manifest: dict, record: bool):
+        """映射 manifest 描述的版本；record 为True时记下与当前版本相比的变化（来自其他进程的写入）
+
+        先在局部变量中构建新状态，全部成功后再替换，读取中途段被删除（FileNotFoundError）时保持原状态。
+        """
+        segment, rows, dim = manifest["segment"], manifest["rows"], manifest["dim"]
+        same_segment = self.manifest is not None and segment == self.manifest["segment"]
+        matrix = self._map(segment, "vectors", np.float32, (rows, dim))
+        chunk_ids = self._map(segment, "chunk_ids", np.int64, (rows,))
+        document_ids = self._map(segment, "document_ids", np.int64, (rows,))
+        if same_segment:
+            documents, start = dict(self.documents), self.manifest["documents_bytes"]
+            alive = np.concatenate([self.alive, np.ones(rows - len(self.alive), dtype=bool)])
+        else:
+            # 重建或压缩后的新段，从头读取文档日志
+            documents, start = {}, 0
+            alive = np.ones(rows, dtype=bool)
+        removed = set()
+        for event in self._read_events(segment, start, manifest["documents_bytes"]):
+            if event.get("deleted"):
+                documents.pop(event["id"], None)
+                upto = event["rows"]
+                alive[:upto] &= document_ids[:upto] != event["id"]
+                removed.add(event["id"])
+            else:
+                documents[event["id"]] = (event["file_type"], event["uploaded"])
+
+        if record:
+            if same_segment:
+                added = chunk_ids[len(self.alive):][alive[len(self.alive):]]
+            else:
+                removed = set(self.documents) - set(documents)
+                added = np.setdiff1d(chunk_ids[alive], self.chunk_ids[self.alive])
+            self._changes["removed"] |= removed
+            if len(added):
+                self._changes["chunk_ids"].append(np.array(added))
+
+        self.matrix, self.chunk_ids, self.document_ids = matrix, chunk_ids, document_ids
+        self.alive = alive
+        self.dead_rows = int(rows - np.count_nonzero(alive))
+        self.nonzero_counts = np.asarray(manifest["nonzero_counts"], dtype=np.int64)
+        self.documents = documents
+        self._document_table = None
+        self.manifest = manifest
+        self.version = manifest["version"]
+        self.generation += 1
+
+    def _sync(self, record: bool = True) -> bool:
+        """映射最新发布的版本，返回是否有变化"""
+        for _ in range(3):
+            manifest = self._read_manifest()
+            if manifest is None or manifest["version"] == self.version:
+                return False
+            try:
+                self._apply(manifest, record)
+                return True
+            except FileNotFoundError:
+                # 读到 manifest 后旧段恰好被压缩替换，重新读取
+                continue
+        logger.warning("共享向量索引同步失败，继续使用当前版本")
+        return False
+
+    def refresh(self) -> Optional[dict]:
+        """其他进程发布了新版本时重新映射，返回其间新增的片段id和删除的文档id，没有变化时返回None
+
+        版本号来自映射的8字节文件，没有变化时开销只是一次内存读取。
+        """
+        if not self.loaded:
+            return None
+        with self._lock:
+            if self._published_version() != self.version:
+                self._sync()
+            if not self._changes["removed"] and not self._changes["chunk_ids"]:
+                return None
+            changes, self._changes = self._changes, _empty_changes()
+        changes["chunk_ids"] = np.concatenate(changes["chunk_ids"]) if changes["chunk_ids"] else \
+            np.zeros(0, dtype=np.int64)
+        return changes
+
+    def read_view(self) -> "MmapVectorIndex":
+        # 重新映射在锁内整体替换矩阵、id和失效标记
+        with self._lock:
+            return super().read_view()
+
+    # ---- 检索：跳过失效行 ----
+
+    def _top_k(self, scores: np.ndarray, rows: Optional[np.ndarray], top_k: int):
+        if rows is None and self.dead_rows:
+            # 全部行打分时（包括批量检索），失效行的得分置为负无穷，且k不超过有效行数
+            scores[~self.alive] = -np.inf
+            top_k = min(top_k, len(self))
+        return super()._top_k(scores, rows, top_k)
+
+    def _exact(self, query: Optional[np.ndarray], rows: Optional[np.ndarray], top_k: int):
+        if rows is not None and self.dead_rows:
+            # 文档id被复用或关键词候选来自已删除的文档时，行号中可能有失效行
+            rows = rows[self.alive[rows]]
+        return super()._exact(query, rows, top_k)
+
+    # ---- 写入方 ----
+
+    @contextlib.asynccontextmanager
+    async def write_lock(self):
+        """在线程中等待写入锁，其他进程持锁（重建、压缩）时不阻塞事件循环；持锁期间 _writer 不再重复加锁
+
+        锁内只能做同步的写入，不能 await，否则同一进程中的其他协程会绕过文件锁写入。
+        """
+        with open(self._path(LOCK_FILE), "a") as lock_file:
+            await asyncio.to_thread(fcntl.flock, lock_file, fcntl.LOCK_EX)
+            self._lock_held = True
+            try:
+                yield
+            finally:
+                self._lock_held = False
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @contextlib.contextmanager
+    def _writer(self):
+        """持有写入锁并同步到最新版本；本进程内的写入也串行进行"""
+        with self._lock, contextlib.ExitStack() as stack:
+            if not self._lock_held:
+                lock_file = stack.enter_context(open(self._path(LOCK_FILE), "a"))
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                stack.callback(fcntl.flock, lock_file, fcntl.LOCK_UN)
+            self._sync()
+            yield
+
+    def _write_at(self, name: str, offset: int, data: bytes):
+        """从offset处写入并截掉之后的内容（上次写入中断留下的、未发布的数据）"""
+        fd = os.open(self._path(name), os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            os.pwrite(fd, data, offset)
+            os.ftruncate(fd, offset + len(data))
+        finally:
+            os.close(fd)
+
+    def _write_version(self, version: int):
+        path = self._path(VERSION_FILE)
+        data = version.to_bytes(8, "little")
+        if os.path.exists(path):
+            # 原地修改：其他进程映射的是这个文件
+            fd = os.open(path, os.O_WRONLY)
+            try:
+                os.pwrite(fd, data, 0)
+            finally:
+                os.close(fd)
+        else:
+            with open(path + ".tmp", "wb") as f:
+                f.write(data)
+            os.replace(path + ".tmp", path)
+
+    def _publish(self, manifest: dict):
+        """原子替换 manifest、更新版本号，并在本进程中映射新版本"""
+        manifest = {**manifest, "format": FORMAT_VERSION, "version": max(self.version, self._published_version()) + 1}
+        tmp = self._path(MANIFEST + ".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(manifest, f)
+        os.replace(tmp, self._path(MANIFEST))
+        self._write_version(manifest["version"])
+        self._apply(manifest, record=False)
+
+    def _remove_stale_segments(self):
+        """删除当前段以外的段文件；已映射旧段的进程不受影响，下次检索前会切换到新段"""
+        for name in os.listdir(self.directory):
+            if name.startswith(SEGMENT_PREFIX) and name.split(".")[0] != self.manifest["segment"]:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(self._path(name))
+
+    def _document_event(self, document_id: int, meta: tuple) -> dict:
+        return {"id": document_id, "file_type": meta[0], "uploaded": meta[1]}
+
+    def _append_events(self, events: list) -> int:
+        """追加文档事件，返回日志的新长度"""
+        offset = self.manifest["documents_bytes"]
+        if not events:
+            return offset
+        data = "".join(json.dumps(event, ensure_ascii=False) + "\n" for event in events).encode("utf-8")
+        self._write_at(f"{self.manifest['segment']}.documents", offset, data)
+        return offset + len(data)
+
+    def register_document(self, document_id: int, file_type: str, upload_date):
+        """元数据随该文档的第一批向量一起写入文档日志"""
+        self._pending_documents[document_id] = (file_type, _timestamp(upload_date))
+
+    def add_document(self, document_id: int, chunk_ids: Sequence[int], embeddings: Sequence[Sequence[float]]):
+        """把一个文档（的一批）片段向量追加到当前段并发布新版本"""
+        if not len(chunk_ids):
+            return
+        chunk_ids = np.asarray(chunk_ids, dtype=np.int64)
+        vectors = normalize_rows(np.asarray(embeddings, dtype=np.float32).reshape(len(chunk_ids), -1))
+        with self._writer():
+            manifest = self.manifest
+            rows, dim = manifest["rows"], manifest["dim"]
+            if rows and vectors.shape[1] != dim:
+                logger.warning(f"文档 {document_id} 的向量维度 {vectors.shape[1]} 与索引维度 {dim} 不一致，未加入索引")
+                return
+            if chunk_ids.min() <= manifest["built_max_chunk_id"]:
+                # 其他worker启动时重建索引，可能已经从数据库读到了这些刚写入的片段
+                found = self.rows_for(chunk_ids)
+                new = found < 0
+                new[~new] = ~self.alive[found[~new]]
+                chunk_ids, vectors = chunk_ids[new], vectors[new]
+                if not len(chunk_ids):
+                    return
+            events = []
+            meta = self._pending_documents.pop(document_id, None)
+            if meta is not None and self.documents.get(document_id) != meta:
+                events.append(self._document_event(document_id, meta))
+            segment = manifest["segment"]
+            self._write_at(f"{segment}.vectors", rows * vectors.shape[1] * 4, vectors.tobytes())
+            self._write_at(f"{segment}.chunk_ids", rows * 8, chunk_ids.tobytes())
+            self._write_at(f"{segment}.document_ids", rows * 8,
+                           np.full(len(chunk_ids), document_id, dtype=np.int64).tobytes())
+            nonzero = np.count_nonzero(vectors, axis=0)
+            if rows:
+                nonzero = nonzero + self.nonzero_counts
+            self._publish({
+                **manifest,
+                "dim": vectors.shape[1],
+                "rows": rows + len(chunk_ids),
+                "documents_bytes": self._append_events(events),
+                "nonzero_counts": nonzero.tolist(),
+                "max_chunk_id": max(manifest["max_chunk_id"], int(chunk_ids.max())),
+            })
+
+    def add_documents(self, documents: Sequence[Tuple[int, Sequence[int], Sequence[Sequence[float]]]]):
+        """逐个文档追加：每次只写入新行，不复制已有数据"""
+        for document_id, chunk_ids, embeddings in documents:
+            self.add_document(document_id, chunk_ids, embeddings)
+
+    def remove_document(self, document_id: int):
+        """在文档日志中记录删除，失效行过多时在后台线程压缩"""
+        self._pending_documents.pop(document_id, None)
+        with self._writer():
+            rows = self.rows_for_documents([document_id])
+            rows = rows[self.alive[rows]]
+            if document_id not in self.documents and not len(rows):
+                return
+            manifest = self.manifest
+            nonzero = self.nonzero_counts - np.count_nonzero(self.matrix[rows], axis=0) if len(rows) else \
+                self.nonzero_counts
+            event = {"id": document_id, "deleted": True, "rows": manifest["rows"]}
+            self._publish({
+                **manifest,
+                "documents_bytes": self._append_events([event]),
+                "nonzero_counts": nonzero.tolist(),
+                "dead_rows": manifest["dead_rows"] + len(rows),
+            })
+            compact = self._needs_compaction()
+        if compact:
+            self._compact_in_background()
+
+    def _needs_compaction(self) -> bool:
+        return self.dead_rows > self.compact_ratio * len(self.chunk_ids)
+
+    def _compact_in_background(self):
+        if self._compacting is not None and self._compacting.is_alive():
+            return
+        self._compacting = threading.Thread(target=self._compact_detached, name="mmap-index-compact", daemon=True)
+        self._compacting.start()
+
+    def _compact_detached(self):
+        """用独立的实例持锁映射最新版本并压缩，不修改本实例；本实例在下次写入或 refresh() 时切换到新段"""
+        try:
+            peer = MmapVectorIndex(self.directory, self.compact_ratio)
+            with peer._writer():
+                if peer._needs_compaction():
+                    peer._compact()
+        except Exception as e:
+            logger.error(f"共享向量索引压缩失败: {e}", exc_info=True)
+
+    def _new_segment(self) -> str:
+        return f"{SEGMENT_PREFIX}{max(self.version, self._published_version()) + 1}"
+
+    def _compact(self, block_rows: int = 65536):
+        """把有效行分块复制到新段，发布后删除旧段"""
+        segment = self._new_segment()
+        live = np.flatnonzero(self.alive)
+        files = {kind: open(self._path(f"{segment}.{kind}"), "wb") for kind, _ in ARRAYS}
+        try:
+            for start in range(0, len(live), block_rows):
+                block = live[start:start + block_rows]
+                files["vectors"].write(self.matrix[block].tobytes())
+                files["chunk_ids"].write(self.chunk_ids[block].tobytes())
+                files["document_ids"].write(self.document_ids[block].tobytes())
+        finally:
+            for f in files.values():
+                f.close()
+        data = "".join(json.dumps(self._document_event(document_id, meta), ensure_ascii=False) + "\n"
+                       for document_id, meta in self.documents.items()).encode("utf-8")
+        with open(self._path(f"{segment}.documents"), "wb") as f:
+            f.write(data)
+        dead_rows = self.dead_rows
+        self._publish({**self.manifest, "segment": segment, "rows": len(live), "documents_bytes": len(data),
+                       "dead_rows": 0})
+        self._remove_stale_segments()
+        logger.info(f"共享向量索引已压缩: 丢弃 {dead_rows} 个失效行, 剩余 {len(live)} 行")
+
+    # ---- 启动 ----
+
+    async def _stale_reason(self, manifest: Optional[dict], dim: Optional[int]) -> Optional[str]:
+        """索引需要从数据库重建的原因，可以直接使用时返回None"""
+        if manifest is None:
+            return "索引不存在"
+        if dim is not None and manifest["rows"] and manifest["dim"] != dim:
+            return f"向量维度 {manifest['dim']} 与当前模型 {dim} 不一致"
+        for kind, dtype in ARRAYS:
+            width = manifest["dim"] if kind == "vectors" else 1
+            path = self._path(f"{manifest['segment']}.{kind}")
+            if manifest["rows"] and (not os.path.exists(path) or
+                                     os.path.getsize(path) < manifest["rows"] * width * np.dtype(dtype).itemsize):
+                return "数据文件不完整"
+        count = await Chunk.all().count()
+        latest = await Chunk.all().order_by("-id").limit(1).values_list("id", flat=True)
+        if (latest[0] if latest else 0) > manifest["max_chunk_id"] or \
+                count != manifest["rows"] - manifest["dead_rows"] + manifest["skipped"]:
+            return "与数据库中的片段不一致"
+        return None
+
+    async def _build(self, batch_size: int, dim: Optional[int]):
+        """从数据库分批读取向量写成新段，不在内存中保留整个矩阵"""
+        segment = self._new_segment()
+        files = {kind: open(self._path(f"{segment}.{kind}"), "wb") for kind, _ in ARRAYS}
+        rows, nonzero, stats = 0, None, {"skipped": 0, "last_id": 0}
+        try:
+            async for chunk_ids, document_ids, matrix in iter_embedding_batches(batch_size, dim, stats):
+                dim = matrix.shape[1]
+                counts = np.count_nonzero(matrix, axis=0).astype(np.int64)
+                nonzero = counts if nonzero is None else nonzero + counts
+                files["vectors"].write(matrix.tobytes())
+                files["chunk_ids"].write(chunk_ids.tobytes())
+                files["document_ids"].write(document_ids.tobytes())
+                rows += len(matrix)
+        finally:
+            for f in files.values():
+                f.close()
+
+        data = "".join(json.dumps(self._document_event(document_id, meta), ensure_ascii=False) + "\n"
+                       for document_id, meta in (await load_document_meta()).items()).encode("utf-8")
+        with open(self._path(f"{segment}.documents"), "wb") as f:
+            f.write(data)
+        self._publish({
+            "segment": segment,
+            "dim": dim or 0,
+            "rows": rows,
+            "dead_rows": 0,
+            "skipped": stats["skipped"],
+            "documents_bytes": len(data),
+            "nonzero_counts": nonzero.tolist() if nonzero is not None else [],
+            "max_chunk_id": stats["last_id"],
+            "built_max_chunk_id": stats["last_id"],
+        })
+        self._remove_stale_segments()
+
+    async def load(self, batch_size: int = 5000, dim: int = None):
+        """持写入锁检查共享索引是否可用，不可用时从数据库重建；之后映射最新版本
+
+        多个worker同时启动时只有拿到锁的第一个会重建，其余的等待后直接映射。
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self._path(LOCK_FILE), "a") as lock_file:
+            await asyncio.to_thread(fcntl.flock, lock_file, fcntl.LOCK_EX)
+            try:
+                manifest = self._read_manifest()
+                reason = await self._stale_reason(manifest, dim)
+                if reason is not None:
+                    logger.info(f"重建共享向量索引: {reason}")
+                    await self._build(batch_size, dim)
+                else:
+                    with self._lock:
+                        self._apply(manifest, record=False)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+        self.loaded = True
+        logger.info(f"共享向量索引已映射: {len(self)} 个片段, 维度 {self.dim}, 版本 {self.version} ({self.directory})")
+
+
+def _empty_changes() -> Dict[str, object]:
+    return {"chunk_ids": [], "removed": set()}
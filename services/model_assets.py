@@ -0,0 +1,62 @@
+"""模型和分词资源的本地缓存路径
+
+设置 MODEL_CACHE_DIR 后，tiktoken 编码表、NLTK 分句模型和 HuggingFace 嵌入模型都从该目录读取：
+镜像构建时运行 prefetch_assets.py 预先下载，运行时（包括入库子进程）不访问网络。
+已单独设置的 TIKTOKEN_CACHE_DIR / NLTK_DATA / HF_HOME 优先。
+"""
+import os
+import sys
+import logging
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+TEXT_PROCESSOR_MODEL = "gpt-3.5-turbo"
+NLTK_PACKAGES = ("punkt_tab", "punkt")
+
+
+def configure_cache_paths(offline: bool = True) -> Optional[str]:
+    """按 MODEL_CACHE_DIR 设置各库的缓存目录，需在导入这些库之前调用；未设置时返回None
+
+    offline 为True时同时让 transformers 只读本地缓存，否则加载模型前会先联网检查更新。
+    """
+    cache_dir = os.getenv("MODEL_CACHE_DIR")
+    if not cache_dir:
+        return None
+    cache_dir = os.path.abspath(cache_dir)
+    os.environ.setdefault("TIKTOKEN_CACHE_DIR", os.path.join(cache_dir, "tiktoken"))
+    os.environ.setdefault("NLTK_DATA", os.path.join(cache_dir, "nltk_data"))
+    os.environ.setdefault("HF_HOME", os.path.join(cache_dir, "huggingface"))
+    if offline:
+        os.environ.setdefault("HF_HUB_OFFLINE", "1")
+        os.environ.setdefault("TRANSFORMERS_OFFLINE", "1")
+    if "nltk" in sys.modules:
+        # NLTK 只在导入时读取 NLTK_DATA
+        import nltk
+        if os.environ["NLTK_DATA"] not in nltk.data.path:
+            nltk.data.path.insert(0, os.environ["NLTK_DATA"])
+    return cache_dir
+
+
+def prefetch(embedding_model: str = None) -> dict:
+    """下载分段用的tiktoken编码表和NLTK分句模型，以及指定的嵌入模型，返回各资源的存放位置"""
+    cache_dir = configure_cache_paths(offline=False)
+    if cache_dir is None:
+        raise RuntimeError("请先设置 MODEL_CACHE_DIR")
+    import tiktoken
+    import nltk
+
+    tiktoken.encoding_for_model(TEXT_PROCESSOR_MODEL)
+    tiktoken.get_encoding("cl100k_base")
+    for package in NLTK_PACKAGES:
+        if not nltk.download(package, download_dir=os.environ["NLTK_DATA"], quiet=True):
+            raise RuntimeError(f"NLTK {package} 下载失败")
+    result = {"tiktoken": os.environ["TIKTOKEN_CACHE_DIR"], "nltk": os.environ["NLTK_DATA"]}
+
+    if embedding_model:
+        from transformers import AutoTokenizer, AutoModel
+        AutoTokenizer.from_pretrained(embedding_model)
+        AutoModel.from_pretrained(embedding_model)
+        result["embedding_model"] = {"name": embedding_model, "path": os.environ["HF_HOME"]}
+    logger.info(f"资源已缓存到 {cache_dir}")
+    return result
@@ -0,0 +1,452 @@
+"""量化向量索引：常驻内存的只有压缩码，全精度向量放在磁盘文件中，精排时按需读取
+
+VECTOR_QUANTIZATION 选择量化方式：
+    int8  标量量化，每维按训练样本的最大绝对值缩放到 [-127, 127]，每行 dim 字节（float32 的 1/4）
+    pq    乘积量化，向量切成 PQ_SUBSPACES 个子空间，每个子空间用 k-means 训练256个中心，
+          每行 PQ_SUBSPACES 字节（默认每4维一个子空间，为 float32 的 1/16）
+
+检索先用压缩码对范围内的全部行近似打分，取前 top_k * QUANTIZED_RERANK_FACTOR（默认int8为10、PQ为30）个候选，
+再读取这些候选的全精度向量精确打分排序，返回的得分与精确检索一致。全精度向量写在
+VECTOR_INDEX_DIR 下创建后即删除的文件中，由操作系统按页载入，内存紧张时可以回收。
+数据量小于 QUANTIZED_MIN_TRAIN_SIZE 时不量化、直接精确检索；之后数据量翻倍时在后台线程重新训练和编码。
+删除文档只把对应的行标记为失效，失效行超过 VECTOR_INDEX_COMPACT_RATIO 后在后台线程把有效行复制到新文件。
+"""
+import os
+import copy
+import mmap
+import time
+import asyncio
+import logging
+import tempfile
+import numpy as np
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
+from services.vector_index import VectorIndex, normalize_rows, iter_embedding_batches, load_document_meta
+
+logger = logging.getLogger(__name__)
+
+
+class DiskVectors:
+    """追加写入的float32矩阵，保存在已删除的临时文件中
+
+    写入和顺序读取都用 pwrite/pread，不占用进程内存；view() 返回只读映射，随机读取少量行时只载入这些页。
+    """
+
+    def __init__(self, dim: int, directory: str = None):
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        fd, path = tempfile.mkstemp(prefix="kbserve-vectors-", dir=directory)
+        os.unlink(path)
+        self.fd = fd
+        self.dim = dim
+        self.rows = 0
+        self.capacity = 0
+        self._map = None
+
+    @property
+    def row_bytes(self) -> int:
+        return self.dim * 4
+
+    def append(self, vectors: np.ndarray):
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        if self.rows + len(vectors) > self.capacity:
+            # 容量按倍数增长（稀疏文件），映射只在扩容时重建
+            self.capacity = max(self.rows + len(vectors), 2 * self.capacity, 1024)
+            os.ftruncate(self.fd, self.capacity * self.row_bytes)
+            buffer = mmap.mmap(self.fd, self.capacity * self.row_bytes, access=mmap.ACCESS_READ)
+            self._map = np.frombuffer(buffer, dtype=np.float32).reshape(self.capacity, self.dim)
+        os.pwrite(self.fd, vectors.tobytes(), self.rows * self.row_bytes)
+        self.rows += len(vectors)
+
+    def view(self) -> np.ndarray:
+        if self._map is None:
+            return np.zeros((0, self.dim), dtype=np.float32)
+        return self._map[:self.rows]
+
+    def read(self, start: int, end: int) -> np.ndarray:
+        """顺序读取 [start, end) 行的副本"""
+        data = os.pread(self.fd, (end - start) * self.row_bytes, start * self.row_bytes)
+        return np.frombuffer(data, dtype=np.float32).reshape(-1, self.dim)
+
+    def blocks(self, block_rows: int = 65536, end: int = None):
+        end = self.rows if end is None else end
+        for start in range(0, end, block_rows):
+            yield start, self.read(start, min(start + block_rows, end))
+
+    def select(self, rows: np.ndarray, directory: str = None, block_rows: int = 65536) -> "DiskVectors":
+        """只保留给定的行（升序），写到新文件"""
+        selected = DiskVectors(self.dim, directory)
+        matrix = self.view()
+        for start in range(0, len(rows), block_rows):
+            selected.append(matrix[rows[start:start + block_rows]])
+        return selected
+
+    def close(self):
+        self._map = None
+        os.close(self.fd)
+
+
+class Int8Codec:
+    """标量量化：每维一个缩放系数，近似内积为 codes @ (query * scale)"""
+
+    name = "int8"
+    rerank_factor = 10
+    sample_size = 65536  # 缩放系数取样本各维的最大绝对值，样本多一些，超出范围的值编码时截断
+
+    def __init__(self):
+        self.scale = None
+
+    def train(self, sample: np.ndarray, seed: int = 0):
+        peak = np.abs(sample).max(axis=0)
+        # 样本中全为0的维度（稀疏的哈希向量很常见）按样本的整体最大值缩放，否则之后出现的值都会被截断为0
+        peak[peak == 0] = peak.max() if peak.any() else 1.0
+        self.scale = (peak / 127).astype(np.float32)
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        return np.clip(np.rint(vectors / self.scale), -127, 127).astype(np.int8)
+
+    def scores(self, codes: np.ndarray, query: np.ndarray, block_rows: int = 8192) -> np.ndarray:
+        # 分块转换为float32再做矩阵向量乘法，临时数组不超过一个块
+        weights = query * self.scale
+        return np.concatenate([codes[start:start + block_rows].astype(np.float32) @ weights
+                               for start in range(0, len(codes), block_rows)]) if len(codes) else \
+            np.zeros(0, dtype=np.float32)
+
+    @property
+    def nbytes(self) -> int:
+        return self.scale.nbytes if self.scale is not None else 0
+
+
+class PQCodec:
+    """乘积量化：子空间各自的256个中心，近似内积为各子空间查表之和"""
+
+    name = "pq"
+    rerank_factor = 30  # 码本误差较大，精排候选要多一些
+    sample_size = 256 * 64  # 每个中心约64个样本，再多对码本质量提升不大但训练时间线性增长
+
+    def __init__(self, subspaces: int = 0):
+        self.subspaces = subspaces  # 0 表示每4维一个子空间
+        self.bounds = None  # 各子空间的起止维度
+        self.codebooks = None  # [子空间] -> (中心数, 子空间维度)
+
+    def train(self, sample: np.ndarray, seed: int = 0, iterations: int = 10):
+        dim = sample.shape[1]
+        subspaces = min(self.subspaces or max(1, dim // 4), dim)
+        edges = np.linspace(0, dim, subspaces + 1).astype(int)
+        self.bounds = list(zip(edges[:-1].tolist(), edges[1:].tolist()))
+        rng = np.random.default_rng(seed)
+        self.codebooks = [_kmeans(np.ascontiguousarray(sample[:, start:end]), min(256, len(sample)), iterations, rng)
+                          for start, end in self.bounds]
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        codes = np.empty((len(vectors), len(self.bounds)), dtype=np.uint8)
+        for j, (start, end) in enumerate(self.bounds):
+            codes[:, j] = _nearest(vectors[:, start:end], self.codebooks[j])
+        return codes
+
+    def scores(self, codes: np.ndarray, query: np.ndarray, block_rows: int = 16384) -> np.ndarray:
+        tables = [codebook @ query[start:end] for codebook, (start, end) in zip(self.codebooks, self.bounds)]
+        scores = np.empty(len(codes), dtype=np.float32)
+        for start in range(0, len(codes), block_rows):
+            block = np.ascontiguousarray(codes[start:start + block_rows].T)
+            total = np.zeros(block.shape[1], dtype=np.float32)
+            for table, column in zip(tables, block):
+                total += table[column]
+            scores[start:start + block_rows] = total
+        return scores
+
+    @property
+    def nbytes(self) -> int:
+        return sum(codebook.nbytes for codebook in self.codebooks) if self.codebooks else 0
+
+
+def _nearest(vectors: np.ndarray, centroids: np.ndarray, block_rows: int = 65536) -> np.ndarray:
+    """欧氏距离最近的中心：argmin(|c|^2 - 2 x·c)"""
+    squared = (centroids * centroids).sum(axis=1)
+    labels = [np.argmin(squared - 2 * (vectors[start:start + block_rows] @ centroids.T), axis=1)
+              for start in range(0, len(vectors), block_rows)]
+    return np.concatenate(labels) if labels else np.zeros(0, dtype=np.int64)
+
+
+def _kmeans(data: np.ndarray, k: int, iterations: int, rng: np.random.Generator) -> np.ndarray:
+    centroids = data[rng.choice(len(data), k, replace=False)].copy()
+    for _ in range(iterations):
+        labels = _nearest(data, centroids)
+        counts = np.bincount(labels, minlength=k)
+        filled = counts > 0  # 空簇保留原来的中心
+        for d in range(data.shape[1]):
+            sums = np.bincount(labels, weights=data[:, d], minlength=k)
+            centroids[filled, d] = sums[filled] / counts[filled]
+    return centroids.astype(np.float32)
+
+
+CODECS = {"int8": Int8Codec, "pq": PQCodec}
+
+
+class QuantizedIndex(VectorIndex):
+    """压缩码近似打分 + 全精度向量精排的精确结果索引
+
+    matrix 是磁盘文件的只读映射，供精排和过滤后的小范围精确检索按行读取；
+    codes 是常驻内存的压缩码，训练前为None，此时退化为精确检索。
+    alive 标记每行是否有效（所属文档未被删除），检索时跳过失效行。训练和压缩在后台线程中
+    基于快照进行，同一时刻只有一个，完成后在事件循环中替换。
+    """
+
+    def __init__(self, method: str = None, rerank_factor: int = None, min_train_size: int = None,
+                 subspaces: int = None, directory: str = None, compact_ratio: float = None):
+        super().__init__()
+        method = (method or os.getenv("VECTOR_QUANTIZATION", "int8")).lower()
+        if method not in CODECS:
+            raise ValueError(f"不支持的量化方式: {method}")
+        self.codec = PQCodec(subspaces or int(os.getenv("PQ_SUBSPACES", 0))) if method == "pq" else Int8Codec()
+        self.rerank_factor = rerank_factor or int(os.getenv("QUANTIZED_RERANK_FACTOR", 0)) or self.codec.rerank_factor
+        self.min_train_size = min_train_size or int(os.getenv("QUANTIZED_MIN_TRAIN_SIZE", 10000))
+        self.directory = directory or os.getenv("VECTOR_INDEX_DIR", "./vector_index")
+        self.compact_ratio = compact_ratio if compact_ratio is not None else \
+            float(os.getenv("VECTOR_INDEX_COMPACT_RATIO", 0.2))
+        self.store = None
+        self.codes = None
+        self.trained_size = 0
+        self.alive = np.ones(0, dtype=bool)
+        self.dead_rows = 0
+        self._background = None  # 进行中的后台训练或压缩任务
+
+    def __len__(self) -> int:
+        return len(self.chunk_ids) - self.dead_rows
+
+    def _replace_store(self, store: Optional[DiskVectors]):
+        if self.store is not None:
+            self.store.close()
+        self.store = store
+        self.matrix = store.view() if store is not None else np.zeros((0, 0), dtype=np.float32)
+
+    def _store_matrix(self, matrix: np.ndarray):
+        """把整个矩阵写入新的磁盘文件（基准测试直接装入合成向量时使用）"""
+        store = DiskVectors(matrix.shape[1], self.directory)
+        store.append(matrix)
+        self._replace_store(store)
+        self.alive = np.ones(len(matrix), dtype=bool)
+        self.dead_rows = 0
+
+    async def load(self, batch_size: int = 5000, dim: int = None):
+        """从数据库分批读取向量写入磁盘文件，内存中不保留全精度矩阵，之后在线程中训练并编码"""
+        if self._background is not None:
+            await self._background
+        store, chunk_ids, document_ids, nonzero = None, [], [], None
+        async for batch_chunk_ids, batch_document_ids, vectors in iter_embedding_batches(batch_size, dim):
+            if store is None:
+                store = DiskVectors(vectors.shape[1], self.directory)
+            store.append(vectors)
+            chunk_ids.append(batch_chunk_ids)
+            document_ids.append(batch_document_ids)
+            counts = np.count_nonzero(vectors, axis=0).astype(np.int64)
+            nonzero = counts if nonzero is None else nonzero + counts
+        self._replace_store(store)
+        self.chunk_ids = np.concatenate(chunk_ids) if chunk_ids else np.zeros(0, dtype=np.int64)
+        self.document_ids = np.concatenate(document_ids) if document_ids else np.zeros(0, dtype=np.int64)
+        self.nonzero_counts = nonzero if nonzero is not None else np.zeros(0, dtype=np.int64)
+        self.alive = np.ones(len(self.chunk_ids), dtype=bool)
+        self.dead_rows = 0
+        self.documents = await load_document_meta()
+        self._document_table = None
+        self.codes, self.trained_size = None, 0
+        self.loaded = True
+        self.generation += 1
+        if self._needs_training():
+            snapshot = self._snapshot()
+            self._install_codes(snapshot, await asyncio.to_thread(self._train, snapshot))
+        logger.info(f"量化向量索引已加载: {len(self)} 个片段, 维度 {self.dim}, {self.memory_stats()}")
+
+    def add_document(self, document_id: int, chunk_ids: Sequence[int], embeddings: Sequence[Sequence[float]]):
+        if not len(chunk_ids):
+            return
+        vectors = normalize_rows(np.asarray(embeddings, dtype=np.float32).reshape(len(chunk_ids), -1))
+        if len(self) and vectors.shape[1] != self.dim:
+            logger.warning(f"文档 {document_id} 的向量维度 {vectors.shape[1]} 与索引维度 {self.dim} 不一致，未加入索引")
+            return
+        if self.store is None or not len(self.chunk_ids):
+            self._replace_store(DiskVectors(vectors.shape[1], self.directory))
+            self.nonzero_counts = np.zeros(vectors.shape[1], dtype=np.int64)
+        self.store.append(vectors)
+        self.matrix = self.store.view()
+        self.nonzero_counts = self.nonzero_counts + np.count_nonzero(vectors, axis=0)
+        self.chunk_ids = np.concatenate([self.chunk_ids, np.asarray(chunk_ids, dtype=np.int64)])
+        self.document_ids = np.concatenate([self.document_ids, np.full(len(chunk_ids), document_id, dtype=np.int64)])
+        self.alive = np.concatenate([self.alive, np.ones(len(chunk_ids), dtype=bool)])
+        if self.codes is not None:
+            self.codes = np.concatenate([self.codes, self.codec.encode(vectors)])
+        self.generation += 1
+        self._maintain()
+
+    def add_documents(self, documents: Sequence[Tuple[int, Sequence[int], Sequence[Sequence[float]]]]):
+        """逐个文档追加：全精度向量写入磁盘文件，只有压缩码和id在内存中拼接"""
+        for document_id, chunk_ids, embeddings in documents:
+            self.add_document(document_id, chunk_ids, embeddings)
+
+    def remove_document(self, document_id: int):
+        """把文档的行标记为失效，不改写磁盘文件；失效行过多时在后台压缩"""
+        if self.documents.pop(document_id, None) is not None:
+            self._document_table = None
+        rows = np.flatnonzero((self.document_ids == document_id) & self.alive)
+        if not len(rows):
+            return
+        self.nonzero_counts = self.nonzero_counts - np.count_nonzero(self.matrix[rows], axis=0)
+        self.alive[rows] = False
+        self.dead_rows += len(rows)
+        self.generation += 1
+        self._maintain()
+
+    def _needs_training(self) -> bool:
+        """数据量达到阈值且比上次训练时翻倍"""
+        return len(self) >= self.min_train_size and len(self) >= 2 * self.trained_size
+
+    def _needs_compaction(self) -> bool:
+        return self.dead_rows > self.compact_ratio * len(self.chunk_ids)
+
+    def read_view(self) -> "QuantizedIndex":
+        # 删除原地修改 alive，视图持有一份副本
+        view = super().read_view()
+        view.alive = self.alive.copy()
+        return view
+
+    def _snapshot(self) -> Tuple[int, np.ndarray]:
+        # 追加只写入快照之后的行，删除只修改 alive，快照中的行号在后台任务完成前保持不变
+        return len(self.chunk_ids), self.alive.copy()
+
+    def _maintain(self):
+        """需要时启动后台训练或压缩；没有事件循环时（脚本、基准测试）直接执行"""
+        if self._background is not None:
+            return
+        if self._needs_training():
+            work, install = self._train, self._install_codes
+        elif self._needs_compaction():
+            work, install = self._compact, self._install_compacted
+        else:
+            return
+        snapshot = self._snapshot()
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            install(snapshot, work(snapshot))
+            self._maintain()
+            return
+        self._background = loop.create_task(self._run_in_background(work, install, snapshot))
+
+    async def _run_in_background(self, work, install, snapshot: Tuple[int, np.ndarray]):
+        try:
+            install(snapshot, await asyncio.to_thread(work, snapshot))
+        except Exception as e:
+            logger.error(f"量化索引后台任务失败: {e}", exc_info=True)
+            return
+        finally:
+            self._background = None
+        # 任务期间的增删可能又触发了训练或压缩
+        self._maintain()
+
+    def _train(self, snapshot: Tuple[int, np.ndarray], seed: int = 0) -> Tuple[Any, np.ndarray]:
+        """用快照中等间隔抽样的行训练新的码本并编码这些行；不修改索引，可在线程中运行"""
+        rows, _ = snapshot
+        started = time.perf_counter()
+        codec = copy.deepcopy(self.codec)
+        step = max(1, -(-rows // codec.sample_size))
+        sample = np.concatenate([block[(-start) % step::step] for start, block in self.store.blocks(end=rows)])
+        codec.train(sample, seed=seed)
+        codes = np.concatenate([codec.encode(block) for _, block in self.store.blocks(end=rows)])
+        logger.info(f"向量量化({codec.name})训练完成: {rows} 个向量, 耗时 {time.perf_counter() - started:.2f}s")
+        return codec, codes
+
+    def _install_codes(self, snapshot: Tuple[int, np.ndarray], trained: Tuple[Any, np.ndarray]):
+        """换用新码本，训练期间追加的行用新码本补编码"""
+        rows, _ = snapshot
+        codec, codes = trained
+        total = len(self.chunk_ids)
+        tail = [codec.encode(self.store.read(start, min(start + 65536, total))) for start in range(rows, total, 65536)]
+        self.codec = codec
+        self.codes = np.concatenate([codes, *tail])
+        self.trained_size = rows
+        logger.info(f"量化索引已换用新码本: {self.memory_stats()}")
+
+    def _compact(self, snapshot: Tuple[int, np.ndarray]) -> DiskVectors:
+        """把快照中的有效行复制到新的磁盘文件；不修改索引，可在线程中运行"""
+        rows, alive = snapshot
+        return self.store.select(np.flatnonzero(alive[:rows]), self.directory)
+
+    def _install_compacted(self, snapshot: Tuple[int, np.ndarray], store: DiskVectors):
+        """换用压缩后的文件：补上压缩期间追加的行，压缩期间删除的行仍标记为失效"""
+        rows, alive = snapshot
+        total = len(self.chunk_ids)
+        for start in range(rows, total, 65536):
+            store.append(self.store.read(start, min(start + 65536, total)))
+        keep = np.concatenate([np.flatnonzero(alive[:rows]), np.arange(rows, total)])
+        self._replace_store(store)
+        self.chunk_ids, self.document_ids, self.alive = self.chunk_ids[keep], self.document_ids[keep], self.alive[keep]
+        if self.codes is not None:
+            self.codes = self.codes[keep]
+        self.dead_rows = int(len(keep) - np.count_nonzero(self.alive))
+        self.generation += 1
+        logger.info(f"量化索引已压缩: 丢弃 {total - len(keep)} 个失效行, 剩余 {len(keep)} 行")
+
+    def _top_k(self, scores: np.ndarray, rows: Optional[np.ndarray], top_k: int):
+        if rows is None and self.dead_rows:
+            # 全部行打分时（包括批量检索），失效行的得分置为负无穷，且k不超过有效行数
+            scores[~self.alive] = -np.inf
+            top_k = min(top_k, len(self))
+        return super()._top_k(scores, rows, top_k)
+
+    def _exact(self, query: Optional[np.ndarray], rows: Optional[np.ndarray], top_k: int) -> List[Tuple[int, float]]:
+        """范围内的行多于精排候选数时先用压缩码近似打分，再对候选读取全精度向量精确打分"""
+        if rows is not None and self.dead_rows:
+            # 文档id被复用或关键词候选来自已删除的文档时，行号中可能有失效行
+            rows = rows[self.alive[rows]]
+        depth = top_k * self.rerank_factor
+        if query is None or self.codes is None or (len(self) if rows is None else len(rows)) <= depth:
+            return super()._exact(query, rows, top_k)
+        approximate = self.codec.scores(self.codes if rows is None else self.codes[rows], query)
+        if rows is None and self.dead_rows:
+            approximate[~self.alive] = -np.inf
+        top = np.argpartition(-approximate, depth - 1)[:depth]
+        # 按行号顺序读取，磁盘访问尽量连续
+        candidates = np.sort(top if rows is None else rows[top])
+        return self._top_k(self.matrix[candidates] @ query, candidates, top_k)
+
+    def search(self, query_embedding: np.ndarray, top_k: int = 5, stats: dict = None,
+               filters: Dict[str, Any] = None) -> List[Tuple[int, float]]:
+        hits = super().search(query_embedding, top_k=top_k, stats=stats, filters=filters)
+        if stats is not None:
+            stats["backend"] = f"quantized({self.codec.name})" if self.codes is not None else \
+                f"quantized({self.codec.name}, untrained)"
+            stats["rerank"] = top_k * self.rerank_factor
+        return hits
+
+    def search_batch(self, query_embeddings: np.ndarray, top_k: Union[int, Sequence[int]] = 5,
+                     stats: dict = None, max_block_cells: int = 1 << 26,
+                     filters: Sequence[Optional[Dict[str, Any]]] = None) -> List[List[Tuple[int, float]]]:
+        """训练前退化为批量精确检索，训练后逐条查询（压缩码打分 + 精排）"""
+        if self.codes is None:
+            return super().search_batch(query_embeddings, top_k, stats=stats, max_block_cells=max_block_cells,
+                                        filters=filters)
+        started = time.perf_counter()
+        top_ks = [top_k] * len(query_embeddings) if isinstance(top_k, int) else list(top_k)
+        filters = list(filters) if filters is not None else [None] * len(top_ks)
+        results = [self.search(query, top_k=k, filters=f) for query, k, f in zip(query_embeddings, top_ks, filters)]
+        if stats is not None:
+            stats.update({
+                "backend": f"quantized({self.codec.name})",
+                "queries": len(results),
+                "total": len(self),
+                "elapsed_ms": round((time.perf_counter() - started) * 1000, 3),
+            })
+        return results
+
+    def memory_stats(self) -> Dict[str, Any]:
+        """常驻内存的压缩码和码本与全精度矩阵的字节数对比"""
+        float_bytes = len(self) * self.dim * 4
+        code_bytes = int(self.codes.nbytes) if self.codes is not None else 0
+        codebook_bytes = self.codec.nbytes if self.codes is not None else 0
+        return {
+            "method": self.codec.name,
+            "trained": self.codes is not None,
+            "float_bytes": float_bytes,
+            "code_bytes": code_bytes,
+            "codebook_bytes": codebook_bytes,
+            "compression": round(float_bytes / (code_bytes + codebook_bytes), 2) if code_bytes else None,
+        }
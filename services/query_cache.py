@@ -0,0 +1,106 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional
+
+
+class LRUCache:
+    """带TTL、条目数和字节数上限的LRU缓存（线程安全）
+
+    每个条目可以附带一个代号（generation），读取时代号不一致视为失效，
+    用于语料变化后让旧的检索结果自然过期。
+    """
+
+    def __init__(self, max_entries: int = 1024, max_bytes: int = 64 << 20, ttl: float = 300.0,
+                 sizeof: Callable[[Any], int] = None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sizeof = sizeof or (lambda value: 64)
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._entries = OrderedDict()  # key -> (value, size, expires_at, generation)
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable, generation: int = None) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, size, expires_at, entry_generation = entry
+            if expires_at < time.monotonic() or entry_generation != generation:
+                self._drop(key, size)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: Hashable, value: Any, generation: int = None):
+        size = self.sizeof(value)
+        if self.max_entries <= 0 or size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+            self._entries[key] = (value, size, time.monotonic() + self.ttl, generation)
+            self.bytes += size
+            while len(self._entries) > self.max_entries or self.bytes > self.max_bytes:
+                _, (_, evicted_size, _, _) = self._entries.popitem(last=False)
+                self.bytes -= evicted_size
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def _drop(self, key: Hashable, size: int):
+        del self._entries[key]
+        self.bytes -= size
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+
+def normalize_question(question: str) -> str:
+    """忽略大小写和空白差异，近似相同的问题共享缓存"""
+    return " ".join(question.casefold().split())
+
+
+class QueryCache:
+    """查询向量缓存 + 检索结果缓存
+
+    - embeddings: 规范化问题 -> 查询向量（与语料无关，只受TTL和容量限制）
+    - results: (规范化问题, top_k) -> [(chunk_id, 相似度)]，以索引的 generation 为代号，
+      文档上传或删除后索引代号变化，旧结果不会再被返回
+    """
+
+    def __init__(self, max_entries: int = None, max_bytes: int = None, ttl: float = None):
+        max_entries = max_entries if max_entries is not None else int(os.getenv("QUERY_CACHE_MAX_ENTRIES", 1024))
+        max_bytes = max_bytes if max_bytes is not None else int(os.getenv("QUERY_CACHE_MAX_BYTES", 64 << 20))
+        ttl = ttl if ttl is not None else float(os.getenv("QUERY_CACHE_TTL", 300))
+        self.embeddings = LRUCache(max_entries, max_bytes, ttl, sizeof=lambda value: value.nbytes + 64)
+        self.results = LRUCache(max_entries, max_bytes, ttl, sizeof=lambda hits: 64 + 32 * len(hits))
+
+    def stats(self) -> Dict[str, Any]:
+        return {"embeddings": self.embeddings.stats(), "results": self.results.stats()}
@@ -1,82 +1,337 @@
 import os
-import tiktoken
-from typing import List, Tuple
-from openai import OpenAI
+import time
+import asyncio
+import logging
+import threading
+import numpy as np
+from typing import Any, AsyncIterator, List, Optional, Sequence, Tuple
 from models.chunk import Chunk
 from models.document import Document
+from services.answer_cache import AnswerCache
+from services.llm_client import create_llm_client
+from services.metrics import STAGE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+NO_API_KEY_MESSAGE = "错误：未配置OpenAI API密钥。请设置OPENAI_API_KEY环境变量。"
+SYSTEM_PROMPT = "你是一个知识渊博的助手，能够基于提供的知识库准确回答问题。如果知识库中没有相关信息，请如实说明。"
+
+# 批量问答：同时进行的大模型调用数、每次批量检索的问题数
+BATCH_QUERY_CONCURRENCY = int(os.getenv("BATCH_QUERY_CONCURRENCY", 8))
+BATCH_QUERY_BLOCK_SIZE = int(os.getenv("BATCH_QUERY_BLOCK_SIZE", 256))
+
+_UNSET = object()  # 大模型客户端尚未创建
+
+# 上下文打包时token预算的最大格数，预算更大时按比例放粗（片段token数向上取整，结果仍不超预算）
+CONTEXT_PACK_RESOLUTION = 4096
+
+
+def estimate_tokens(text: str) -> int:
+    """不分词的保守估计：UTF-8每2字节计1个token（cl100k下英文约4字节、中文约3字节一个token）"""
+    return -(-len(text.encode("utf-8")) // 2)
+
+
+def pack_context(costs: Sequence[int], scores: Sequence[float], budget: int) -> List[int]:
+    """在token预算内选出检索得分之和最大的片段（0/1背包），返回按原排名排列的下标
+
+    全部放得下时直接全选；否则在 numpy 上做动态规划，片段数不超过 top_k，开销可以忽略。
+    得分不大于0的片段视为极小的正分，预算有富余时仍会放入。
+    """
+    if sum(costs) <= budget:
+        return list(range(len(costs)))
+    scale = max(1, -(-budget // CONTEXT_PACK_RESOLUTION))
+    capacity = budget // scale
+    weights = [-(-cost // scale) for cost in costs]
+    best = np.zeros(capacity + 1)
+    taken = np.zeros((len(costs), capacity + 1), dtype=bool)
+    for i, (weight, score) in enumerate(zip(weights, scores)):
+        if weight > capacity:
+            continue
+        candidate = best[:capacity + 1 - weight] + max(score, 1e-6)
+        improved = candidate > best[weight:]
+        taken[i, weight:] = improved
+        best[weight:] = np.where(improved, candidate, best[weight:])
+    selected = []
+    remaining = capacity
+    for i in range(len(costs) - 1, -1, -1):
+        if taken[i, remaining]:
+            selected.append(i)
+            remaining -= weights[i]
+    return selected[::-1]
+
 
 class RetrievalAugmentedGenerator:
-    def __init__(self, vectordb, model_name: str = "qwen3:32b"):
+    def __init__(self, vectordb, model_name: str = "qwen3:32b", answer_cache: AnswerCache = None, client=None):
         self.vectordb = vectordb
         self.model_name = model_name
-        # 兼容qwen3:32b模型的分词器设置
-        if model_name.startswith("qwen3"):
-            # qwen3系列模型没有官方tiktoken分词器，需使用兼容的分词器或估算
-            # 这里简单用cl100k_base作为近似，或根据实际情况替换
-            self.encoding = tiktoken.get_encoding("cl100k_base")
-        else:
-            self.encoding = tiktoken.encoding_for_model(model_name)
-        
-        # 初始化OpenAI客户端
-        api_key = os.getenv("OPENAI_API_KEY")
-        base_url= os.getenv("OPENAI_API_BASE_URL")
-        if not api_key:
-            print("Warning: OPENAI_API_KEY not set in environment variables")
-        self.client = OpenAI(api_key=api_key, base_url=base_url) if api_key else None
-
-    async def generate_answer(self, question: str, top_k: int = 5, max_context_tokens: int = 3000) -> Tuple[str, List[dict]]:
-        """结合检索结果和大模型生成答案"""
-        # 检索相关上下文
-        results = await self.vectordb.search(question, top_k=top_k)
-        
-        # 构建上下文
-        context = ""
-        context_tokens = 0
-        sources = []
+        self.answer_cache = answer_cache if answer_cache is not None else AnswerCache()
+        # 上下文预算按入库时保存的片段token数计算（cl100k_base，qwen3等模型没有官方tiktoken分词器时作为近似）
+
+        # 异步OpenAI客户端，所有请求共享一个连接池，不阻塞事件循环；未传入时在首次使用时创建
+        self._client = client if client is not None else _UNSET
+        self._client_lock = threading.Lock()
+
+    @property
+    def client(self):
+        """大模型客户端，未配置API密钥时为None；启动预热可能在其他线程中首次访问"""
+        if self._client is _UNSET:
+            with self._client_lock:
+                if self._client is _UNSET:
+                    self._client = create_llm_client()
+        return self._client
+
+    async def close(self):
+        """关闭客户端连接池（从未创建过则无需关闭）"""
+        if self._client is not _UNSET and self._client is not None:
+            await self._client.close()
+
+    async def _retrieve(self, question: str, top_k: int, stats: Optional[dict], filters: Optional[dict] = None):
+        """检索片段并查询答案缓存，返回 (检索结果, 上下文键, 问题向量, 缓存的答案)"""
+        with STAGE_SECONDS.time(stage="search"):
+            results = await self.vectordb.search(question, top_k=top_k, stats=stats, filters=filters)
+        return (results, *await self._check_cache(question, results, stats))
+
+    async def _check_cache(self, question: str, results: List[Tuple[Chunk, float]], stats: Optional[dict]):
+        """查询答案缓存，返回 (上下文键, 问题向量, 缓存的答案)"""
+        context_key = self.answer_cache.context_key(chunk.id for chunk, _ in results)
+        question_embedding = None
+        if self.answer_cache.semantic and hasattr(self.vectordb, "embed_question"):
+            question_embedding = await self.vectordb.embed_question(question)
+        cached = self.answer_cache.get(context_key, question, question_embedding)
+        if stats is not None:
+            stats["answer_cache"] = "hit" if cached else "miss"
+        return context_key, question_embedding, cached
+
+    async def _fetch_documents(self, result_lists: List[List[Tuple[Chunk, float]]]) -> dict:
+        """一次查询取回所有检索结果涉及的文档（只取id和文件名）"""
+        document_ids = {chunk.document_id for results in result_lists for chunk, _ in results}
+        if not document_ids:
+            return {}
+        return {
+            document.id: document
+            for document in await Document.filter(id__in=document_ids).only("id", "filename")
+        }
+
+    async def _build_context(self, results: List[Tuple[Chunk, float]], max_context_tokens: int,
+                             documents: dict = None) -> Tuple[str, List[dict]]:
+        """在token上限内选出得分之和最大的片段，按检索排名拼接上下文；documents 为空时一次查询取回所有来源文档
+
+        片段的token数取自入库时保存的 Chunk.token_count，查询时不做任何分词；
+        来源行等格式文字按字节数保守估计。排名靠前的大片段放不下时不会挤掉后面能放下的片段。
+        """
+        started = time.perf_counter()
+        if documents is None:
+            documents = await self._fetch_documents([results])
+        entries, costs = [], []
         for chunk, score in results:
-            document = await Document.get(id=chunk.document_id)
-            chunk_text = f"来源: {document.filename} (位置: {chunk.start_pos}-{chunk.end_pos})\n内容: {chunk.text}\n\n"
-            chunk_tokens = len(self.encoding.encode(chunk_text))
-            
-            if context_tokens + chunk_tokens <= max_context_tokens:
-                context += chunk_text
-                context_tokens += chunk_tokens
-                
-                # 记录来源
-                sources.append({
-                    "document_id": document.id,
-                    "filename": document.filename,
-                    "chunk_id": chunk.id,
-                    "start_pos": chunk.start_pos,
-                    "end_pos": chunk.end_pos,
-                    "similarity_score": score
-                })
-            else:
-                break
-        
+            document = documents.get(chunk.document_id)
+            if document is None:
+                # 检索后文档已被删除
+                continue
+            header = f"来源: {document.filename} (位置: {chunk.start_pos}-{chunk.end_pos})\n内容: "
+            chunk_tokens = chunk.token_count if chunk.token_count is not None else estimate_tokens(chunk.text)
+            entries.append((chunk, score, document, header))
+            costs.append(chunk_tokens + estimate_tokens(header) + 1)
+
+        context_parts = []
+        sources = []
+        for i in pack_context(costs, [score for _, score, _, _ in entries], max_context_tokens):
+            chunk, score, document, header = entries[i]
+            context_parts.append(f"{header}{chunk.text}\n\n")
+
+            # 记录来源
+            sources.append({
+                "document_id": document.id,
+                "filename": document.filename,
+                "chunk_id": chunk.id,
+                "start_pos": chunk.start_pos,
+                "end_pos": chunk.end_pos,
+                "similarity_score": score
+            })
+        STAGE_SECONDS.observe(time.perf_counter() - started, stage="context_build")
+        return "".join(context_parts), sources
+
+    def _messages(self, context: str, question: str) -> List[dict]:
         # 构建提示词
         prompt = f"""基于以下知识库内容回答问题：
         {context}
-        
+
         问题: {question}
         回答: """
-        
+        return [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": prompt}
+        ]
+
+    async def _complete(self, context: str, question: str) -> str:
+        """调用大模型生成答案"""
+        with STAGE_SECONDS.time(stage="llm_total"):
+            response = await self.client.chat.completions.create(
+                model=self.model_name,
+                messages=self._messages(context, question),
+                temperature=0.2,
+                max_tokens=1000
+            )
+        return response.choices[0].message.content.strip()
+
+    async def generate_answer(self, question: str, top_k: int = 5, max_context_tokens: int = 3000, stats: dict = None,
+                              filters: dict = None) -> Tuple[str, List[dict]]:
+        """结合检索结果和大模型生成答案，stats不为None时写入检索统计，filters 限定检索的文档范围
+
+        检索到的片段集合与之前某次相同、且问题相同（或足够相似）时直接返回缓存的答案，
+        stats["answer_cache"] 为 hit / miss。
+        """
+        results, context_key, question_embedding, cached = await self._retrieve(question, top_k, stats, filters)
+        if cached:
+            return cached
+        context, sources = await self._build_context(results, max_context_tokens)
+
         # 调用大模型生成答案
         try:
             if not self.client:
-                return "错误：未配置OpenAI API密钥。请设置OPENAI_API_KEY环境变量。", []
-                
-            response = self.client.chat.completions.create(
+                return NO_API_KEY_MESSAGE, []
+
+            started = time.perf_counter()
+            answer = await self._complete(context, question)
+            self.answer_cache.put(context_key, question, answer, sources, time.perf_counter() - started,
+                                  question_embedding)
+            return answer, sources
+        except Exception as e:
+            logger.error(f"生成答案失败: {e}", exc_info=True)
+            return "抱歉，生成答案时出错。请重试或检查您的API密钥。", []
+
+    async def stream_answer(self, question: str, top_k: int = 5, max_context_tokens: int = 3000,
+                            stats: dict = None, filters: dict = None) -> AsyncIterator[Tuple[str, Any]]:
+        """流式生成答案，依次产出 (事件, 数据)：
+
+        - ("sources", 来源列表)：检索完成后立即产出，首字节时间只取决于检索
+        - ("token", 文本)：大模型每返回一段增量文本产出一次
+        - ("done", {"cached": 是否命中答案缓存}) 或出错时的 ("error", 错误信息)
+        """
+        results, context_key, question_embedding, cached = await self._retrieve(question, top_k, stats, filters)
+        if cached:
+            answer, sources = cached
+            yield "sources", sources
+            yield "token", answer
+            yield "done", {"cached": True}
+            return
+
+        context, sources = await self._build_context(results, max_context_tokens)
+        yield "sources", sources
+        if not self.client:
+            yield "error", NO_API_KEY_MESSAGE
+            return
+
+        parts = []
+        try:
+            started = time.perf_counter()
+            stream = await self.client.chat.completions.create(
                 model=self.model_name,
-                messages=[
-                    {"role": "system", "content": "你是一个知识渊博的助手，能够基于提供的知识库准确回答问题。如果知识库中没有相关信息，请如实说明。"},
-                    {"role": "user", "content": prompt}
-                ],
+                messages=self._messages(context, question),
                 temperature=0.2,
-                max_tokens=1000
+                max_tokens=1000,
+                stream=True
             )
-            
-            return response.choices[0].message.content.strip(), sources
+            try:
+                async for event in stream:
+                    delta = event.choices[0].delta.content if event.choices else None
+                    if delta:
+                        if not parts:
+                            STAGE_SECONDS.observe(time.perf_counter() - started, stage="llm_first_token")
+                        parts.append(delta)
+                        yield "token", delta
+            finally:
+                # 客户端断开时也要释放上游连接
+                await stream.close()
         except Exception as e:
-            print(f"Error generating answer: {e}")
-            return "抱歉，生成答案时出错。请重试或检查您的API密钥。", []    
\ No newline at end of file
+            logger.error(f"流式生成答案失败: {e}", exc_info=True)
+            yield "error", "抱歉，生成答案时出错。请重试或检查您的API密钥。"
+            return
+
+        elapsed = time.perf_counter() - started
+        STAGE_SECONDS.observe(elapsed, stage="llm_total")
+        self.answer_cache.put(context_key, question, "".join(parts).strip(), sources, elapsed, question_embedding)
+        yield "done", {"cached": False}
+
+    async def answer_batch(self, queries: List[Tuple], concurrency: int = None,
+                           max_context_tokens: int = 3000, block_size: int = None) -> AsyncIterator[dict]:
+        """批量问答，按完成顺序产出每个问题的结果
+
+        queries 为 [(问题, top_k)] 或 [(问题, top_k, 过滤条件)]。问题按块检索（每块一次编码、一次矩阵乘法、一次回表），
+        大模型调用最多同时进行 concurrency 个，待取走的结果最多缓存 concurrency 个；
+        并发占满或调用方消费慢时暂停检索下一块，内存占用与批大小无关。
+        每个结果为 {"index", "question", "answer", "sources", "cached"}，出错时为 {"index", "question", "error"}。
+        """
+        queries = [(query[0], query[1], query[2] if len(query) > 2 else None) for query in queries]
+        concurrency = concurrency or BATCH_QUERY_CONCURRENCY
+        block_size = block_size or BATCH_QUERY_BLOCK_SIZE
+        semaphore = asyncio.Semaphore(concurrency)
+        finished = asyncio.Queue(maxsize=concurrency)
+
+        async def answer(index: int, question: str, results: List[Tuple[Chunk, float]], documents: dict) -> dict:
+            try:
+                context_key, question_embedding, cached = await self._check_cache(question, results, None)
+                if cached:
+                    answer, sources = cached
+                else:
+                    context, sources = await self._build_context(results, max_context_tokens, documents)
+                    if not self.client:
+                        answer, sources = NO_API_KEY_MESSAGE, []
+                    else:
+                        started = time.perf_counter()
+                        answer = await self._complete(context, question)
+                        self.answer_cache.put(context_key, question, answer, sources,
+                                              time.perf_counter() - started, question_embedding)
+                return {"index": index, "question": question, "answer": answer, "sources": sources,
+                        "cached": cached is not None}
+            except Exception as e:
+                return {"index": index, "question": question, "error": str(e)}
+
+        async def answer_one(index: int, question: str, results: List[Tuple[Chunk, float]], documents: dict):
+            try:
+                # 调用方消费慢时在这里等待队列空位，并发名额随之占用，检索也随之暂停
+                await finished.put(await answer(index, question, results, documents))
+            finally:
+                semaphore.release()
+
+        async def produce():
+            tasks = set()
+            try:
+                for start in range(0, len(queries), block_size):
+                    block = queries[start:start + block_size]
+                    with STAGE_SECONDS.time(stage="search_batch"):
+                        result_lists = await self.vectordb.search_batch([q for q, _, _ in block],
+                                                                        top_k=[k for _, k, _ in block],
+                                                                        filters=[f for _, _, f in block])
+                    documents = await self._fetch_documents(result_lists)
+                    for offset, ((question, _, _), results) in enumerate(zip(block, result_lists)):
+                        await semaphore.acquire()
+                        task = asyncio.create_task(answer_one(start + offset, question, results, documents))
+                        tasks.add(task)
+                        task.add_done_callback(tasks.discard)
+                if tasks:
+                    await asyncio.gather(*tasks)
+            except asyncio.CancelledError:
+                # 调用方已停止读取，不再放结束标记（队列可能已满）
+                for task in list(tasks):
+                    task.cancel()
+                raise
+            except Exception:
+                for task in list(tasks):
+                    task.cancel()
+                await finished.put(None)
+                raise
+            await finished.put(None)
+
+        producer = asyncio.create_task(produce())
+        try:
+            while True:
+                item = await finished.get()
+                if item is None:
+                    break
+                yield item
+            # 检索阶段的异常在这里抛出
+            await producer
+        finally:
+            if not producer.done():
+                producer.cancel()
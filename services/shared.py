@@ -0,0 +1,27 @@
+"""各控制器共享的服务实例，保证上传、删除和查询使用同一份向量索引"""
+import os
+from services.vector_index import create_vector_index
+from services.keyword_index import create_keyword_index
+from services.ingestion import IngestionQueue
+from services.embedding_cache import EmbeddingCache
+from services.answer_cache import AnswerCache
+
+vector_index = create_vector_index()  # VECTOR_INDEX_BACKEND: exact / ivf / mmap（多worker共享）/ quantized（int8/PQ量化）
+keyword_index = create_keyword_index()  # RETRIEVAL_MODE 为 bm25 / hybrid 时创建，否则为None
+
+# VECTOR_DB_BACKEND: simple 为简化版哈希向量（默认），transformer 为深度学习嵌入模型
+if os.getenv("VECTOR_DB_BACKEND", "simple").lower() == "transformer":
+    from services.vector_db import VectorDB
+    vector_db = VectorDB(index=vector_index, keyword_index=keyword_index)
+else:
+    from services.simple_vector_db import SimpleVectorDB
+    vector_db = SimpleVectorDB(vector_index, keyword_index=keyword_index)  # 使用简化版向量数据库
+
+# 哈希向量的计算比查缓存还快，嵌入缓存默认只对 transformer 后端开启
+_default_cache = "true" if type(vector_db).__name__ == "VectorDB" else "false"
+embedding_cache = EmbeddingCache(vector_db, enabled=os.getenv("EMBEDDING_CACHE", _default_cache).lower() in ("1", "true", "yes"))
+
+ingest_queue = IngestionQueue(vector_db, embedding_cache=embedding_cache)
+
+# 大模型答案缓存，删除文档时清除引用它的答案
+answer_cache = AnswerCache()
@@ -1,66 +1,137 @@
+import os
+import time
+import asyncio
 import numpy as np
-from typing import List, Dict, Any, Tuple
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
+from typing import List, Dict, Any, Tuple, Union
 from models.chunk import Chunk
+from services.query_cache import QueryCache, normalize_question
+from services.term_tokenizer import tokenize_terms
+from services.vector_index import VectorIndex, filters_key, hydrate_hits, hydrate_hit_lists
+from services.keyword_index import BM25Index, retrieval_mode
+from services.hybrid_search import search_hits, search_hits_batch, refresh_indexes
 
 class SimpleVectorDB:
-    """简化的向量数据库实现，不依赖外部模型下载"""
-    
-    def __init__(self):
-        self.vectorizer = TfidfVectorizer(
-            max_features=1000,
-            stop_words='english',
-            ngram_range=(1, 2)
-        )
-        self.is_fitted = False
-        
+    """简化的向量数据库实现，不依赖外部模型下载
+
+    使用无状态的哈希向量化：同一段文本在任何进程、任何时刻都得到相同的向量，
+    上传新文档无需重新拟合，也不会使已存储的向量失效。
+    IDF只作用于查询向量，由索引中每一维的非零行数增量维护。
+    """
+
+    def __init__(self, index: VectorIndex = None, n_features: int = None, query_cache: QueryCache = None,
+                 keyword_index: BM25Index = None, mode: str = None):
+        self.index = index if index is not None else VectorIndex()
+        # 关键词索引存在时按 RETRIEVAL_MODE 做 bm25 / hybrid 检索
+        self.keyword_index = keyword_index
+        self.retrieval_mode = (mode or retrieval_mode()) if keyword_index is not None else "vector"
+        self.query_cache = query_cache if query_cache is not None else QueryCache()
+        self.dim = n_features or int(os.getenv("HASHING_N_FEATURES", 4096))
+        # 嵌入缓存的模型标识，分词或加权方式变化时需要更新版本号
+        self.model_id = f"hashing-v1-{self.dim}"
+        self.vectorizer = None  # 首次计算向量时创建，导入sklearn约需1秒，不计入启动时间
+
+    def _get_vectorizer(self):
+        if self.vectorizer is None:
+            from sklearn.feature_extraction.text import HashingVectorizer
+            self.vectorizer = HashingVectorizer(
+                analyzer=tokenize_terms,
+                n_features=self.dim,
+                alternate_sign=False,
+                norm=None
+            )
+        return self.vectorizer
+
+    def warm_up(self):
+        """预先导入sklearn并创建向量器，供启动预热调用"""
+        self._embed_batch(["warm up"])
+
+    def _embed_batch(self, texts: List[str]) -> np.ndarray:
+        """词频取对数后做L2归一化"""
+        from sklearn.preprocessing import normalize
+        counts = self._get_vectorizer().transform(texts).astype(np.float32)
+        counts.data = 1.0 + np.log(counts.data)
+        return normalize(counts).toarray()
+
     def embed_text(self, text: str) -> np.ndarray:
         """将文本转换为向量表示"""
-        if not self.is_fitted:
-            # 如果还没有拟合，先用当前文本拟合
-            self.vectorizer.fit([text])
-            self.is_fitted = True
-        
-        return self.vectorizer.transform([text]).toarray()[0]
-    
+        return self._embed_batch([text])[0]
+
+    def embed_query(self, query: str) -> np.ndarray:
+        """查询向量按 IDF² 加权，等价于文档和查询两侧都做IDF加权
+
+        缓存的是加权前的向量，IDF随语料变化，每次按当前索引重新加权。
+        """
+        embedding = self._question_embedding(query)
+        idf = self.index.idf()
+        if idf is not None and idf.shape == embedding.shape:
+            embedding = embedding * idf * idf
+        return embedding
+
+    def _question_embedding(self, query: str) -> np.ndarray:
+        key = normalize_question(query)
+        embedding = self.query_cache.embeddings.get(key)
+        if embedding is None:
+            embedding = self.embed_text(query)
+            self.query_cache.embeddings.put(key, embedding)
+        return embedding
+
+    async def embed_question(self, query: str) -> np.ndarray:
+        """问题本身的向量（不含IDF加权），用于比较问题之间的相似度"""
+        return self._question_embedding(query)
+
     async def create_embeddings(self, chunks: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-        """为多个文本片段创建嵌入"""
-        # 收集所有文本用于拟合vectorizer
-        texts = [chunk["text"] for chunk in chunks]
-        
-        # 拟合vectorizer
-        self.vectorizer.fit(texts)
-        self.is_fitted = True
-        
-        # 为每个块生成向量
-        for chunk in chunks:
-            embedding = self.embed_text(chunk["text"])
-            chunk["embedding"] = embedding.tolist()
-        
-        return chunks
-    
-    async def search(self, query: str, top_k: int = 5) -> List[Tuple[Chunk, float]]:
-        """搜索与查询最相似的文本片段"""
-        if not self.is_fitted:
-            # 如果没有数据，返回空结果
-            return []
-            
-        query_embedding = self.embed_text(query)
-        
-        # 查询数据库中的所有嵌入
-        chunks = await Chunk.all()
-        
+        """为多个文本片段创建嵌入，只处理本次的片段"""
         if not chunks:
+            return chunks
+        # 在线程中计算，避免大文档阻塞事件循环
+        embeddings = await asyncio.to_thread(self._embed_batch, [chunk["text"] for chunk in chunks])
+        for chunk, embedding in zip(chunks, embeddings):
+            chunk["embedding"] = embedding
+        return chunks
+
+    async def search(self, query: str, top_k: int = 5, stats: dict = None,
+                     filters: Dict[str, Any] = None) -> List[Tuple[Chunk, float]]:
+        """搜索与查询最相似的文本片段，filters 限定文档范围，stats不为None时写入检索统计"""
+        started = time.perf_counter()
+        key = (normalize_question(query), top_k, filters_key(filters))
+        await refresh_indexes(self.index, self.keyword_index)
+        generation = self.index.generation
+        hits = self.query_cache.results.get(key, generation)
+        if hits is None:
+            # 在常驻内存的向量矩阵/倒排索引上检索，只回表读取命中的片段
+            hits = await search_hits(self.index, self.keyword_index, self.retrieval_mode, query,
+                                     self.embed_query, top_k=top_k, stats=stats, filters=filters)
+            self.query_cache.results.put(key, hits, generation)
+        elif stats is not None:
+            stats.update({
+                "backend": "cache",
+                "candidates": 0,
+                "total": len(self.index),
+                "elapsed_ms": round((time.perf_counter() - started) * 1000, 3),
+            })
+        return await hydrate_hits(hits)
+
+    async def search_batch(self, queries: List[str], top_k: Union[int, List[int]] = 5,
+                           stats: dict = None, filters: List[Dict[str, Any]] = None) -> List[List[Tuple[Chunk, float]]]:
+        """批量检索：一次向量化所有问题，一次矩阵乘法打分，一次回表"""
+        if not queries:
             return []
-        
-        # 计算查询与所有文本片段的相似度
-        similarities = []
-        for chunk in chunks:
-            chunk_embedding = np.array(chunk.embedding)
-            similarity = cosine_similarity([query_embedding], [chunk_embedding])[0][0]
-            similarities.append((chunk, similarity))
-        
-        # 按相似度排序并返回前k个结果
-        similarities.sort(key=lambda x: x[1], reverse=True)
-        return similarities[:top_k]
+        await refresh_indexes(self.index, self.keyword_index)
+        embeddings = None
+        if self.retrieval_mode != "bm25":
+            embeddings = await asyncio.to_thread(self._embed_batch, queries)
+            idf = self.index.idf()
+            if idf is not None and idf.shape[0] == embeddings.shape[1]:
+                embeddings = embeddings * (idf * idf)
+        hit_lists = await search_hits_batch(self.index, self.keyword_index, self.retrieval_mode, queries, embeddings,
+                                            top_k=top_k, stats=stats, filters=filters)
+        return await hydrate_hit_lists(hit_lists)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "backend": "simple",
+            "model": self.model_id,
+            "retrieval_mode": self.retrieval_mode,
+            "keyword_index": self.keyword_index.stats() if self.keyword_index is not None else None,
+            "query_cache": self.query_cache.stats(),
+        }
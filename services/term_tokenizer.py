@@ -0,0 +1,32 @@
+import re
+import unicodedata
+from typing import List
+
+# 其他文字按Unicode词切分（保留 A-123、v1.2 这类编号，包括带重音的拉丁字母和西里尔字母），中日韩文字按连续片段切出
+_CJK_RANGES = "\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\u3040-\u30ff\uac00-\ud7af"
+_WORD_CHAR = rf"[^\W_{_CJK_RANGES}]"
+_TERM_PATTERN = re.compile(rf"{_WORD_CHAR}+(?:[._\-/]{_WORD_CHAR}+)*|[{_CJK_RANGES}]+")
+_CJK_PATTERN = re.compile(rf"[{_CJK_RANGES}]")
+
+
+def normalize_text(text: str) -> str:
+    """NFKC规范化（全角字母数字转半角、合成重音字符）并做大小写折叠（ß -> ss）"""
+    return unicodedata.normalize("NFKC", text).casefold()
+
+
+def tokenize_terms(text: str) -> List[str]:
+    """将文本切分为检索词项，中文等CJK文本生成单字和相邻双字"""
+    terms = []
+    for match in _TERM_PATTERN.finditer(normalize_text(text)):
+        token = match.group()
+        if _CJK_PATTERN.match(token):
+            terms.extend(token)
+            terms.extend(token[i:i + 2] for i in range(len(token) - 1))
+        else:
+            terms.append(token)
+    return terms
+
+
+def is_cjk_character(term: str) -> bool:
+    """CJK单字词项：区分度低，中文语料中几乎每个片段都包含常用单字"""
+    return len(term) == 1 and _CJK_PATTERN.match(term) is not None
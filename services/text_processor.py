@@ -1,20 +1,42 @@
 import re
 import os
+import bisect
+import time
+import logging
+import regex
 import tiktoken
-from typing import List
-from nltk.tokenize import sent_tokenize
-import nltk
-
-# 确保NLTK数据已下载，并增强异常提示
-try:
-    nltk.data.find('tokenizers/punkt')
-except LookupError:
-    try:
-        nltk.download('punkt', quiet=True)
-        nltk.data.find('tokenizers/punkt')
-    except Exception as e:
-        print("[NLTK punkt] 资源下载失败，请检查网络或手动执行: python -m nltk.downloader punkt")
-        raise e
+from typing import Callable, Iterable, Iterator, List
+
+logger = logging.getLogger(__name__)
+
+# 中文句末标点，NLTK的punkt模型不识别
+_CJK_SENTENCE_END = re.compile(r'[\u3002\uff01\uff1f\uff1b]+')
+# 没有punkt模型时按西文句末标点分句
+_LATIN_SENTENCE_END = re.compile(r'(?<=[.!?])\s+')
+
+_sent_tokenize = None
+
+
+def _split_on_punctuation(text: str) -> List[str]:
+    return [sentence for sentence in _LATIN_SENTENCE_END.split(text) if sentence]
+
+
+def get_sentence_tokenizer() -> Callable[[str], List[str]]:
+    """首次分句时才导入NLTK（约1.5秒），运行时从不联网下载模型
+
+    punkt 模型缺失时（离线节点没有预先下载）退回按句末标点分句并记录警告，
+    模型由 prefetch_assets.py 预先下载到 MODEL_CACHE_DIR。
+    """
+    global _sent_tokenize
+    if _sent_tokenize is None:
+        from nltk.tokenize import sent_tokenize
+        try:
+            sent_tokenize("Warm up.")
+            _sent_tokenize = sent_tokenize
+        except LookupError:
+            logger.warning("未找到NLTK punkt 分句模型，改为按句末标点分句；请运行 python prefetch_assets.py 预先下载")
+            _sent_tokenize = _split_on_punctuation
+    return _sent_tokenize
 
 class TextProcessor:
     def __init__(self, 
@@ -27,63 +49,158 @@ class TextProcessor:
         self.encoding = tiktoken.encoding_for_model(model_name)
     
     def chunk_text(self, text: str, document_id: int) -> List[dict]:
-        """将文本分割成多个重叠的片段，修复死循环和推进问题"""
+        """将文本分割成多个重叠的片段，每个片段带有token数"""
+        return self._split(text, document_id)[0]
+
+    def sentence_starts(self, text: str) -> List[int]:
+        """对整段文本只分句一次，返回句子边界的字符偏移（升序）
+
+        除NLTK分句外，中文句末标点（。！？；）处也视为句子边界。边界都挪到所在预分词词的起点：
+        tiktoken先按正则把文本切成词再分别编码，在词边界处切开时各句分别编码后拼接与整段文本编码
+        得到相同的token。例如 cl100k 中句首之前的空格并入后一个词，单个标点与紧随其后的字母
+        合成一个词（"。第二句"），连续的标点自成一个词（"？（"）。
+        """
+        sentences = get_sentence_tokenizer()(text)
+
+        starts = []
+        pos = 0
+        for sent in sentences:
+            found = text.find(sent, pos)
+            if found < 0:
+                continue
+            starts.append(found)
+            pos = found + len(sent)
+        starts.extend(m.end() for m in _CJK_SENTENCE_END.finditer(text))
+
+        words = [m.start() for m in regex.finditer(self.encoding._pat_str, text)]
+        cuts = {words[bisect.bisect_right(words, start) - 1] for start in starts}
+        cuts.discard(0)
+        cuts.discard(len(text))
+        return sorted(cuts)
+
+    def _split(self, text: str, document_id: int, final: bool = True, skip: int = 0):
+        """单遍分段：分句一次，逐句编码一次，句子边界即累计token数，再按边界切分
+
+        返回 (片段列表, 尾部起始token, 尾部文本, 尾部中下一个片段的起始token)。final为False时最后一个片段不产出，
+        由调用方把尾部文本与后续内容拼接后继续分段，并把最后一项作为 skip 传回（第一个片段从该token开始）。
+        """
+        cuts = self.sentence_starts(text)
+        spans = list(zip([0] + cuts, cuts + [len(text)]))
+        tokens = []
+        boundaries = []
+        piece_starts = []  # 每个非空句子的 (起始token, 字符范围)
+        for span, piece_tokens in zip(spans, self.encoding.encode_batch([text[a:b] for a, b in spans])):
+            if piece_tokens:
+                piece_starts.append((len(tokens), span))
+                tokens.extend(piece_tokens)
+                boundaries.append(len(tokens))
+        total = len(tokens)
+        if total - skip <= self.chunk_size:
+            if not final:
+                return [], 0, text, skip
+            return ([self._chunk(document_id, tokens, skip, total)] if total > skip else []), total, "", 0
+
         chunks = []
-        tokens = self.encoding.encode(text)
-
-        if len(tokens) <= self.chunk_size:
-            chunks.append({
-                "document_id": document_id,
-                "text": self.encoding.decode(tokens),
-                "start_pos": 0,
-                "end_pos": len(tokens)
-            })
-            return chunks
-
-        start = 0
-        while start < len(tokens):
-            end = min(start + self.chunk_size, len(tokens))
-            try:
-                # 尝试在句子边界处分割
-                decoded_text = self.encoding.decode(tokens[start:end])
-                sentences = sent_tokenize(decoded_text)
-            except LookupError as e:
-                raise RuntimeError("NLTK punkt 资源缺失，请手动执行: python -m nltk.downloader punkt") from e
-
-            # 默认用 chunk_size 分割
-            new_end = end
-            if len(sentences) > 1:
-                # 尝试在最后一个完整句子后分割
-                last_full_sent_idx = -1
-                total_len = 0
-                for i, sent in enumerate(sentences):
-                    sent_len = len(self.encoding.encode(sent))
-                    if total_len + sent_len <= self.chunk_size * 0.9:
-                        last_full_sent_idx = i
-                        total_len += sent_len
-                    else:
-                        break
-                if last_full_sent_idx >= 0:
-                    end_text = ' '.join(sentences[:last_full_sent_idx+1])
-                    end_tokens = self.encoding.encode(end_text)
-                    new_end = start + len(end_tokens)
-            # 防止死循环：如果分句分割无效或推进太少，强制推进
-            if new_end <= start:
-                new_end = min(start + self.chunk_size, len(tokens))
-            chunk_text = self.encoding.decode(tokens[start:new_end])
-            chunks.append({
-                "document_id": document_id,
-                "text": chunk_text,
-                "start_pos": start,
-                "end_pos": new_end
-            })
-            # 计算下一个块的起始位置（考虑重叠）
-            # 保证 start 一定推进
-            next_start = max(start + self.chunk_size - self.overlap, new_end - self.overlap)
-            if next_start <= start:
-                next_start = start + self.chunk_size  # 兜底推进
+        limit = int(self.chunk_size * 0.9)
+        start, b, prev_end = skip, 0, 0
+        while start < total:
+            # 在上一片段结尾之后、chunk_size*0.9 之内的最后一个句子边界处结束，没有则按 chunk_size 硬切
+            while b < len(boundaries) and boundaries[b] <= max(start, prev_end):
+                b += 1
+            j = b
+            while j + 1 < len(boundaries) and boundaries[j + 1] - start <= limit:
+                j += 1
+            if j < len(boundaries) and boundaries[j] - start <= limit:
+                end = boundaries[j]
+            else:
+                end = min(start + self.chunk_size, total)
+
+            if end >= total and not final:
+                return (chunks, *self._tail(text, tokens, piece_starts, boundaries, start))
+            chunks.append(self._chunk(document_id, tokens, start, end))
+            if end >= total:
+                break
+            prev_end = end
+
+            # 下一个片段从 end - overlap 之后的第一个句子起点开始（重叠区内没有句子边界时按token重叠）
+            next_start = max(end - self.overlap, start + 1)
+            k = j if j < len(boundaries) else len(boundaries) - 1
+            while k > 0 and boundaries[k - 1] >= next_start:
+                k -= 1
+            if boundaries[k] >= next_start and boundaries[k] < end:
+                next_start = boundaries[k]
             start = next_start
-        return chunks
+        return chunks, total, "", 0
+
+    def _tail(self, text: str, tokens: List[int], piece_starts: List[tuple], boundaries: List[int], start: int):
+        """尾部从 start 之前最近的、重新编码后token不变的位置开始保留，返回 (起始token, 尾部文本, skip)
+
+        不能直接解码 tokens[start:]：token可能截断多字节字符，或与前面的字符合并编码，
+        重新编码后token数不同，后续片段的偏移就会错位。找不到这样的位置时从句首保留。
+        """
+        i = bisect.bisect_right([token for token, _ in piece_starts], start) - 1
+        first, (offset, piece_end) = piece_starts[i]
+        piece = text[offset:piece_end]
+        for k in range(start, max(first, start - 16), -1):
+            try:
+                prefix = self.encoding.decode_bytes(tokens[first:k]).decode("utf-8")
+            except UnicodeDecodeError:
+                continue
+            if self.encoding.encode(piece[len(prefix):]) == tokens[k:boundaries[i]]:
+                return k, text[offset + len(prefix):], start - k
+        return first, text[offset:], start - first
+
+    def _chunk(self, document_id: int, tokens: List[int], start: int, end: int) -> dict:
+        return {
+            "document_id": document_id,
+            "text": self.encoding.decode(tokens[start:end]),
+            "start_pos": start,
+            "end_pos": end,
+            "token_count": end - start
+        }
+    
+    def iter_chunks(self, segments: Iterable[str], document_id: int, timings: dict = None) -> Iterator[dict]:
+        """对逐段产出的文本增量地清理和分段，跨页/跨段的内容可以落在同一个片段中
+
+        缓冲区积累到一定长度后分段，除最后一个片段外全部产出，最后一个片段的文本
+        留在缓冲区与后续内容一起继续分段；start_pos/end_pos 为全文的token偏移。
+        timings 不为None时，清理和分段的累计秒数分别加到 timings["clean"] / timings["chunk"]。
+        """
+        timings = timings if timings is not None else {}
+        timings.setdefault("clean", 0.0)
+        timings.setdefault("chunk", 0.0)
+        window = self.chunk_size * 32  # 缓冲区的字符数上限
+        buffer = ""
+        base = skip = 0
+        for segment in segments:
+            started = time.perf_counter()
+            cleaned = self.clean_text(segment)
+            timings["clean"] += time.perf_counter() - started
+            if not cleaned:
+                continue
+            buffer = f"{buffer} {cleaned}" if buffer else cleaned
+            if len(buffer) < window:
+                continue
+
+            started = time.perf_counter()
+            chunks, keep_from, buffer, skip = self._split(buffer, document_id, final=False, skip=skip)
+            timings["chunk"] += time.perf_counter() - started
+            for chunk in chunks:
+                yield self._shift(chunk, base)
+            base += keep_from
+
+        if buffer:
+            started = time.perf_counter()
+            chunks = self._split(buffer, document_id, skip=skip)[0]
+            timings["chunk"] += time.perf_counter() - started
+            for chunk in chunks:
+                yield self._shift(chunk, base)
+
+    @staticmethod
+    def _shift(chunk: dict, offset: int) -> dict:
+        chunk["start_pos"] += offset
+        chunk["end_pos"] += offset
+        return chunk
     
     def clean_text(self, text: str) -> str:
         """清理文本，去除多余空格和特殊字符"""
@@ -1,61 +1,179 @@
 import os
+import time
+import asyncio
+import threading
 import numpy as np
-from typing import List, Dict, Any, Tuple
-import torch
-from transformers import AutoTokenizer, AutoModel
-from sklearn.metrics.pairwise import cosine_similarity
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Tuple, Union
 from models.chunk import Chunk
+from services.micro_batcher import MicroBatcher
+from services.query_cache import QueryCache, normalize_question
+from services.vector_index import VectorIndex, filters_key, hydrate_hits, hydrate_hit_lists
+from services.keyword_index import BM25Index, retrieval_mode
+from services.hybrid_search import search_hits, search_hits_batch, refresh_indexes
 
 class VectorDB:
-    def __init__(self, embedding_model_name: str = None):
+    def __init__(self, embedding_model_name: str = None, index: VectorIndex = None, query_cache: QueryCache = None,
+                 keyword_index: BM25Index = None, mode: str = None):
+        self.index = index if index is not None else VectorIndex()
+        # 关键词索引存在时按 RETRIEVAL_MODE 做 bm25 / hybrid 检索
+        self.keyword_index = keyword_index
+        self.retrieval_mode = (mode or retrieval_mode()) if keyword_index is not None else "vector"
+        self.query_cache = query_cache if query_cache is not None else QueryCache()
         self.embedding_model_name = embedding_model_name or os.getenv("EMBEDDING_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+        self.model_id = self.embedding_model_name  # 嵌入缓存的模型标识
         self.tokenizer = None
         self.model = None
-        self.device = "cuda" if torch.cuda.is_available() else "cpu"
-    
+        self.dim = None
+        # torch 和 transformers 在加载模型时才导入，不计入启动时间
+        self.device = os.getenv("EMBEDDING_DEVICE")
+        self._model_lock = threading.Lock()
+        self.batch_size = int(os.getenv("EMBED_BATCH_SIZE", 32))
+
+        # 模型推理放在独立的单线程执行器中，不阻塞事件循环，也避免多个线程争抢模型
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="embedding")
+        # 查询侧微批：短时间窗口内的并发查询合并为一次前向计算
+        self.query_batcher = MicroBatcher(
+            self._embed_queries,
+            max_batch_size=int(os.getenv("QUERY_BATCH_SIZE", 32)),
+            max_wait_ms=float(os.getenv("QUERY_BATCH_WAIT_MS", 5))
+        )
+
+        # 吞吐和延迟统计
+        self.chunks_embedded = 0
+        self.embedding_seconds = 0.0
+        self.query_latencies = deque(maxlen=2000)
+
     def _initialize_model(self):
-        """延迟初始化嵌入模型，节省资源"""
-        if self.model is None:
+        """延迟初始化嵌入模型，节省资源；启动预热线程和嵌入执行器可能同时调用"""
+        if self.model is not None:
+            return
+        with self._model_lock:
+            if self.model is not None:
+                return
+            import torch
+            from transformers import AutoTokenizer, AutoModel
+            self.device = self.device or ("cuda" if torch.cuda.is_available() else "cpu")
             self.tokenizer = AutoTokenizer.from_pretrained(self.embedding_model_name)
-            self.model = AutoModel.from_pretrained(self.embedding_model_name).to(self.device)
-            self.model.eval()
-    
-    def embed_text(self, text: str) -> np.ndarray:
-        """将文本转换为向量表示"""
+            model = AutoModel.from_pretrained(self.embedding_model_name).to(self.device)
+            model.eval()
+            self.dim = model.config.hidden_size
+            self.model = model
+
+    def warm_up(self):
+        """预先加载嵌入模型并做一次前向计算，供启动预热调用"""
+        self._forward(["warm up"])
+
+    def _forward(self, texts: List[str]) -> np.ndarray:
+        """对一批文本做一次前向计算，按批内最长文本填充"""
+        import torch
         self._initialize_model()
-        
-        # 对文本进行分词
-        inputs = self.tokenizer(text, padding=True, truncation=True, return_tensors="pt", max_length=512)
+
+        inputs = self.tokenizer(texts, padding=True, truncation=True, return_tensors="pt", max_length=512)
         inputs = {k: v.to(self.device) for k, v in inputs.items()}
-        
-        # 获取模型嵌入
+
         with torch.no_grad():
             outputs = self.model(**inputs)
-        
+
         # 使用[CLS]标记的输出作为文本嵌入
-        embeddings = outputs.last_hidden_state[:, 0, :].cpu().numpy()
-        return embeddings.squeeze()
-    
+        return outputs.last_hidden_state[:, 0, :].float().cpu().numpy().astype(np.float32)
+
+    def _length_buckets(self, texts: List[str]) -> List[List[int]]:
+        """按长度排序后切分批次，使同一批内的文本长度接近，减少填充"""
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        return [order[i:i + self.batch_size] for i in range(0, len(order), self.batch_size)]
+
+    def embed_batch(self, texts: List[str]) -> np.ndarray:
+        """同步批量计算向量，结果顺序与输入一致"""
+        embeddings = [None] * len(texts)
+        for bucket in self._length_buckets(texts):
+            for i, embedding in zip(bucket, self._forward([texts[i] for i in bucket])):
+                embeddings[i] = embedding
+        return np.stack(embeddings) if embeddings else np.zeros((0, self.dim or 0), dtype=np.float32)
+
+    def embed_text(self, text: str) -> np.ndarray:
+        """将文本转换为向量表示"""
+        return self.embed_batch([text])[0]
+
+    async def _embed_queries(self, queries: List[str]) -> List[np.ndarray]:
+        loop = asyncio.get_running_loop()
+        return list(await loop.run_in_executor(self.executor, self.embed_batch, queries))
+
     async def create_embeddings(self, chunks: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-        """为多个文本片段创建嵌入"""
-        for chunk in chunks:
-            embedding = self.embed_text(chunk["text"])
-            chunk["embedding"] = embedding.tolist()
+        """为多个文本片段批量创建嵌入，每个批次单独提交到执行器，期间查询仍可插队"""
+        loop = asyncio.get_running_loop()
+        texts = [chunk["text"] for chunk in chunks]
+        started = time.perf_counter()
+        for bucket in self._length_buckets(texts):
+            embeddings = await loop.run_in_executor(self.executor, self._forward, [texts[i] for i in bucket])
+            for i, embedding in zip(bucket, embeddings):
+                chunks[i]["embedding"] = embedding
+        self.chunks_embedded += len(chunks)
+        self.embedding_seconds += time.perf_counter() - started
         return chunks
-    
-    async def search(self, query: str, top_k: int = 5) -> List[Tuple[Chunk, float]]:
-        """搜索与查询最相似的文本片段"""
-        query_embedding = self.embed_text(query)
-        
-        # 查询数据库中的所有嵌入
-        chunks = await Chunk.all()
-        
-        # 计算查询与所有文本片段的相似度
-        similarities = []
-        for chunk in chunks:
-            similarity = cosine_similarity([query_embedding], [np.array(chunk.embedding)])[0][0]
-            similarities.append((chunk, similarity))
-        
-        # 按相似度排序并返回前k个结果
-        similarities.sort(key=lambda x: x[1], reverse=True)
-        return similarities[:top_k]    
\ No newline at end of file
+
+    async def embed_question(self, query: str) -> np.ndarray:
+        """查询向量，优先取缓存，未命中时经微批计算"""
+        question = normalize_question(query)
+        embedding = self.query_cache.embeddings.get(question)
+        if embedding is None:
+            embedding = await self.query_batcher.submit(query)
+            self.query_cache.embeddings.put(question, embedding)
+        return embedding
+
+    async def search(self, query: str, top_k: int = 5, stats: dict = None,
+                     filters: Dict[str, Any] = None) -> List[Tuple[Chunk, float]]:
+        """搜索与查询最相似的文本片段，filters 限定文档范围，stats不为None时写入检索统计"""
+        started = time.perf_counter()
+        question = normalize_question(query)
+        await refresh_indexes(self.index, self.keyword_index)
+        generation = self.index.generation
+        key = (question, top_k, filters_key(filters))
+        hits = self.query_cache.results.get(key, generation)
+        if hits is None:
+            # 在常驻内存的向量矩阵/倒排索引上检索，只回表读取命中的片段（纯关键词模式不计算查询向量）
+            hits = await search_hits(self.index, self.keyword_index, self.retrieval_mode, query,
+                                     self.embed_question, top_k=top_k, stats=stats, filters=filters)
+            self.query_cache.results.put(key, hits, generation)
+        elif stats is not None:
+            stats.update({
+                "backend": "cache",
+                "candidates": 0,
+                "total": len(self.index),
+                "elapsed_ms": round((time.perf_counter() - started) * 1000, 3),
+            })
+        results = await hydrate_hits(hits)
+        self.query_latencies.append(time.perf_counter() - started)
+        return results
+
+    async def search_batch(self, queries: List[str], top_k: Union[int, List[int]] = 5,
+                           stats: dict = None, filters: List[Dict[str, Any]] = None) -> List[List[Tuple[Chunk, float]]]:
+        """批量检索：所有问题按长度分桶一次性编码，一次矩阵乘法打分，一次回表"""
+        if not queries:
+            return []
+        await refresh_indexes(self.index, self.keyword_index)
+        embeddings = None
+        if self.retrieval_mode != "bm25":
+            loop = asyncio.get_running_loop()
+            embeddings = await loop.run_in_executor(self.executor, self.embed_batch, queries)
+        hit_lists = await search_hits_batch(self.index, self.keyword_index, self.retrieval_mode, queries, embeddings,
+                                            top_k=top_k, stats=stats, filters=filters)
+        return await hydrate_hit_lists(hit_lists)
+
+    def stats(self) -> Dict[str, Any]:
+        """入库吞吐（片段/秒）和查询延迟分位数"""
+        latencies = np.array(self.query_latencies) * 1000
+        return {
+            "backend": "transformer",
+            "model": self.embedding_model_name,
+            "retrieval_mode": self.retrieval_mode,
+            "keyword_index": self.keyword_index.stats() if self.keyword_index is not None else None,
+            "chunks_embedded": self.chunks_embedded,
+            "ingest_chunks_per_sec": round(self.chunks_embedded / self.embedding_seconds, 2) if self.embedding_seconds else 0.0,
+            "query_samples": len(latencies),
+            "query_p50_ms": round(float(np.percentile(latencies, 50)), 3) if len(latencies) else 0.0,
+            "query_p99_ms": round(float(np.percentile(latencies, 99)), 3) if len(latencies) else 0.0,
+            "query_mean_batch_size": round(self.query_batcher.mean_batch_size, 2),
+            "query_cache": self.query_cache.stats(),
+        }
@@ -0,0 +1,645 @@
+import os
+import copy
+import time
+import asyncio
+import logging
+import contextlib
+import datetime
+import numpy as np
+from typing import Any, Dict, List, Tuple, Sequence, Optional, Union
+from models.chunk import Chunk
+from models.document import Document
+from services.embedding_codec import row_embedding
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    """按行做L2归一化，零向量保持为零"""
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+FILTER_FIELDS = ("document_ids", "file_type", "upload_date_from", "upload_date_to")
+
+
+def normalize_filters(filters: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """去掉未设置的过滤条件，没有任何条件时返回None"""
+    if not filters:
+        return None
+    active = {name: filters[name] for name in FILTER_FIELDS if filters.get(name) is not None}
+    return active or None
+
+
+def filters_key(filters: Optional[Dict[str, Any]]) -> Optional[tuple]:
+    """过滤条件的可哈希表示，用作检索结果缓存键的一部分"""
+    filters = normalize_filters(filters)
+    if filters is None:
+        return None
+    return tuple(
+        (name, tuple(sorted(set(value))) if name == "document_ids" else
+         value.isoformat() if isinstance(value, datetime.datetime) else value)
+        for name, value in sorted(filters.items())
+    )
+
+
+def _timestamp(value: Optional[datetime.datetime]) -> float:
+    return value.timestamp() if value is not None else 0.0
+
+
+async def iter_embedding_batches(batch_size: int = 5000, dim: int = None, stats: dict = None):
+    """按id顺序分批读取数据库中的向量，产出 (chunk id数组, 文档id数组, 归一化的float32矩阵)
+
+    dim 为None时取第一个向量的维度；没有向量或维度不一致的片段跳过，stats 不为None时
+    写入跳过的片段数（skipped）和读到的最大chunk id（last_id）。
+    """
+    last_id = skipped = 0
+    while True:
+        rows = await Chunk.filter(id__gt=last_id).order_by("id").limit(batch_size).values_list(
+            "id", "document_id", "embedding_blob", "embedding_dim", "embedding_dtype", "embedding"
+        )
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        vectors, chunk_ids, document_ids = [], [], []
+        for chunk_id, document_id, blob, blob_dim, dtype, legacy in rows:
+            embedding = row_embedding(blob, blob_dim, dtype, legacy)
+            if embedding is None:
+                skipped += 1
+                continue
+            if dim is None:
+                dim = len(embedding)
+            if len(embedding) != dim:
+                logger.warning(f"跳过维度不一致的向量: chunk {chunk_id} ({len(embedding)} != {dim})")
+                skipped += 1
+                continue
+            chunk_ids.append(chunk_id)
+            document_ids.append(document_id)
+            vectors.append(embedding)
+        if stats is not None:
+            stats.update(skipped=skipped, last_id=last_id)
+        if vectors:
+            yield (np.array(chunk_ids, dtype=np.int64), np.array(document_ids, dtype=np.int64),
+                   normalize_rows(np.vstack(vectors)))
+
+
+async def load_document_meta() -> Dict[int, Tuple[str, float]]:
+    """所有文档的过滤用元数据：文档id -> (文件类型, 上传时间戳)"""
+    return {
+        document_id: (file_type, _timestamp(upload_date))
+        for document_id, file_type, upload_date in await Document.all().values_list("id", "file_type", "upload_date")
+    }
+
+
+class VectorIndex:
+    """常驻内存的向量索引：预归一化的float32矩阵 + 并行的chunk id / document id数组
+
+    另外保存每个文档的元数据（文件类型、上传时间），检索时的过滤条件先在文档级别用
+    预先构建的位图求出命中的文档，再取这些文档的行范围，只扫描范围内的行。
+    """
+
+    def __init__(self):
+        self.matrix = np.zeros((0, 0), dtype=np.float32)
+        self.chunk_ids = np.zeros(0, dtype=np.int64)
+        self.document_ids = np.zeros(0, dtype=np.int64)
+        # 每一维上非零的行数，供哈希词频向量计算IDF
+        self.nonzero_counts = np.zeros(0, dtype=np.int64)
+        self.loaded = False
+        # 语料代号：每次加入或移除片段后递增，查询缓存据此判断结果是否过期
+        self.generation = 0
+        self._row_lookup = None  # (generation, 按chunk id排序的行号, 排序后的chunk id)
+        self._document_rows = None  # (generation, 按文档排序的行号, 文档id, 起始偏移, 结束偏移)
+        self.documents = {}  # 文档id -> (文件类型, 上传时间戳)
+        self._document_table = None  # 惰性构建的 (文档id数组, {文件类型: 位图}, 上传时间戳数组)
+
+    def __len__(self) -> int:
+        return len(self.chunk_ids)
+
+    @property
+    def dim(self) -> int:
+        return self.matrix.shape[1]
+
+    def refresh(self) -> Optional[dict]:
+        """同步其他进程对共享索引的修改；常驻内存的索引只由本进程修改，没有需要同步的变化"""
+        return None
+
+    async def load(self, batch_size: int = 5000, dim: int = None):
+        """从数据库分批构建索引，启动时调用一次；指定dim时跳过其他维度的旧向量"""
+        matrix_parts, chunk_ids, document_ids = [], [], []
+        async for batch_chunk_ids, batch_document_ids, vectors in iter_embedding_batches(batch_size, dim):
+            chunk_ids.append(batch_chunk_ids)
+            document_ids.append(batch_document_ids)
+            matrix_parts.append(vectors)
+
+        self.matrix = np.vstack(matrix_parts) if matrix_parts else np.zeros((0, 0), dtype=np.float32)
+        self.chunk_ids = np.concatenate(chunk_ids) if chunk_ids else np.zeros(0, dtype=np.int64)
+        self.document_ids = np.concatenate(document_ids) if document_ids else np.zeros(0, dtype=np.int64)
+        self.nonzero_counts = np.count_nonzero(self.matrix, axis=0).astype(np.int64)
+        self.documents = await load_document_meta()
+        self._document_table = None
+        self.loaded = True
+        self.generation += 1
+        logger.info(f"向量索引已加载: {len(self)} 个片段, 维度 {self.dim}")
+
+    def register_document(self, document_id: int, file_type: str, upload_date: Optional[datetime.datetime]):
+        """登记文档的过滤用元数据，入库时在加入片段前调用"""
+        meta = (file_type, _timestamp(upload_date))
+        if self.documents.get(document_id) != meta:
+            self.documents[document_id] = meta
+            self._document_table = None
+
+    @contextlib.asynccontextmanager
+    async def write_lock(self):
+        """事件循环中增删片段前持有的写入锁；常驻内存的索引只由本进程修改，不需要加锁"""
+        yield
+
+    def read_view(self) -> "VectorIndex":
+        """在事件循环中取当前版本的只读视图（浅拷贝），供线程中检索
+
+        增删都整体替换数组而不是原地修改，视图在检索期间不受事件循环中后续修改的影响；
+        过滤用的文档表先在事件循环中建好，原地修改的字段由子类复制一份。
+        """
+        self._documents_table()
+        return copy.copy(self)
+
+    def adopt_caches(self, view: "VectorIndex"):
+        """取回视图在线程中建好的行号查找表，语料没有变化时供后续检索复用"""
+        if view._row_lookup is not None and view._row_lookup[0] == self.generation:
+            self._row_lookup = view._row_lookup
+        if view._document_rows is not None and view._document_rows[0] == self.generation:
+            self._document_rows = view._document_rows
+
+    def add_document(self, document_id: int, chunk_ids: Sequence[int], embeddings: Sequence[Sequence[float]]):
+        """增量加入一个文档的所有片段向量"""
+        self.add_documents([(document_id, chunk_ids, embeddings)])
+
+    def add_documents(self, documents: Sequence[Tuple[int, Sequence[int], Sequence[Sequence[float]]]]):
+        """一次加入多个文档的片段向量，documents 为 (document_id, chunk_ids, embeddings)
+
+        矩阵整体只拼接一次：批量导入时逐个文档 vstack 会反复复制整个矩阵。
+        """
+        parts = []
+        dim = self.dim if len(self) else None
+        for document_id, chunk_ids, embeddings in documents:
+            if not len(chunk_ids):
+                continue
+            vectors = normalize_rows(np.asarray(embeddings, dtype=np.float32).reshape(len(chunk_ids), -1))
+            if dim is not None and vectors.shape[1] != dim:
+                logger.warning(f"文档 {document_id} 的向量维度 {vectors.shape[1]} 与索引维度 {dim} 不一致，未加入索引")
+                continue
+            dim = vectors.shape[1]
+            parts.append((document_id, np.asarray(chunk_ids, dtype=np.int64), vectors))
+        if parts:
+            self._append(np.concatenate([np.full(len(chunk_ids), document_id, dtype=np.int64)
+                                         for document_id, chunk_ids, _ in parts]),
+                         np.concatenate([chunk_ids for _, chunk_ids, _ in parts]),
+                         np.vstack([vectors for _, _, vectors in parts]))
+
+    def _append(self, document_ids: np.ndarray, chunk_ids: np.ndarray, vectors: np.ndarray):
+        """追加已归一化的行"""
+        if len(self):
+            self.matrix = np.vstack([self.matrix, vectors])
+            self.nonzero_counts += np.count_nonzero(vectors, axis=0)
+        else:
+            self.matrix = vectors
+            self.nonzero_counts = np.count_nonzero(vectors, axis=0).astype(np.int64)
+        self.chunk_ids = np.concatenate([self.chunk_ids, chunk_ids])
+        self.document_ids = np.concatenate([self.document_ids, document_ids])
+        self.generation += 1
+
+    def remove_document(self, document_id: int):
+        """从索引中移除一个文档的所有片段"""
+        if self.documents.pop(document_id, None) is not None:
+            self._document_table = None
+        keep = self.document_ids != document_id
+        if keep.all():
+            return
+        self.nonzero_counts -= np.count_nonzero(self.matrix[~keep], axis=0)
+        self.matrix = self.matrix[keep]
+        self.chunk_ids = self.chunk_ids[keep]
+        self.document_ids = self.document_ids[keep]
+        self.generation += 1
+
+    def idf(self):
+        """平滑IDF: log((1+N)/(1+df)) + 1，索引为空时返回None"""
+        if not len(self):
+            return None
+        return (np.log((1 + len(self)) / (1 + self.nonzero_counts)) + 1).astype(np.float32)
+
+    def _prepare_query(self, query_embedding: np.ndarray) -> Optional[np.ndarray]:
+        """归一化查询向量，索引为空或维度不一致时返回None"""
+        if not len(self):
+            return None
+        query = normalize_rows(np.asarray(query_embedding, dtype=np.float32).ravel())
+        if query.shape[0] != self.dim:
+            logger.warning(f"查询向量维度 {query.shape[0]} 与索引维度 {self.dim} 不一致")
+            return None
+        return query
+
+    def _top_k(self, scores: np.ndarray, rows: Optional[np.ndarray], top_k: int) -> List[Tuple[int, float]]:
+        """argpartition 取前k个并排序；rows为scores对应的行号，None表示全部行"""
+        k = min(top_k, len(scores))
+        if k <= 0:
+            return []
+        if k < len(scores):
+            top = np.argpartition(-scores, k - 1)[:k]
+        else:
+            top = np.arange(len(scores))
+        top = top[np.argsort(-scores[top])]
+        top_rows = top if rows is None else rows[top]
+        return list(zip(self.chunk_ids[top_rows].tolist(), scores[top].tolist()))
+
+    def _exact(self, query: Optional[np.ndarray], rows: Optional[np.ndarray], top_k: int) -> List[Tuple[int, float]]:
+        """在全部行（rows为None）或给定的行上精确打分取前k个"""
+        if query is None:
+            return []
+        if rows is None:
+            return self._top_k(self.matrix @ query, None, top_k)
+        return self._top_k(self.matrix[rows] @ query, rows, top_k) if len(rows) else []
+
+    def search(self, query_embedding: np.ndarray, top_k: int = 5, stats: dict = None,
+               filters: Dict[str, Any] = None) -> List[Tuple[int, float]]:
+        """精确检索：一次矩阵向量乘法 + argpartition 取前k个，返回 (chunk_id, 相似度)
+
+        filters 可包含 document_ids / file_type / upload_date_from / upload_date_to，
+        只扫描满足条件的文档的行，结果仍是范围内真正的前k个。
+        stats 不为None时写入本次检索的统计信息（后端、扫描的候选数、耗时）
+        """
+        started = time.perf_counter()
+        query = self._prepare_query(query_embedding)
+        rows = self.filter_rows(filters)
+        hits = self._exact(query, rows, top_k)
+        if stats is not None:
+            stats.update({
+                "backend": "exact",
+                "candidates": (len(self) if rows is None else len(rows)) if query is not None else 0,
+                "total": len(self),
+                "filtered": rows is not None,
+                "elapsed_ms": round((time.perf_counter() - started) * 1000, 3),
+            })
+        return hits
+
+    def _documents_table(self):
+        if self._document_table is None:
+            document_ids = np.array(sorted(self.documents), dtype=np.int64)
+            type_bitmaps = {}
+            uploaded = np.zeros(len(document_ids), dtype=np.float64)
+            for i, document_id in enumerate(document_ids.tolist()):
+                file_type, uploaded[i] = self.documents[document_id]
+                type_bitmaps.setdefault(file_type, np.zeros(len(document_ids), dtype=bool))[i] = True
+            self._document_table = (document_ids, type_bitmaps, uploaded)
+        return self._document_table
+
+    def filter_documents(self, filters: Optional[Dict[str, Any]]) -> Optional[np.ndarray]:
+        """满足过滤条件的文档id（升序），没有过滤条件时返回None"""
+        filters = normalize_filters(filters)
+        if filters is None:
+            return None
+        document_ids, type_bitmaps, uploaded = self._documents_table()
+        mask = np.ones(len(document_ids), dtype=bool)
+        if "document_ids" in filters:
+            mask &= np.isin(document_ids, np.asarray(list(filters["document_ids"]), dtype=np.int64))
+        if "file_type" in filters:
+            bitmap = type_bitmaps.get(filters["file_type"])
+            mask &= bitmap if bitmap is not None else False
+        if "upload_date_from" in filters:
+            mask &= uploaded >= _timestamp(filters["upload_date_from"])
+        if "upload_date_to" in filters:
+            mask &= uploaded <= _timestamp(filters["upload_date_to"])
+        return document_ids[mask]
+
+    def _rows_by_document(self):
+        """按文档id排序的行号及每个文档的行范围，语料变化后惰性重建"""
+        if self._document_rows is None or self._document_rows[0] != self.generation:
+            order = np.argsort(self.document_ids, kind="stable")
+            document_ids, starts = np.unique(self.document_ids[order], return_index=True)
+            ends = np.append(starts[1:], len(order)).astype(starts.dtype)
+            self._document_rows = (self.generation, order, document_ids, starts, ends)
+        return self._document_rows[1:]
+
+    def rows_for_documents(self, document_ids: Sequence[int]) -> np.ndarray:
+        """若干文档的所有行号"""
+        document_ids = np.asarray(document_ids, dtype=np.int64)
+        if not len(self) or not len(document_ids):
+            return np.zeros(0, dtype=np.int64)
+        if len(document_ids) > 1000:
+            # 文档很多时直接按行比较，比逐个拼接行范围更快
+            return np.flatnonzero(np.isin(self.document_ids, document_ids))
+        order, indexed, starts, ends = self._rows_by_document()
+        positions = np.minimum(np.searchsorted(indexed, document_ids), len(indexed) - 1)
+        found = indexed[positions] == document_ids
+        ranges = [order[start:end] for start, end in zip(starts[positions[found]], ends[positions[found]])]
+        return np.concatenate(ranges) if ranges else np.zeros(0, dtype=np.int64)
+
+    def filter_rows(self, filters: Optional[Dict[str, Any]]) -> Optional[np.ndarray]:
+        """满足过滤条件的行号，没有过滤条件时返回None（全部行）"""
+        document_ids = self.filter_documents(filters)
+        return None if document_ids is None else self.rows_for_documents(document_ids)
+
+    def rows_for(self, chunk_ids: Sequence[int]) -> np.ndarray:
+        """chunk id 对应的行号，不在索引中的为-1；按id排序的查找表在语料变化后惰性重建"""
+        chunk_ids = np.asarray(chunk_ids, dtype=np.int64)
+        if not len(self):
+            return np.full(len(chunk_ids), -1, dtype=np.int64)
+        if self._row_lookup is None or self._row_lookup[0] != self.generation:
+            order = np.argsort(self.chunk_ids, kind="stable")
+            self._row_lookup = (self.generation, order, self.chunk_ids[order])
+        _, order, sorted_ids = self._row_lookup
+        positions = np.minimum(np.searchsorted(sorted_ids, chunk_ids), len(sorted_ids) - 1)
+        return np.where(sorted_ids[positions] == chunk_ids, order[positions], -1)
+
+    def search_rows(self, query_embedding: np.ndarray, rows: np.ndarray, top_k: int = 5,
+                    stats: dict = None) -> List[Tuple[int, float]]:
+        """只在给定的行上精确检索，用于关键词候选等已缩小的范围，扫描量与行数成正比"""
+        started = time.perf_counter()
+        query = self._prepare_query(query_embedding)
+        rows = np.asarray(rows, dtype=np.int64)
+        hits = self._exact(query, rows, top_k)
+        if stats is not None:
+            stats.update({
+                "backend": "exact(subset)",
+                "candidates": len(rows) if query is not None else 0,
+                "total": len(self),
+                "elapsed_ms": round((time.perf_counter() - started) * 1000, 3),
+            })
+        return hits
+
+    def search_batch(self, query_embeddings: np.ndarray, top_k: Union[int, Sequence[int]] = 5,
+                     stats: dict = None, max_block_cells: int = 1 << 26,
+                     filters: Sequence[Optional[Dict[str, Any]]] = None) -> List[List[Tuple[int, float]]]:
+        """批量精确检索：多条查询与语料做矩阵-矩阵乘法，每条查询各自取前k个
+
+        top_k 可以是每条查询各自的k；查询按块计算，每块的得分矩阵不超过 max_block_cells 个元素。
+        filters 为每条查询各自的过滤条件，带过滤条件的查询单独在过滤后的行上检索。
+        """
+        started = time.perf_counter()
+        queries = np.asarray(query_embeddings, dtype=np.float32).reshape(len(query_embeddings), -1)
+        top_ks = [top_k] * len(queries) if isinstance(top_k, int) else list(top_k)
+        filters = list(filters) if filters is not None else [None] * len(queries)
+        results = [[] for _ in range(len(queries))]
+        # 分块大小按实际参与打分的矩阵行数计算（含失效行），而不是有效行数
+        matrix = self.matrix
+        if len(self) and len(queries) and queries.shape[1] != self.dim:
+            logger.warning(f"查询向量维度 {queries.shape[1]} 与索引维度 {self.dim} 不一致")
+        elif len(self) and len(queries):
+            plain = []
+            for i, query_filters in enumerate(filters):
+                if normalize_filters(query_filters) is None:
+                    plain.append(i)
+                else:
+                    results[i] = self.search(queries[i], top_k=top_ks[i], filters=query_filters)
+            plain_queries = normalize_rows(queries[plain])
+            block = max(1, max_block_cells // len(matrix))
+            for start in range(0, len(plain), block):
+                scores = plain_queries[start:start + block] @ matrix.T
+                for i, row in enumerate(scores):
+                    results[plain[start + i]] = self._top_k(row, None, top_ks[plain[start + i]])
+        if stats is not None:
+            stats.update({
+                "backend": "exact",
+                "queries": len(queries),
+                "total": len(self),
+                "elapsed_ms": round((time.perf_counter() - started) * 1000, 3),
+            })
+        return results
+
+
+class IVFIndex(VectorIndex):
+    """倒排文件(IVF)近似最近邻索引
+
+    用球面k-means把向量分成nlist个簇，查询时只扫描与查询最接近的nprobe个簇。
+    nprobe越大召回越高、延迟越高；数据量小于min_train_size时退化为精确检索。
+    新增向量直接分配到最近的簇，数据量翻倍后在后台线程重新训练聚类中心，
+    训练期间继续用旧的聚类中心（或精确检索）查询，训练完成后在事件循环中整体替换。
+    """
+
+    def __init__(self, nlist: int = None, nprobe: int = None, min_train_size: int = None):
+        super().__init__()
+        self.nlist = nlist or int(os.getenv("IVF_NLIST", 0))  # 0 表示按 4*sqrt(N) 自动选择
+        self.nprobe = nprobe or int(os.getenv("IVF_NPROBE", 8))
+        self.min_train_size = min_train_size or int(os.getenv("IVF_MIN_TRAIN_SIZE", 10000))
+        self.centroids = None
+        self.assignments = np.zeros(0, dtype=np.int32)
+        self.trained_size = 0
+        self._lists = None
+        self._removals = 0  # 移除或重新加载的次数，判断训练期间已有的行是否变化
+        self._training = None  # 进行中的后台训练任务
+
+    async def load(self, batch_size: int = 5000, dim: int = None):
+        await super().load(batch_size=batch_size, dim=dim)
+        self.centroids = None
+        self.assignments = np.zeros(0, dtype=np.int32)
+        self.trained_size = 0
+        self._removals += 1
+        self._lists = None
+        if self._needs_training():
+            snapshot = self._snapshot()
+            self._install(snapshot, *await asyncio.to_thread(self._train, snapshot[0]))
+
+    def _append(self, document_ids: np.ndarray, chunk_ids: np.ndarray, vectors: np.ndarray):
+        size_before = len(self)
+        super()._append(document_ids, chunk_ids, vectors)
+        if self.centroids is not None and len(self) > size_before:
+            self.assignments = np.concatenate([self.assignments, self._assign(self.matrix[size_before:])])
+            self._lists = None
+        self._maybe_train()
+
+    def remove_document(self, document_id: int):
+        if self.centroids is not None:
+            self.assignments = self.assignments[self.document_ids != document_id]
+            self._lists = None
+        self._removals += 1
+        super().remove_document(document_id)
+
+    def _needs_training(self) -> bool:
+        """数据量达到阈值且比上次训练时翻倍"""
+        return len(self) >= self.min_train_size and len(self) >= 2 * self.trained_size
+
+    def adopt_caches(self, view: "IVFIndex"):
+        super().adopt_caches(view)
+        if self._lists is None and view.assignments is self.assignments:
+            self._lists = view._lists
+
+    def _snapshot(self) -> Tuple[np.ndarray, np.ndarray, int]:
+        # 增删都会替换数组而不是原地修改，后台线程可以直接读取快照
+        return self.matrix, self.chunk_ids, self._removals
+
+    def _maybe_train(self):
+        """需要时重新训练；在事件循环中由后台线程训练，没有事件循环时（脚本、基准测试）直接训练"""
+        if self._training is not None or not self._needs_training():
+            return
+        snapshot = self._snapshot()
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._install(snapshot, *self._train(snapshot[0]))
+            return
+        self._training = loop.create_task(self._train_in_background(snapshot))
+
+    async def _train_in_background(self, snapshot: Tuple[np.ndarray, np.ndarray, int]):
+        try:
+            self._install(snapshot, *await asyncio.to_thread(self._train, snapshot[0]))
+        except Exception as e:
+            logger.error(f"IVF索引训练失败: {e}", exc_info=True)
+        finally:
+            self._training = None
+
+    def _train(self, matrix: np.ndarray, iterations: int = 10, seed: int = 0) -> Tuple[np.ndarray, np.ndarray]:
+        """在给定的行上训练聚类中心，返回 (聚类中心, 这些行所属的簇)；不修改索引，可在线程中运行"""
+        nlist = self.nlist or int(4 * np.sqrt(len(matrix)))
+        nlist = max(1, min(nlist, len(matrix)))
+        rng = np.random.default_rng(seed)
+        sample_size = min(len(matrix), 64 * nlist, 100_000)
+        sample = matrix[np.sort(rng.choice(len(matrix), sample_size, replace=False))]
+        centroids = sample[rng.choice(sample_size, nlist, replace=False)].copy()
+        for _ in range(iterations):
+            labels = np.argmax(sample @ centroids.T, axis=1)
+            # 按簇排序后分段求和，代替逐簇的布尔索引；空簇保留原来的中心
+            order = np.argsort(labels, kind="stable")
+            counts = np.bincount(labels, minlength=nlist)
+            filled = np.flatnonzero(counts)
+            starts = np.concatenate([[0], np.cumsum(counts)[:-1]])[filled]
+            centroids[filled] = np.add.reduceat(sample[order], starts, axis=0)
+            centroids = normalize_rows(centroids)
+        return centroids, self._assign(matrix, centroids)
+
+    def _install(self, snapshot: Tuple[np.ndarray, np.ndarray, int], centroids: np.ndarray, assignments: np.ndarray):
+        """替换聚类中心和簇分配：训练期间新加入的行分配到新的中心，训练期间有删除时按chunk id对齐"""
+        _, chunk_ids, removals = snapshot
+        if removals == self._removals:
+            tail = self._assign(self.matrix[len(chunk_ids):], centroids)
+            assignments = np.concatenate([assignments, tail])
+        else:
+            order = np.argsort(chunk_ids)
+            rows = order[np.searchsorted(chunk_ids, self.chunk_ids, sorter=order).clip(max=len(order) - 1)]
+            known = chunk_ids[rows] == self.chunk_ids
+            assignments = assignments[rows]
+            assignments[~known] = self._assign(self.matrix[~known], centroids)
+        self.centroids = centroids
+        self.assignments = assignments
+        self.trained_size = len(chunk_ids)
+        self._lists = None
+        logger.info(f"IVF索引训练完成: {len(chunk_ids)} 个向量, {len(centroids)} 个簇")
+
+    def _assign(self, vectors: np.ndarray, centroids: np.ndarray = None, batch_size: int = 65536) -> np.ndarray:
+        """把向量分配到最近的聚类中心（默认为当前的聚类中心）"""
+        centroids = self.centroids if centroids is None else centroids
+        labels = [np.argmax(vectors[i:i + batch_size] @ centroids.T, axis=1)
+                  for i in range(0, len(vectors), batch_size)]
+        return np.concatenate(labels).astype(np.int32) if labels else np.zeros(0, dtype=np.int32)
+
+    def _inverted_lists(self) -> Tuple[np.ndarray, np.ndarray]:
+        """按簇排序的行号及每个簇的起止偏移，数据变化后惰性重建"""
+        if self._lists is None:
+            order = np.argsort(self.assignments, kind="stable")
+            offsets = np.searchsorted(self.assignments[order], np.arange(len(self.centroids) + 1))
+            self._lists = (order, offsets)
+        return self._lists
+
+    def search(self, query_embedding: np.ndarray, top_k: int = 5, stats: dict = None,
+               filters: Dict[str, Any] = None) -> List[Tuple[int, float]]:
+        """只扫描nprobe个簇；有过滤条件时只保留簇内满足条件的行
+
+        过滤后的行数不多于要扫描的簇，或簇内满足条件的行不足top_k时，直接在过滤后的行上精确检索，
+        保证返回范围内的top_k个结果。
+        """
+        if self.centroids is None:
+            hits = super().search(query_embedding, top_k=top_k, stats=stats, filters=filters)
+            if stats is not None:
+                stats["backend"] = "ivf(untrained)"
+            return hits
+
+        started = time.perf_counter()
+        query = self._prepare_query(query_embedding)
+        scope = self.filter_rows(filters)
+        hits, rows = [], np.zeros(0, dtype=np.int64)
+        nprobe = min(self.nprobe, len(self.centroids))
+        backend = "ivf"
+        if query is not None:
+            order, offsets = self._inverted_lists()
+            centroid_scores = self.centroids @ query
+            probe = np.argpartition(-centroid_scores, nprobe - 1)[:nprobe]
+            rows = np.concatenate([order[offsets[c]:offsets[c + 1]] for c in probe])
+            if scope is not None and len(scope) <= len(rows):
+                rows, backend = scope, "ivf(filtered exact)"
+            elif scope is not None:
+                in_scope = np.zeros(len(self), dtype=bool)
+                in_scope[scope] = True
+                rows = rows[in_scope[rows]]
+            hits = self._exact(query, rows, top_k)
+            if scope is not None and len(hits) < min(top_k, len(scope)):
+                # 探测的簇中满足条件的行不足top_k个
+                rows, backend = scope, "ivf(filtered exact)"
+                hits = self._exact(query, rows, top_k)
+        if stats is not None:
+            stats.update({
+                "backend": backend,
+                "nlist": len(self.centroids),
+                "nprobe": nprobe,
+                "candidates": len(rows),
+                "total": len(self),
+                "filtered": scope is not None,
+                "elapsed_ms": round((time.perf_counter() - started) * 1000, 3),
+            })
+        return hits
+
+    def search_batch(self, query_embeddings: np.ndarray, top_k: Union[int, Sequence[int]] = 5,
+                     stats: dict = None, max_block_cells: int = 1 << 26,
+                     filters: Sequence[Optional[Dict[str, Any]]] = None) -> List[List[Tuple[int, float]]]:
+        """训练前退化为批量精确检索，训练后逐条查询只扫描各自的nprobe个簇"""
+        if self.centroids is None:
+            results = super().search_batch(query_embeddings, top_k, stats=stats, max_block_cells=max_block_cells,
+                                           filters=filters)
+            if stats is not None:
+                stats["backend"] = "ivf(untrained)"
+            return results
+
+        started = time.perf_counter()
+        top_ks = [top_k] * len(query_embeddings) if isinstance(top_k, int) else list(top_k)
+        filters = list(filters) if filters is not None else [None] * len(top_ks)
+        results = [self.search(query, top_k=k, filters=f) for query, k, f in zip(query_embeddings, top_ks, filters)]
+        if stats is not None:
+            stats.update({
+                "backend": "ivf",
+                "queries": len(results),
+                "total": len(self),
+                "elapsed_ms": round((time.perf_counter() - started) * 1000, 3),
+            })
+        return results
+
+
+def create_vector_index() -> VectorIndex:
+    """根据环境变量 VECTOR_INDEX_BACKEND (exact / ivf / mmap / quantized) 创建向量索引"""
+    backend = os.getenv("VECTOR_INDEX_BACKEND", "exact").lower()
+    if backend == "exact":
+        return VectorIndex()
+    if backend == "ivf":
+        return IVFIndex()
+    if backend == "mmap":
+        from services.mmap_index import MmapVectorIndex
+        return MmapVectorIndex()
+    if backend == "quantized":
+        from services.quantized_index import QuantizedIndex
+        return QuantizedIndex()
+    raise ValueError(f"不支持的向量索引类型: {backend}")
+
+
+# 回表时读取的片段列
+HIT_FIELDS = ("id", "document_id", "text", "start_pos", "end_pos", "token_count")
+
+
+async def hydrate_hits(hits: List[Tuple[int, float]]) -> List[Tuple[Chunk, float]]:
+    """一次查询读取命中的片段，只取生成上下文需要的列（不读向量），并保持排序"""
+    return (await hydrate_hit_lists([hits]))[0]
+
+
+async def hydrate_hit_lists(hit_lists: List[List[Tuple[int, float]]]) -> List[List[Tuple[Chunk, float]]]:
+    """批量检索的结果合并为一次查询回表"""
+    chunk_ids = {chunk_id for hits in hit_lists for chunk_id, _ in hits}
+    if not chunk_ids:
+        return [[] for _ in hit_lists]
+    chunks = await Chunk.filter(id__in=list(chunk_ids)).only(*HIT_FIELDS)
+    by_id = {chunk.id: chunk for chunk in chunks}
+    return [[(by_id[chunk_id], score) for chunk_id, score in hits if chunk_id in by_id] for hits in hit_lists]
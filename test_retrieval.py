@@ -0,0 +1,984 @@
+#!/usr/bin/env python3
+"""
+检索路径测试
+- 每次问答读取数据库的次数应为常数，与 top_k 和语料规模无关（不允许N+1查询）
+- 带过滤条件的检索只扫描范围内的行，并且仍返回 top_k 个结果
+- 查询缓存：按LRU和字节上限淘汰，过期后不再返回；文档入库使索引代号变化后旧的检索结果失效
+- 模型嵌入：按长度分桶计算后结果仍按输入顺序，并发的查询在微批窗口内合并为一次前向计算
+- 冷启动：导入应用时不加载解析库、嵌入模型、分句和分词库
+- 上下文打包不因排名靠前的大片段放不下而丢掉后面的片段
+- 共享的内存映射索引：一个实例写入或删除后，另一个实例检索前同步，结果与常驻内存的索引一致；
+  等待写入锁和压缩都不阻塞事件循环
+- 量化索引：压缩码近似打分后精排，返回的片段和得分与精确检索一致；删除标记失效行，压缩和重新训练在后台进行
+- /metrics 指标导出：直方图按 le 累积分桶并带 _sum/_count，仪表和缓存统计在抓取时由回调读取
+- 检索词项：德语、法语、俄语等非ASCII文字按完整的词切分，中文生成单字和双字
+- IVF索引在后台线程训练，训练期间加入和删除的行在替换聚类中心后都有正确的簇分配
+- 重启恢复：多个worker同时恢复时每个未完成的任务只被认领一次，已完成的文档拒绝再写入片段，
+  无法恢复的批量导入文档残留的片段被删除；写库与加入索引之间删除文档时索引中不残留该文档的行
+- 上传去重：内容相同的文件返回已有文档并带 X-Duplicate-Of 头；片段文本相同的新文档嵌入命中缓存，统计命中和未命中次数
+- 批量导入：逐文件返回成功、重复和失败，压缩包内解压后过大的文件按失败处理
+- 中文语料上的混合检索：问题含少见词项时只在候选片段上打分，常用单字不会让候选覆盖整个语料
+- 答案缓存：相同问题和检索结果直接返回缓存的答案，删除来源文档后引用它的答案失效
+- 批量问答接口：NDJSON逐行按完成顺序返回，每行带请求中的序号，同时进行的大模型调用不超过 concurrency
+- 流式问答接口（对接 benchmarks/stub_llm.py 桩服务）：先发 sources 事件，再逐段发 token，最后 done；上游出错时发 error
+- 分段：片段的 start_pos/end_pos 是全文token偏移，切回的文本与片段一致，token_count正确，
+  逐段输入（跨段缓冲、硬切截断多字节字符）时偏移也不错位；句子都不超长时片段在句末结束；
+  标点后不空格的中文与整段文本编码得到的token一致
+运行: python -m pytest test_retrieval.py
+"""
+
+import io
+import os
+import json
+import fcntl
+import contextlib
+import asyncio
+import zipfile
+import random
+import subprocess
+import sys
+import tempfile
+import importlib.util
+import numpy as np
+import tiktoken
+from types import SimpleNamespace
+from fastapi import HTTPException, UploadFile
+from tortoise import Tortoise, connections
+
+from models.document import Document, DocumentStatus
+from models.chunk import Chunk
+from services.embedding_codec import embedding_fields
+from services.simple_vector_db import SimpleVectorDB
+from services.vector_db import VectorDB
+from services.vector_index import IVFIndex, VectorIndex
+from services.mmap_index import MmapVectorIndex
+from services.quantized_index import QuantizedIndex
+from services.term_tokenizer import tokenize_terms
+from services.keyword_index import BM25Index, term_frequencies
+from services.hybrid_search import hybrid_search
+from services.ingestion import (DocumentDoneError, IngestionQueue, WORKER_ID, spool_bulk_upload, spool_path,
+                                store_chunks)
+from services.retrieval_generator import RetrievalAugmentedGenerator, pack_context
+from services.text_processor import TextProcessor
+
+QUERY_METHODS = ("execute_query", "execute_query_dict", "execute_insert", "execute_many", "execute_script")
+
+
+class FakeCompletions:
+    """代替大模型接口，直接返回固定答案"""
+
+    async def create(self, **kwargs):
+        message = SimpleNamespace(content="测试答案")
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+
+
+class RoundTripCounter:
+    """统计默认连接上执行的SQL次数"""
+
+    def __init__(self):
+        self.count = 0
+        self._originals = {}
+
+    def __enter__(self):
+        conn = connections.get("default")
+        for name in QUERY_METHODS:
+            original = getattr(conn, name)
+            self._originals[name] = original
+
+            async def counted(*args, _original=original, **kwargs):
+                self.count += 1
+                return await _original(*args, **kwargs)
+
+            setattr(conn, name, counted)
+        return self
+
+    def __exit__(self, *exc):
+        conn = connections.get("default")
+        for name, original in self._originals.items():
+            setattr(conn, name, original)
+
+
+async def build_corpus(vector_db: SimpleVectorDB, documents: int, chunks_per_document: int):
+    for d in range(documents):
+        doc = await Document.create(filename=f"doc{d}.txt", file_type="text/plain" if d % 2 else "text/markdown",
+                                    size=0, processed=True, status=DocumentStatus.DONE)
+        texts = [f"第{d}号文档的第{c}段，讨论错误代码 E-{c} 和设备 {d} 的维护方法。" for c in range(chunks_per_document)]
+        embeddings = vector_db._embed_batch(texts)
+        await Chunk.bulk_create([
+            Chunk(document_id=doc.id, text=text, start_pos=0, end_pos=len(text), token_count=len(text),
+                  **embedding_fields(embedding))
+            for text, embedding in zip(texts, embeddings)
+        ])
+    await vector_db.index.load(dim=vector_db.dim)
+
+
+async def init_memory_db():
+    await Tortoise.init(db_url="sqlite://:memory:",
+                        modules={"models": ["models.document", "models.chunk", "models.embedding_cache"]})
+
+
+def fake_client():
+    return SimpleNamespace(chat=SimpleNamespace(completions=FakeCompletions()))
+
+
+async def count_query_round_trips(documents: int, chunks_per_document: int, top_k: int) -> int:
+    await init_memory_db()
+    try:
+        await Tortoise.generate_schemas()
+        vector_db = SimpleVectorDB(VectorIndex())
+        await build_corpus(vector_db, documents, chunks_per_document)
+        rag = RetrievalAugmentedGenerator(vector_db, client=fake_client())
+
+        with RoundTripCounter() as counter:
+            answer, sources = await rag.generate_answer("错误代码 E-3 怎么处理", top_k=top_k, max_context_tokens=100000)
+        assert answer == "测试答案"
+        assert len(sources) == min(top_k, documents * chunks_per_document)
+        return counter.count
+    finally:
+        await Tortoise.close_connections()
+
+
+class CountingCompletions(FakeCompletions):
+    """记录大模型调用次数"""
+
+    def __init__(self):
+        self.calls = 0
+
+    async def create(self, **kwargs):
+        self.calls += 1
+        return await super().create(**kwargs)
+
+
+async def check_answer_cache():
+    from controllers import document_controller
+    from services.answer_cache import AnswerCache
+    await init_memory_db()
+    shared = document_controller.vector_db, document_controller.answer_cache
+    try:
+        await Tortoise.generate_schemas()
+        vector_db = document_controller.vector_db = SimpleVectorDB(VectorIndex())
+        answer_cache = document_controller.answer_cache = AnswerCache(max_entries=8, ttl=60)
+        await build_corpus(vector_db, documents=4, chunks_per_document=3)
+        completions = CountingCompletions()
+        rag = RetrievalAugmentedGenerator(vector_db, answer_cache=answer_cache,
+                                          client=SimpleNamespace(chat=SimpleNamespace(completions=completions)))
+
+        async def ask(question: str):
+            stats = {}
+            answer, sources = await rag.generate_answer(question, top_k=2, stats=stats)
+            return stats["answer_cache"], {source["document_id"] for source in sources}
+
+        status, cited = await ask("设备 1 的维护方法")
+        assert status == "miss" and completions.calls == 1
+        # 大小写和空白不同的同一问题、检索到相同片段时直接返回缓存的答案
+        assert await ask("  设备 1  的维护方法 ") == ("hit", cited) and completions.calls == 1
+
+        # 删除未被引用的文档不影响缓存，删除来源文档后引用它的答案失效
+        others = await Document.exclude(id__in=cited).values_list("id", flat=True)
+        await document_controller.delete_document(others[0])
+        assert answer_cache.invalidations == 0 and (await ask("设备 1 的维护方法"))[0] == "hit"
+        await document_controller.delete_document(next(iter(cited)))
+        assert answer_cache.invalidations == 1 and len(answer_cache._entries) == 0
+        assert (await ask("设备 1 的维护方法"))[0] == "miss" and completions.calls == 2
+        assert (answer_cache.hits, answer_cache.misses) == (2, 2)
+    finally:
+        document_controller.vector_db, document_controller.answer_cache = shared
+        await Tortoise.close_connections()
+
+
+def test_answer_cache_hits_and_invalidates_on_delete():
+    asyncio.run(check_answer_cache())
+
+
+class SlowCompletions:
+    """回答问题本身，序号除以3余2的立即返回，其余耗时0.2秒；记录同时进行的调用数"""
+
+    def __init__(self):
+        self.active = self.peak = 0
+
+    async def create(self, **kwargs):
+        question = kwargs["messages"][-1]["content"].split("问题: ")[1].split("\n")[0]
+        self.active += 1
+        self.peak = max(self.peak, self.active)
+        try:
+            await asyncio.sleep(0 if int(question.split("-")[1].split(" ")[0]) % 3 == 2 else 0.2)
+        finally:
+            self.active -= 1
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=f"答案 {question}"))])
+
+
+async def check_batch_query_endpoint():
+    from controllers import query_controller
+    from schemas.query import BatchQueryRequest, QueryRequest
+    await init_memory_db()
+    rag = query_controller.rag
+    try:
+        await Tortoise.generate_schemas()
+        vector_db = SimpleVectorDB(VectorIndex())
+        await build_corpus(vector_db, documents=4, chunks_per_document=5)
+        completions = SlowCompletions()
+        query_controller.rag = RetrievalAugmentedGenerator(
+            vector_db, client=SimpleNamespace(chat=SimpleNamespace(completions=completions)))
+        questions = [f"错误代码 E-{i} 怎么处理" for i in range(12)]
+        response = await query_controller.batch_query(BatchQueryRequest(
+            queries=[QueryRequest(question=question, top_k=2) for question in questions], concurrency=3))
+        assert response.media_type == "application/x-ndjson"
+        lines = [json.loads(line) async for line in response.body_iterator]
+    finally:
+        query_controller.rag = rag
+        await Tortoise.close_connections()
+
+    for line in lines:
+        assert set(line) == {"index", "question", "answer", "sources", "cached"}
+        assert line["question"] == questions[line["index"]] and line["answer"] == f"答案 {line['question']}"
+        assert len(line["sources"]) == 2 and line["cached"] is False
+    assert sorted(line["index"] for line in lines) == list(range(len(questions)))
+    # 按完成顺序返回：最先开始的3个问题中序号2立即完成，其余两个还在等待
+    assert lines[0]["index"] == 2 and [line["index"] for line in lines] != list(range(len(questions)))
+    assert completions.peak == 3
+
+
+def test_batch_query_streams_ndjson_within_concurrency():
+    asyncio.run(check_batch_query_endpoint())
+
+
+def load_stub_llm():
+    spec = importlib.util.spec_from_file_location(
+        "stub_llm", os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmarks", "stub_llm.py"))
+    stub = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(stub)
+    stub.LATENCY, stub.TOKENS_PER_SECOND, stub.OUTPUT_TOKENS = 0, 0, 5
+    return stub
+
+
+def parse_sse(body: str) -> list:
+    events = []
+    for block in body.strip().split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in block.splitlines())
+        events.append((lines["event"], json.loads(lines["data"])))
+    return events
+
+
+async def check_stream_query_endpoint():
+    import httpx
+    from openai import AsyncOpenAI
+    from controllers import query_controller
+    from schemas.query import QueryRequest
+    stub = load_stub_llm()
+    await init_memory_db()
+    rag = query_controller.rag
+    try:
+        await Tortoise.generate_schemas()
+        vector_db = SimpleVectorDB(VectorIndex())
+        await build_corpus(vector_db, documents=2, chunks_per_document=3)
+        client = AsyncOpenAI(api_key="test", base_url="http://stub/v1", max_retries=0,
+                             http_client=httpx.AsyncClient(transport=httpx.ASGITransport(app=stub.app)))
+        query_controller.rag = RetrievalAugmentedGenerator(vector_db, client=client)
+
+        async def stream(question: str) -> list:
+            response = await query_controller.stream_query(QueryRequest(question=question, top_k=2))
+            assert response.media_type == "text/event-stream"
+            return parse_sse("".join([part async for part in response.body_iterator]))
+
+        events = await stream("错误代码 E-1 怎么处理")
+        names = [name for name, _ in events]
+        assert names == ["sources"] + ["token"] * stub.OUTPUT_TOKENS + ["done"]
+        assert len(events[0][1]["sources"]) == 2 and events[-1][1] == {"cached": False}
+        assert "".join(data["text"] for name, data in events if name == "token").split()
+
+        stub.ERROR_RATE = 1
+        events = await stream("设备 1 的维护方法")
+        assert [name for name, _ in events] == ["sources", "error"] and events[1][1]["message"]
+        await client.close()
+    finally:
+        query_controller.rag = rag
+        await Tortoise.close_connections()
+
+
+def test_stream_query_events_against_stub_llm():
+    asyncio.run(check_stream_query_endpoint())
+
+
+def test_query_round_trips_are_constant():
+    small = asyncio.run(count_query_round_trips(documents=2, chunks_per_document=3, top_k=1))
+    large = asyncio.run(count_query_round_trips(documents=30, chunks_per_document=20, top_k=20))
+    # 一次读取命中的片段 + 一次读取来源文档
+    assert small == large == 2
+
+
+async def check_filtered_search():
+    await init_memory_db()
+    try:
+        await Tortoise.generate_schemas()
+        vector_db = SimpleVectorDB(VectorIndex())
+        await build_corpus(vector_db, documents=30, chunks_per_document=20)
+        rag = RetrievalAugmentedGenerator(vector_db, client=fake_client())
+        target = await Document.get(filename="doc7.txt")
+
+        stats = {}
+        with RoundTripCounter() as counter:
+            _, sources = await rag.generate_answer("错误代码 E-3 怎么处理", top_k=5, max_context_tokens=100000,
+                                                   stats=stats, filters={"document_ids": [target.id]})
+        assert counter.count == 2
+        assert len(sources) == 5 and {s["document_id"] for s in sources} == {target.id}
+        # 只扫描该文档的20行
+        assert stats["candidates"] == 20 and stats["total"] == 600
+
+        markdown_ids = set(await Document.filter(file_type="text/markdown").values_list("id", flat=True))
+        _, sources = await rag.generate_answer("设备 7 的维护方法", top_k=20, max_context_tokens=100000,
+                                               filters={"file_type": "text/markdown"})
+        assert len(sources) == 20 and {s["document_id"] for s in sources} <= markdown_ids
+    finally:
+        await Tortoise.close_connections()
+
+
+def test_filtered_search_is_scoped_and_returns_top_k():
+    asyncio.run(check_filtered_search())
+
+
+def test_lru_cache_evicts_and_expires():
+    from services import query_cache
+    now = [1000.0]
+    clock = query_cache.time
+    query_cache.time = SimpleNamespace(monotonic=lambda: now[0])
+    try:
+        cache = query_cache.LRUCache(max_entries=2, max_bytes=200, ttl=10, sizeof=lambda value: len(value))
+        cache.put("a", "x" * 50)
+        cache.put("b", "x" * 50)
+        assert cache.get("a") is not None  # a 变为最近使用，放入 c 时淘汰 b
+        cache.put("c", "x" * 50)
+        assert cache.get("b") is None and cache.get("a") and cache.get("c")
+        # 超过字节上限时从最久未用的开始淘汰，单个超过上限的值不缓存
+        cache.put("d", "x" * 160)
+        assert len(cache) == 1 and cache.bytes == 160 and cache.get("d")
+        cache.put("huge", "x" * 300)
+        assert cache.get("huge") is None and cache.evictions == 3
+        # 过期和代号不一致都按未命中处理，并删除条目
+        cache.put("e", "x", generation=1)
+        assert cache.get("e", generation=2) is None and "e" not in cache._entries
+        now[0] += 11
+        assert cache.get("d") is None and len(cache) == 0
+        assert (cache.expirations, cache.hits, cache.bytes) == (2, 4, 0)
+    finally:
+        query_cache.time = clock
+
+
+async def check_query_cache_generation():
+    await init_memory_db()
+    try:
+        await Tortoise.generate_schemas()
+        vector_db = SimpleVectorDB(VectorIndex())
+        await build_corpus(vector_db, documents=3, chunks_per_document=4)
+        question = "设备 7 的维护方法"
+        first = await vector_db.search(question, top_k=3)
+        stats = {}
+        assert [chunk.id for chunk, _ in await vector_db.search(question, top_k=3, stats=stats)] == \
+            [chunk.id for chunk, _ in first]
+        assert stats["backend"] == "cache" and vector_db.query_cache.results.hits == 1
+
+        # 新文档入库后索引代号变化，旧结果失效，新文档可以被检索到
+        doc = await Document.create(filename="new.txt", file_type="text/plain", size=1, status=DocumentStatus.EMBEDDING)
+        text = "设备 7 的维护方法：每月检查一次设备 7 的维护记录。"
+        await store_chunks(doc, [{"text": text, "start_pos": 0, "end_pos": 1, "token_count": 1}], vector_db)
+        stats = {}
+        hits = await vector_db.search(question, top_k=3, stats=stats)
+        assert stats["backend"] != "cache" and vector_db.query_cache.results.expirations == 1
+        assert hits[0][0].document_id == doc.id
+        # 查询向量与语料无关，仍然命中
+        assert vector_db.query_cache.embeddings.hits >= 1
+    finally:
+        await Tortoise.close_connections()
+
+
+def test_query_cache_invalidates_on_generation_bump():
+    asyncio.run(check_query_cache_generation())
+
+
+async def check_shared_mmap_index():
+    await init_memory_db()
+    try:
+        await Tortoise.generate_schemas()
+        vector_db = SimpleVectorDB(VectorIndex())
+        await build_corpus(vector_db, documents=6, chunks_per_document=10)
+        with tempfile.TemporaryDirectory() as directory:
+            # 模拟两个worker：writer 入库和删除，reader 只检索
+            writer, reader = MmapVectorIndex(directory, compact_ratio=0.05), MmapVectorIndex(directory)
+            await writer.load(dim=vector_db.dim)
+            await reader.load(dim=vector_db.dim)
+            assert len(reader) == 60 and reader.refresh() is None
+
+            doc = await Document.create(filename="new.txt", file_type="text/plain", size=0, status=DocumentStatus.DONE)
+            texts = [f"新文档的第{c}段，介绍备用电源的更换步骤。" for c in range(4)]
+            chunks = [await Chunk.create(document_id=doc.id, text=text, start_pos=0, end_pos=len(text),
+                                         **embedding_fields(embedding))
+                      for text, embedding in zip(texts, vector_db._embed_batch(texts))]
+            for index in (writer, vector_db.index):
+                index.register_document(doc.id, doc.file_type, doc.upload_date)
+                index.add_document(doc.id, [chunk.id for chunk in chunks], vector_db._embed_batch(texts))
+            generation = reader.generation
+            changes = reader.refresh()
+            assert changes["chunk_ids"].tolist() == [chunk.id for chunk in chunks]
+            assert reader.generation > generation and len(reader) == 64
+
+            query = vector_db._embed_batch(["备用电源怎么更换"])[0]
+            assert reader.search(query, top_k=10) == vector_db.index.search(query, top_k=10)
+            new_only = {"file_type": "text/plain", "upload_date_from": doc.upload_date}
+            assert {chunk_id for chunk_id, _ in reader.search(query, top_k=10, filters=new_only)} == \
+                {chunk.id for chunk in chunks}
+
+            # 其他进程持有写入锁时，在线程中等待，事件循环照常运行
+            with open(os.path.join(directory, "writer.lock"), "a") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+                async def remove():
+                    async with writer.write_lock():
+                        writer.remove_document(doc.id)
+
+                task = asyncio.create_task(remove())
+                await asyncio.sleep(0.05)
+                assert not task.done()
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+            await task
+            vector_db.index.remove_document(doc.id)
+            # 失效行超过比例，在后台线程压缩到新段
+            segment = writer.manifest["segment"]
+            writer._compacting.join()
+            assert reader.refresh()["removed"] == {doc.id}
+            assert reader.manifest["segment"] != segment and reader.dead_rows == 0
+            assert len(reader) == 60
+            assert reader.search(query, top_k=10) == vector_db.index.search(query, top_k=10)
+            assert reader.search_batch([query, query], top_k=3) == vector_db.index.search_batch([query, query], top_k=3)
+    finally:
+        await Tortoise.close_connections()
+
+
+def test_shared_mmap_index_syncs_between_instances():
+    asyncio.run(check_shared_mmap_index())
+
+
+async def check_quantized_index():
+    await init_memory_db()
+    try:
+        await Tortoise.generate_schemas()
+        vector_db = SimpleVectorDB(VectorIndex())
+        await build_corpus(vector_db, documents=30, chunks_per_document=20)
+        queries = vector_db._embed_batch(["错误代码 E-3 怎么处理", "设备 7 的维护方法", "第12号文档"])
+        with tempfile.TemporaryDirectory() as directory:
+            for method in ("int8", "pq"):
+                index = QuantizedIndex(method, rerank_factor=4, min_train_size=1, directory=directory, compact_ratio=0.02)
+                await index.load(dim=vector_db.dim)
+                memory = index.memory_stats()
+                # 数据量小时码本占比大，只比较每行压缩码的大小
+                assert memory["trained"] and memory["code_bytes"] * (4 if method == "int8" else 16) == memory["float_bytes"]
+                for query in queries:
+                    stats = {}
+                    hits = index.search(query, top_k=5, stats=stats)
+                    assert stats["rerank"] == 20
+                    expected = dict(vector_db.index.search(query, top_k=600))
+                    # 精排后的得分是全精度的
+                    assert all(abs(score - expected[chunk_id]) < 1e-5 for chunk_id, score in hits)
+                    if method == "int8":
+                        assert [round(score, 5) for _, score in hits] == \
+                            [round(score, 5) for _, score in vector_db.index.search(query, top_k=5)]
+
+                # 删除只标记失效行，检索立即跳过；失效行超过比例后在后台压缩
+                target = await Document.get(filename="doc7.txt")
+                index.remove_document(target.id)
+                assert len(index) == 580 and index.codes.shape[0] == 600 and index._background is not None
+                assert target.id not in {index.document_ids[index.chunk_ids.tolist().index(chunk_id)]
+                                         for chunk_id, _ in index.search(queries[1], top_k=20)}
+                before = [round(score, 5) for _, score in index.search(queries[0], top_k=5)]
+                await index._background
+                assert index.codes.shape[0] == index.store.rows == len(index) == 580 and index.dead_rows == 0
+                assert [round(score, 5) for _, score in index.search(queries[0], top_k=5)] == before
+
+                if method == "int8":
+                    # 数据量翻倍时在后台重新训练，期间追加的行用新码本补编码
+                    codec = index.codec
+                    texts = [f"补充文档的第{c}段" for c in range(620)]
+                    index.add_document(target.id + 1000, range(10000, 10620), vector_db._embed_batch(texts))
+                    assert index._background is not None and index.codec is codec
+                    index.add_document(target.id + 1001, range(20000, 20010), vector_db._embed_batch(texts[:10]))
+                    await index._background
+                    assert index.codec is not codec and index.codes.shape[0] == len(index) == 1210
+                    assert (index.codes == index.codec.encode(index.matrix)).all()
+                index._replace_store(None)
+    finally:
+        await Tortoise.close_connections()
+
+
+def test_quantized_index_reranks_to_exact_scores():
+    asyncio.run(check_quantized_index())
+
+
+class StubForwardDB(VectorDB):
+    """用文本在列表中的序号代替模型输出，记录每次前向计算的输入"""
+
+    def __init__(self, texts: list, **kwargs):
+        super().__init__(**kwargs)
+        self.ids = {text: i for i, text in enumerate(texts)}
+        self.calls = []
+
+    def _forward(self, texts):
+        self.calls.append(list(texts))
+        return np.array([[self.ids[text], len(text)] for text in texts], dtype=np.float32)
+
+
+async def check_transformer_batching():
+    rng = random.Random(5)
+    texts = [f"{i}:" + "字" * rng.randint(0, 200) for i in range(50)]
+    db = StubForwardDB(texts)
+    db.batch_size = 8
+    try:
+        # 按长度分桶，每批内长度接近，结果仍按输入顺序
+        assert db.embed_batch(texts)[:, 0].tolist() == list(range(len(texts)))
+        assert [len(call) for call in db.calls] == [8] * 6 + [2]
+        lengths = [len(text) for call in db.calls for text in call]
+        assert lengths == sorted(lengths)
+        chunks = await db.create_embeddings([{"text": text} for text in texts])
+        assert [int(chunk["embedding"][0]) for chunk in chunks] == list(range(len(texts)))
+
+        # 并发到达的查询合并为一次前向计算
+        db.calls.clear()
+        db.query_batcher.max_wait = 0.05
+        embeddings = await asyncio.gather(*(db.embed_question(text) for text in texts[:6]))
+        assert [int(embedding[0]) for embedding in embeddings] == list(range(6))
+        assert len(db.calls) == 1 and sorted(db.calls[0]) == sorted(texts[:6])
+        assert db.query_batcher.batches == 1 and db.query_batcher.mean_batch_size == 6
+        # 超过 max_batch_size 时分成多次
+        db.query_batcher.max_batch_size = 4
+        await asyncio.gather(*(db.embed_question(text) for text in texts[10:16]))
+        assert [len(call) for call in db.calls[1:]] == [4, 2]
+        # 模型从未加载
+        assert db.model is None
+    finally:
+        db.executor.shutdown()
+
+
+def test_transformer_batches_keep_order_and_merge_queries():
+    asyncio.run(check_transformer_batching())
+
+
+def test_app_import_skips_heavy_dependencies():
+    # 在新的解释器中导入应用：解析库、模型、分句和分词库都在首次使用时才导入
+    script = ("import sys; before = set(sys.modules); import main; "
+              "print(' '.join(sorted({name.split('.')[0] for name in sys.modules} - before)))")
+    result = subprocess.run([sys.executable, "-c", script], cwd=os.path.dirname(os.path.abspath(__file__)),
+                            capture_output=True, text=True, timeout=120, check=True)
+    loaded = set(result.stdout.strip().splitlines()[-1].split())
+    heavy = {"torch", "transformers", "sentence_transformers", "sklearn", "nltk", "tiktoken", "openai",
+             "pdfplumber", "pytesseract", "PIL", "openpyxl", "docx"}
+    assert "main" in loaded and not loaded & heavy, loaded & heavy
+
+
+def test_context_packing_skips_oversized_chunk():
+    # 第2名的片段超出预算，后面能放下的片段仍被选入，并保持排名顺序
+    assert pack_context([100, 2900, 100, 100], [0.9, 0.8, 0.7, 0.6], 1000) == [0, 2, 3]
+    # 预算内得分之和最大，而不是贪心地先放高分
+    assert pack_context([600, 500, 500], [0.9, 0.6, 0.6], 1000) == [1, 2]
+
+
+def test_metrics_exposition():
+    from services.metrics import CallbackMetric, Counter, Gauge, Histogram, Registry
+    registry = Registry()
+    latency = Histogram("t_seconds", "耗时", ("stage",), buckets=(0.1, 1), registry=registry)
+    for value in (0.05, 0.1, 0.5, 3):
+        latency.observe(value, stage="search")
+    Counter("t_total", "次数", registry=registry).inc(2)
+    Gauge("t_size", "大小", function=lambda: 7, registry=registry)
+    CallbackMetric("t_hits_total", "命中", "counter", lambda: [({"cache": 'a"b'}, 3)], registry=registry)
+    # 桶累积计数，le 等于上界的值落在该桶内，+Inf 桶等于 _count
+    assert registry.render().splitlines() == [
+        "# HELP t_seconds 耗时", "# TYPE t_seconds histogram",
+        't_seconds_bucket{stage="search",le="0.1"} 2',
+        't_seconds_bucket{stage="search",le="1"} 3',
+        't_seconds_bucket{stage="search",le="+Inf"} 4',
+        't_seconds_sum{stage="search"} 3.65',
+        't_seconds_count{stage="search"} 4',
+        "# HELP t_total 次数", "# TYPE t_total counter", "t_total 2",
+        "# HELP t_size 大小", "# TYPE t_size gauge", "t_size 7",
+        "# HELP t_hits_total 命中", "# TYPE t_hits_total counter", 't_hits_total{cache="a\\"b"} 3',
+    ]
+    try:
+        Counter("t_total", "重复", registry=registry)
+        raise AssertionError("同名指标不应重复注册")
+    except ValueError:
+        pass
+
+    # 应用的 /metrics：各阶段直方图和抓取时由回调读取的仪表
+    import main
+    from services.metrics import STAGE_SECONDS
+    STAGE_SECONDS.observe(0.003, stage="search")
+    response = asyncio.run(main.metrics())
+    assert response.media_type == "text/plain; version=0.0.4"
+    lines = response.body.decode().splitlines()
+    assert "# TYPE kbserve_stage_seconds histogram" in lines
+    buckets = [line for line in lines if line.startswith('kbserve_stage_seconds_bucket{stage="search"')]
+    assert buckets[0].startswith('kbserve_stage_seconds_bucket{stage="search",le="0.001"}')
+    assert buckets[-1].startswith('kbserve_stage_seconds_bucket{stage="search",le="+Inf"}')
+    counts = [int(line.rsplit(" ", 1)[1]) for line in buckets]
+    assert counts == sorted(counts) and counts[-1] >= 1
+    assert f'kbserve_stage_seconds_count{{stage="search"}} {counts[-1]}' in lines
+    assert any(line.startswith('kbserve_stage_seconds_sum{stage="search"} ') for line in lines)
+    assert f"kbserve_vector_index_chunks {len(main.vector_index)}" in lines
+    assert "# TYPE kbserve_ingest_pending gauge" in lines and f"kbserve_ingest_pending {main.ingest_queue.pending}" in lines
+    assert 'kbserve_cache_lookups_total{cache="answer",result="hit"} ' + str(main.answer_cache.hits) in lines
+
+
+def test_term_tokenizer_keeps_non_ascii_words():
+    assert tokenize_terms("Запрос: документ и ПАМЯТЬ") == ["запрос", "документ", "и", "память"]
+    assert tokenize_terms("Die Größe der Straße") == ["die", "grösse", "der", "strasse"]
+    assert tokenize_terms("Café, résumé, naïve") == ["café", "résumé", "naïve"]
+    # 全角字母数字规范化为半角，编号整体保留
+    assert tokenize_terms("错误码ＥＲＲ－１２ v1.2") == ["错", "误", "码", "错误", "误码", "err-12", "v1.2"]
+
+    vector_db = SimpleVectorDB(VectorIndex())
+    russian, german = vector_db._embed_batch(["документ о памяти устройства", "Wartung der Straßenbeleuchtung"])
+    assert russian.any() and german.any()
+
+
+def mixed_sentences(rng: random.Random, count: int, max_words: int, long_ratio: float = 0.0) -> list:
+    """中英文混合的句子，long_ratio 的句子远超片段长度，只能硬切"""
+    english = "retrieval index vector query document chunk token embedding latency cache batch memory".split()
+    chinese = ["检索", "向量", "文档", "分段", "查询", "缓存", "延迟", "模型", "答案", "索引", "数据库", "服务器"]
+    sentences = []
+    for _ in range(count):
+        n = rng.randint(60, 150) if rng.random() < long_ratio else rng.randint(3, max_words)
+        if rng.random() < 0.5:
+            sentences.append(" ".join(rng.choice(english) for _ in range(n)).capitalize() + ".")
+        else:
+            sentences.append("".join(rng.choice(chinese) for _ in range(n)) + "。")
+    return sentences
+
+
+def check_chunk_offsets(processor: TextProcessor, chunks: list, text: str):
+    tokens = processor.encoding.encode(text)
+    assert chunks[0]["start_pos"] == 0 and chunks[-1]["end_pos"] == len(tokens)
+    for previous, chunk in zip([None] + chunks, chunks):
+        assert chunk["token_count"] == chunk["end_pos"] - chunk["start_pos"] <= processor.chunk_size
+        assert processor.encoding.decode(tokens[chunk["start_pos"]:chunk["end_pos"]]) == chunk["text"]
+        if previous is not None:
+            # 相邻片段首尾相接或重叠，重叠不超过 overlap
+            assert previous["start_pos"] < chunk["start_pos"] <= previous["end_pos"]
+            assert previous["end_pos"] - chunk["start_pos"] <= processor.overlap
+
+
+def test_chunker_offsets_slice_back_to_text():
+    processor = TextProcessor(chunk_size=120, overlap=30)
+    text = " ".join(mixed_sentences(random.Random(7), 400, 25, long_ratio=0.05))
+    chunks = processor.chunk_text(text, 3)
+    assert len(chunks) > 100 and {chunk["document_id"] for chunk in chunks} == {3}
+    check_chunk_offsets(processor, chunks, text)
+    # 超长句子按 chunk_size 硬切
+    assert any(chunk["token_count"] == processor.chunk_size for chunk in chunks)
+
+    # 逐段输入：缓冲区多次切分，偏移与整篇文本的token一一对应
+    segments = [text[i:i + 997] for i in range(0, len(text), 997)]
+    streamed = list(processor.iter_chunks(segments, 3))
+    check_chunk_offsets(processor, streamed, " ".join(processor.clean_text(segment) for segment in segments))
+
+    assert processor.chunk_text("", 1) == []
+    short = processor.chunk_text("Short text.", 1)
+    assert [(c["text"], c["start_pos"], c["end_pos"]) for c in short] == [("Short text.", 0, short[0]["token_count"])]
+
+
+def test_chunker_ends_chunks_at_sentence_boundaries():
+    processor = TextProcessor(chunk_size=400, overlap=80)
+    text = " ".join(mixed_sentences(random.Random(3), 300, 10))
+    chunks = processor.chunk_text(text, 1)
+    assert len(chunks) > 10
+    check_chunk_offsets(processor, chunks, text)
+    assert all(chunk["text"].endswith((".", "。")) for chunk in chunks[:-1])
+
+
+def pretoken_bpe_encoding(words: list):
+    """cl100k 预分词规则加上几个汉字与标点的合并，离线也能复现"。第二句"这类跨句合并"""
+    pattern = r"""(?i:'s|'t|'re|'ve|'m|'ll|'d)|[^\r\n\p{L}\p{N}]?\p{L}+|\p{N}{1,3}| ?[^\s\p{L}\p{N}]+[\r\n]*|\s*[\r\n]+|\s+(?!\S)|\s+"""
+    ranks = {bytes([i]): i for i in range(256)}
+    for word in sorted(words, key=len):
+        data = word.encode()
+        for n in range(2, len(data) + 1):
+            ranks.setdefault(data[:n], len(ranks))
+    return tiktoken.Encoding(name="pretoken-bpe", pat_str=pattern, mergeable_ranks=ranks, special_tokens={})
+
+
+def test_chunker_offsets_on_unspaced_chinese():
+    # 句末标点后没有空格，标点与下一句的字合成一个预分词词，切分位置必须与整段文本编码一致
+    text = "第一句。第二句。第三句" + "第四句！附注？（括号）。第五句；" * 30 + "English. Next one！「引号」。结束"
+    characters = set("第一二三四五句附注括号结束引")
+    for encoding in (None, pretoken_bpe_encoding(list(characters) + [p + c for p in "。！？；" for c in characters])):
+        processor = TextProcessor(chunk_size=40, overlap=10)
+        processor.encoding = encoding or processor.encoding
+        check_chunk_offsets(processor, processor.chunk_text(text, 1), text)
+        segments = [text[i:i + 50] for i in range(0, len(text), 50)]
+        check_chunk_offsets(processor, list(processor.iter_chunks(segments, 1)),
+                            " ".join(processor.clean_text(segment) for segment in segments))
+
+
+async def check_ivf_background_training():
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((3000, 32)).astype(np.float32)
+    index = IVFIndex(nlist=16, nprobe=16, min_train_size=2000)
+    index.add_documents([(d + 1, range(d * 100, d * 100 + 100), vectors[d * 100:d * 100 + 100]) for d in range(20)])
+    # 训练在后台进行，期间仍可检索、加入和删除
+    assert index._training is not None and index.centroids is None
+    index.add_documents([(d + 1, range(d * 100, d * 100 + 100), vectors[d * 100:d * 100 + 100]) for d in range(20, 30)])
+    index.remove_document(5)
+    assert len(index.search(vectors[0], top_k=5)) == 5
+    await index._training
+    assert index._training is None and len(index.centroids) == 16
+    assert len(index.assignments) == len(index) == 2900
+    assert (index.assignments == index._assign(index.matrix)).all()
+    # nprobe覆盖全部簇时结果与精确检索一致
+    exact = VectorIndex()
+    exact.add_documents([(d + 1, range(d * 100, d * 100 + 100), vectors[d * 100:d * 100 + 100]) for d in range(30) if d != 4])
+    assert [chunk_id for chunk_id, _ in index.search(vectors[7], top_k=5)] == \
+        [chunk_id for chunk_id, _ in exact.search(vectors[7], top_k=5)]
+
+
+def test_ivf_trains_in_background():
+    asyncio.run(check_ivf_background_training())
+
+
+async def check_recovery_claims():
+    await init_memory_db()
+    try:
+        await Tortoise.generate_schemas()
+        vector_db = SimpleVectorDB(VectorIndex())
+        # 上次运行的进程已退出：同一主机上不存在的进程号
+        dead_owner = WORKER_ID.replace(f":{os.getpid()}:", ":999999999:")
+        orphan = await Document.create(filename="orphan.txt", file_type="text/plain", size=1,
+                                       status=DocumentStatus.PARSING, owner=dead_owner)
+        running = await Document.create(filename="running.txt", file_type="text/plain", size=1,
+                                        status=DocumentStatus.EMBEDDING, owner=WORKER_ID)
+        # 批量导入中途重启：已提交了一批片段（并在启动时被加载进索引），但没有暂存文件可以恢复
+        partial = await Document.create(filename="partial.txt", file_type="text/plain", size=1,
+                                        status=DocumentStatus.PARSING, owner=dead_owner)
+        texts = ["批量导入已写入的片段"] * 3
+        await Chunk.bulk_create([Chunk(document_id=partial.id, text=text, start_pos=0, end_pos=len(text), token_count=1,
+                                       **embedding_fields(embedding))
+                                 for text, embedding in zip(texts, vector_db._embed_batch(texts))])
+        await vector_db.index.load(dim=vector_db.dim)
+        assert len(vector_db.index) == 3
+        paths = [spool_path(doc.id, doc.filename) for doc in (orphan, running)]
+        for path in paths:
+            with open(path, "w") as f:
+                f.write("x")
+        submitted = []
+        workers = [IngestionQueue(vector_db) for _ in range(3)]
+        for worker in workers:
+            worker.submit = lambda document_id, path, force=False: submitted.append(document_id)
+        try:
+            await asyncio.gather(*(worker.recover() for worker in workers))
+        finally:
+            for path in paths:
+                os.unlink(path)
+        assert submitted == [orphan.id]
+        assert (await Document.get(id=orphan.id)).owner == WORKER_ID
+        assert (await Document.get(id=partial.id)).status == DocumentStatus.FAILED
+        assert await Chunk.filter(document_id=partial.id).count() == 0 and len(vector_db.index) == 0
+
+        done = await Document.create(filename="done.txt", file_type="text/plain", size=1,
+                                     status=DocumentStatus.DONE, processed=True)
+        chunk = {"text": "重复入库", "start_pos": 0, "end_pos": 4, "token_count": 4}
+        try:
+            await store_chunks(done, [chunk], vector_db)
+            raise AssertionError("已完成的文档不应再写入片段")
+        except DocumentDoneError:
+            pass
+        assert await Chunk.filter(document_id=done.id).count() == 0
+    finally:
+        await Tortoise.close_connections()
+
+
+def test_recovery_claims_each_job_once():
+    asyncio.run(check_recovery_claims())
+
+
+class DeletingIndex(VectorIndex):
+    """第一次加锁写入之前先执行 on_write，模拟在写库与加入索引之间到达的删除请求"""
+    on_write = None
+
+    @contextlib.asynccontextmanager
+    async def write_lock(self):
+        on_write, self.on_write = self.on_write, None
+        if on_write is not None:
+            await on_write()
+        yield
+
+
+async def check_delete_during_ingest():
+    from controllers import document_controller
+    await init_memory_db()
+    shared = document_controller.vector_db
+    try:
+        await Tortoise.generate_schemas()
+        index, keyword_index = DeletingIndex(), BM25Index()
+        vector_db = document_controller.vector_db = SimpleVectorDB(index, keyword_index=keyword_index)
+        doc = await Document.create(filename="gone.txt", file_type="text/plain", size=1,
+                                    status=DocumentStatus.EMBEDDING, owner=WORKER_ID)
+        index.on_write = lambda: document_controller.delete_document(doc.id)
+        chunks = [{"text": f"第{i}段维护记录", "start_pos": i, "end_pos": i + 1, "token_count": 1} for i in range(3)]
+        try:
+            await store_chunks(doc, chunks, vector_db)
+            raise AssertionError("文档已被删除，入库应当失败")
+        except ValueError:
+            pass
+        # 索引中不残留已删除文档的行
+        assert len(index) == 0 and len(keyword_index) == 0
+        assert await Chunk.all().count() == 0 and not await Document.exists(id=doc.id)
+    finally:
+        document_controller.vector_db = shared
+        await Tortoise.close_connections()
+
+
+def test_delete_during_ingest_leaves_no_index_rows():
+    asyncio.run(check_delete_during_ingest())
+
+
+async def check_upload_dedup():
+    from fastapi import Response
+    from controllers import document_controller
+    from services.embedding_cache import EmbeddingCache
+    await init_memory_db()
+    shared = document_controller.vector_db, document_controller.embedding_cache, dict(document_controller.upload_stats)
+    try:
+        await Tortoise.generate_schemas()
+        vector_db = document_controller.vector_db = SimpleVectorDB(VectorIndex())
+        cache = document_controller.embedding_cache = EmbeddingCache(vector_db)
+        document_controller.upload_stats.update(uploads=0, duplicates=0)
+        text = "".join(f"第{i}条：检查设备 {i} 的备用电源。" for i in range(200))
+
+        async def upload(name: str, content: str):
+            response = Response()
+            doc = await document_controller.upload_document(
+                response, UploadFile(io.BytesIO(content.encode("utf-8")), filename=name), async_mode=False)
+            return doc, response.headers.get("X-Duplicate-Of")
+
+        first, duplicate_of = await upload("a.txt", text)
+        assert duplicate_of is None and first.chunk_count > 1
+        assert (cache.hits, cache.misses) == (0, first.chunk_count)
+        # 内容相同的上传直接返回已有文档，不再解析和嵌入
+        again, duplicate_of = await upload("a-copy.txt", text)
+        assert again.id == first.id and duplicate_of == str(first.id)
+        assert await Document.all().count() == 1 and cache.misses == first.chunk_count
+        # 只有空白不同的文件是新文档，片段文本相同，嵌入全部命中缓存
+        spaced, duplicate_of = await upload("b.txt", text.replace(" ", "  "))
+        assert duplicate_of is None and spaced.id != first.id and spaced.chunk_count == first.chunk_count
+        assert (cache.hits, cache.misses) == (first.chunk_count, first.chunk_count)
+
+        stats = await document_controller.get_ingest_stats()
+        assert (stats["uploads"], stats["duplicate_uploads"], stats["duplicate_rate"]) == (3, 1, round(1 / 3, 4))
+        assert stats["embedding_cache"]["hit_rate"] == 0.5
+    finally:
+        document_controller.vector_db, document_controller.embedding_cache = shared[:2]
+        document_controller.upload_stats.update(shared[2])
+        await Tortoise.close_connections()
+
+
+def test_upload_dedup_and_embedding_cache_counters():
+    asyncio.run(check_upload_dedup())
+
+
+def zip_bytes(files: dict) -> bytes:
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as archive:
+        for name, data in files.items():
+            archive.writestr(name, data)
+    return buffer.getvalue()
+
+
+async def check_bulk_upload():
+    from controllers import document_controller
+    await init_memory_db()
+    try:
+        await Tortoise.generate_schemas()
+        archive = zip_bytes({"docs/a.txt": "设备维护手册。" * 50, "docs/a-copy.txt": "设备维护手册。" * 50,
+                             "docs/b.xyz": "???", "__MACOSX/docs/._a.txt": "x"})
+        response = await document_controller.bulk_upload_documents(files=[
+            UploadFile(io.BytesIO(archive), filename="docs.zip"),
+            UploadFile(io.BytesIO(b"not a zip"), filename="broken.zip"),
+            UploadFile(io.BytesIO("备用电源的更换步骤".encode("utf-8")), filename="c.txt"),
+        ])
+        assert (response["total"], response["done"], response["duplicate"], response["failed"]) == (5, 2, 1, 2)
+        files = {file["filename"]: file for file in response["files"]}
+        assert list(files) == ["docs/a.txt", "docs/a-copy.txt", "docs/b.xyz", "broken.zip", "c.txt"]
+        assert files["docs/a.txt"]["chunk_count"] > 0
+        assert files["docs/a-copy.txt"]["document_id"] == files["docs/a.txt"]["document_id"]
+        assert files["docs/b.xyz"]["document_id"] is None and files["docs/b.xyz"]["error"]
+        # 失败的文件不保留文档记录
+        assert await Document.all().count() == 2
+        assert await Chunk.all().count() == files["docs/a.txt"]["chunk_count"] + files["c.txt"]["chunk_count"]
+    finally:
+        document_controller.ingest_queue.shutdown()
+        await Tortoise.close_connections()
+
+    # 压缩炸弹：按实际解压出的字节数限制，单个文件过大时整个压缩包失败，总量超限时拒绝请求
+    bomb = zip_bytes({"small.txt": "x", "zeros.txt": b"\0" * (4 << 20)})
+    try:
+        spool_bulk_upload(io.BytesIO(bomb), "bomb.zip", max_file_bytes=1 << 20)
+        raise AssertionError("解压后过大的文件应被拒绝")
+    except ValueError as e:
+        assert "zeros.txt" in str(e)
+    limit, document_controller.BULK_MAX_TOTAL_BYTES = document_controller.BULK_MAX_TOTAL_BYTES, 1 << 20
+    try:
+        await document_controller.bulk_upload_documents(files=[UploadFile(io.BytesIO(bomb), filename="bomb.zip")])
+        raise AssertionError("总大小超限时应返回413")
+    except HTTPException as e:
+        assert e.status_code == 413
+    finally:
+        document_controller.BULK_MAX_TOTAL_BYTES = limit
+
+
+def test_bulk_upload_reports_each_file():
+    asyncio.run(check_bulk_upload())
+
+
+def test_hybrid_search_prunes_chinese_corpus():
+    words = ["设备", "温度", "故障", "维护", "数据库", "索引", "缓存", "服务器", "响应", "内存", "文档", "解析"]
+    rng = random.Random(0)
+    texts = ["".join(rng.choice(words) for _ in range(30)) + "。" for _ in range(400)]
+    texts[123] += " 故障码 E-4242 需要更换风扇"
+    vector_db = SimpleVectorDB(VectorIndex())
+    keyword_index = BM25Index()
+    for d in range(40):
+        chunk_ids = list(range(d * 10 + 1, d * 10 + 11))
+        batch = texts[d * 10:d * 10 + 10]
+        vector_db.index.add_document(d + 1, chunk_ids, vector_db._embed_batch(batch))
+        keyword_index.add_document(d + 1, chunk_ids, [term_frequencies(text) for text in batch])
+
+    # 几乎每个片段都包含"故"、"数据"这类常用词项，候选只取少见词项的倒排表，不足融合深度时用BM25排名补足
+    for question, target in (("故障码 E-4242 怎么处理", 124), ("数据库服务器的风扇", None)):
+        stats = {}
+        hits = hybrid_search(vector_db.index, keyword_index, question, vector_db._embed_batch([question])[0],
+                             top_k=5, stats=stats)
+        assert stats["pruned"] is True and stats["candidates"] < len(texts) / 4
+        assert len(hits) == 5 and (target is None or target in dict(hits))
+
+
+if __name__ == "__main__":
+    test_query_round_trips_are_constant()
+    test_answer_cache_hits_and_invalidates_on_delete()
+    test_batch_query_streams_ndjson_within_concurrency()
+    test_stream_query_events_against_stub_llm()
+    test_filtered_search_is_scoped_and_returns_top_k()
+    test_lru_cache_evicts_and_expires()
+    test_query_cache_invalidates_on_generation_bump()
+    test_shared_mmap_index_syncs_between_instances()
+    test_quantized_index_reranks_to_exact_scores()
+    test_transformer_batches_keep_order_and_merge_queries()
+    test_app_import_skips_heavy_dependencies()
+    test_context_packing_skips_oversized_chunk()
+    test_metrics_exposition()
+    test_term_tokenizer_keeps_non_ascii_words()
+    test_chunker_offsets_slice_back_to_text()
+    test_chunker_ends_chunks_at_sentence_boundaries()
+    test_chunker_offsets_on_unspaced_chinese()
+    test_ivf_trains_in_background()
+    test_recovery_claims_each_job_once()
+    test_delete_during_ingest_leaves_no_index_rows()
+    test_upload_dedup_and_embedding_cache_counters()
+    test_bulk_upload_reports_each_file()
+    test_hybrid_search_prunes_chinese_corpus()
+    print("检索路径测试通过")
+